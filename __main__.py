@@ -12,12 +12,13 @@ def main():
 	parser_server = subparsers.add_parser('server',
 		help='To be run by client. Receives client commands and execute them.')
 	client.populate_subparsers(parser_client)
+	server.populate_parser(parser_server)
 
 	args = parser.parse_args()
 	if args.mode == 'client':
 		client.main(args)
 	elif args.mode == 'server':
-		server.main()
+		server.main(args)
 
 if __name__ == "__main__":
 	sys.exit(main())
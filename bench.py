@@ -0,0 +1,245 @@
+import sys
+import os
+import json
+import time
+import shlex
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+import subprocess
+
+import client
+
+PKG_DIR = os.path.dirname(os.path.abspath(__file__))
+GiB = 1024 ** 3
+
+# full size scenarios. Use --scale to shrink them.
+SCENARIOS = {
+	# name: description
+	'tiny': "1M files of up to 256 bytes in 1000 directories",
+	'large': "3 files of 10GiB",
+	'deep': "100k files in directories nested 64 levels deep",
+	'symlinks': "200k symlinks pointing to 50k files",
+	'mixed': "200k files of up to 64KiB, 20 files of up to 64MiB and 20k symlinks",
+}
+# fraction of entries changed by the churn between the first and second sync
+CHURN_MODIFY = 0.01
+CHURN_DELETE = 0.005
+CHURN_ADD = 0.005
+CHURN_CHMOD = 0.002
+
+def _scaled(n, scale):
+	return max(1, int(n * scale))
+
+def _write_random(rnd, fn, size, blocksz=1_048_576):
+	with open(fn, 'wb') as f:
+		while size:
+			n = min(size, blocksz)
+			f.write(rnd.randbytes(n))
+			size -= n
+
+def _gen_files(rnd, count, dirs, maxsz, prefix="f"):
+	for i in range(count):
+		d = f"d{i % dirs:04d}"
+		os.makedirs(d, exist_ok=True)
+		_write_random(rnd, f"{d}/{prefix}{i}", rnd.randint(0, maxsz))
+
+def _gen_tree(name, rnd, scale):
+	"""Generate the scenario's tree in the current directory"""
+	if name == 'tiny':
+		_gen_files(rnd, _scaled(1_000_000, scale), _scaled(1000, scale), 256)
+	elif name == 'large':
+		for i in range(3):
+			_write_random(rnd, f"large{i}.bin", _scaled(10 * GiB, scale))
+	elif name == 'deep':
+		count = _scaled(100_000, scale)
+		for i in range(count):
+			d = "/".join(f"n{(i + lvl) % 4}" for lvl in range(i % 64 + 1))
+			os.makedirs(d, exist_ok=True)
+			_write_random(rnd, f"{d}/f{i}", rnd.randint(0, 1024))
+	elif name == 'symlinks':
+		files = _scaled(50_000, scale)
+		_gen_files(rnd, files, _scaled(100, scale), 1024)
+		os.makedirs("links", exist_ok=True)
+		for i in range(_scaled(200_000, scale)):
+			j = rnd.randrange(files)
+			os.symlink(f"../d{j % _scaled(100, scale):04d}/f{j}", f"links/l{i}")
+	elif name == 'mixed':
+		_gen_files(rnd, _scaled(200_000, scale), _scaled(500, scale), 65536)
+		os.makedirs("big", exist_ok=True)
+		for i in range(_scaled(20, scale)):
+			_write_random(rnd, f"big/b{i}", rnd.randint(0, _scaled(64 * 1_048_576, scale)))
+		os.makedirs("links", exist_ok=True)
+		for i in range(_scaled(20_000, scale)):
+			os.symlink(f"target{rnd.randrange(1000)}", f"links/l{i}")
+	else:
+		raise ValueError(f"Unknown scenario '{name}'")
+
+def _churn(rnd):
+	"""Modify, delete, add, chmod and retarget some entries of the current tree"""
+	files = []
+	links = []
+	for root, _, names in os.walk("."):
+		for n in names:
+			pth = os.path.join(root, n)[2:]
+			if pth.startswith(".s2rstate"):
+				continue
+			(links if os.path.islink(pth) else files).append(pth)
+	files.sort()
+	links.sort()
+	rnd.shuffle(files)
+
+	def _take(frac):
+		n = int(len(files) * frac)
+		ret = files[:n]
+		del files[:n]
+		return ret
+
+	for fn in _take(CHURN_MODIFY):
+		size = os.path.getsize(fn)
+		if size > 1_048_576:
+			# change a small part of big files
+			with open(fn, 'r+b') as f:
+				f.seek(rnd.randrange(size))
+				f.write(rnd.randbytes(4096))
+		else:
+			_write_random(rnd, fn, rnd.randint(0, max(size * 2, 256)))
+	for fn in _take(CHURN_DELETE):
+		os.unlink(fn)
+	for fn in _take(CHURN_CHMOD):
+		os.chmod(fn, os.stat(fn).st_mode ^ 0o111)
+	for i in range(max(1, int((len(files) + len(links)) * CHURN_ADD))):
+		os.makedirs("added", exist_ok=True)
+		_write_random(rnd, f"added/a{i}", rnd.randint(0, 4096))
+	for lnk in links[:int(len(links) * CHURN_MODIFY)]:
+		os.unlink(lnk)
+		os.symlink(f"retargeted{rnd.randrange(1000)}", lnk)
+
+def _timer_total(report, name):
+	return report['timers'].get(name, {}).get('total_s', 0.0)
+
+def _sync(srcdir, syncargs):
+	"""Run 'client sync' in 'srcdir', and returns its measurements"""
+	statsfn = os.path.join(os.path.dirname(srcdir), "stats.json")
+	start = time.monotonic()
+	p = subprocess.run([sys.executable, PKG_DIR, "client", "sync", "--quiet",
+		"--stats", statsfn, *syncargs], cwd=srcdir, stdout=subprocess.DEVNULL,
+		check=False)
+	wall = time.monotonic() - start
+	try:
+		with open(statsfn, 'r') as f:
+			report = json.load(f)
+		os.unlink(statsfn)
+	except (OSError, ValueError):
+		return {'ok': False, 'wall_s': round(wall, 4)}
+
+	counters = report['counters']
+	return {
+		'ok': p.returncode == 0 and report['ok'],
+		'wall_s': round(wall, 4),
+		'load_s': _timer_total(report, 'load_state'),
+		'scan_s': _timer_total(report, 'scan'),
+		'diff_s': _timer_total(report, 'diff'),
+		'hash_s': _timer_total(report, 'hash'),
+		'sync_s': _timer_total(report, 'sync'),
+		'save_s': _timer_total(report, 'save_state'),
+		'files': counters.get('files_updated', 0) + counters.get('files_deleted', 0),
+		'bytes': counters.get('uploaded_bytes', 0),
+		'sent_bytes': counters.get('sent_bytes', 0),
+		'bytes_per_s': report.get('upload_bytes_per_s'),
+		'files_per_s': report.get('files_per_s'),
+		'round_trips': counters.get('requests', 0),
+		'client_max_rss_kb': report['client_max_rss_kb'],
+		'server_max_rss_kb': report['server_max_rss_kb'],
+		# buffer, chunk and window sizes chosen at runtime
+		'settings': report.get('settings', {}),
+	}
+
+def _run_scenario(name, workdir, args):
+	rnd = random.Random(f"{args.seed}:{name}")
+	base = os.path.join(workdir, name)
+	srcdir = os.path.join(base, "src")
+	dstdir = os.path.join(base, "dst")
+	shutil.rmtree(base, ignore_errors=True)
+	os.makedirs(srcdir)
+	os.makedirs(dstdir)
+
+	start = time.monotonic()
+	cwd = os.getcwd()
+	os.chdir(srcdir)
+	try:
+		_gen_tree(name, rnd, args.scale)
+		with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+			client._gen_state(argparse.Namespace(statefile=client.DEFAULT_STATE_FILE,
+				resolve_symlink=False, scan_workers=client.DEFAULT_SCAN_WORKERS), True)
+		with open(client.DEFAULT_STATE_FILE, 'r') as f:
+			sw = json.load(f)
+		sw['command'] = [sys.executable, PKG_DIR, "server"]
+		sw['remotecwd'] = dstdir
+		with open(client.DEFAULT_STATE_FILE, 'w') as f:
+			json.dump(sw, f)
+	finally:
+		os.chdir(cwd)
+	gen_s = time.monotonic() - start
+
+	syncargs = shlex.split(args.sync_args)
+	for run in ("initial", "churn", "noop"):
+		if run == "churn":
+			os.chdir(srcdir)
+			try:
+				_churn(rnd)
+			finally:
+				os.chdir(cwd)
+		res = _sync(srcdir, syncargs)
+		yield {'scenario': name, 'run': run, 'scale': args.scale,
+			'gen_s': round(gen_s, 4), 'sync_args': args.sync_args, **res}
+		gen_s = 0.0
+
+	if not args.keep:
+		shutil.rmtree(base, ignore_errors=True)
+
+def main():
+	parser = argparse.ArgumentParser(
+		description="Benchmark sync to a local server started over stdio. For each "\
+		"scenario, a tree is generated and synced 3 times: initially, after some "\
+		"changes, and without changes. Results are printed as JSON lines.")
+	parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+		help="Comma separated scenarios to run (default: all). Scenarios: " + \
+		"; ".join(f"'{k}': {v}" for k, v in SCENARIOS.items()))
+	parser.add_argument("--scale", type=float, default=1.0,
+		help="Multiply file counts and sizes of the scenarios (default: 1.0)")
+	parser.add_argument("--seed", default="s2r",
+		help="Seed for generating trees and changes (default: 's2r')")
+	parser.add_argument("--sync-args", default="",
+		help="Extra arguments for 'client sync', e.g. '--streams 4'")
+	parser.add_argument("--workdir",
+		help="Directory to generate trees in (default: a temporary directory)")
+	parser.add_argument("--keep", action="store_true",
+		help="Keep the generated trees")
+	parser.add_argument("--output", "-o",
+		help="Append results to this file instead of printing them")
+	args = parser.parse_args()
+
+	names = [n for n in args.scenarios.split(",") if n]
+	for n in names:
+		if n not in SCENARIOS:
+			parser.error(f"Unknown scenario '{n}'")
+	workdir = args.workdir or tempfile.mkdtemp(prefix="s2rbench.")
+	out = open(args.output, 'a') if args.output else sys.stdout
+	failed = False
+	try:
+		for n in names:
+			for res in _run_scenario(n, workdir, args):
+				failed |= not res['ok']
+				print(json.dumps(res), file=out, flush=True)
+	finally:
+		if out is not sys.stdout:
+			out.close()
+		if not args.workdir and not args.keep:
+			shutil.rmtree(workdir, ignore_errors=True)
+	return 1 if failed else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -1,176 +1,1065 @@
 import sys
 import os
 import json
+import signal
+import time
+import itertools
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+import shared
+import scanner
+import statefile
+import filters
+import tree
+import watch
+import clientcomm
 from clientcomm import run_sync
+from renames import find_renames
+from stats import Stats
 
 DEFAULT_STATE_FILE = '.s2rstate.json'
+DEFAULT_SCAN_WORKERS = 1
+DEFAULT_STREAMS = 1
+# how often the watch command saves the state file (seconds)
+CHECKPOINT_INTERVAL = 30
+# smaller files with duplicate contents are uploaded again instead of copied
+COPY_MIN_SZ = 4096
+# files hashed ahead of the diff, at most
+HASH_AHEAD = 256
 
-def _recursive_scan(path, result, resolve_symlink):
+def recursive_scan(stfile, resolve_symlink, workers=1, cache=None, filt=None):
 	"""
-	'result' is a dict of {relative path name: [target, mtime]}
+	Returns a tree.Tree of {relative path name: [target, mtime, size, digest, inode]}
 		'target' would be a string for symlinks.
 		On normal file, 'target' is a bool that contains whether the target file
 		is executable or not.
-	The 'path' argument suplied in this function must be '.'.
-	"""
-	for de in os.scandir(path):
-		include = False
-		is_symlink = de.is_symlink() and not resolve_symlink
-		if not is_symlink:
-			if de.is_dir():
-				_recursive_scan(os.path.join(path, de.name), result, resolve_symlink)
-			elif de.is_file():
-				include = True
-			# ignore non-file
-		else:
-			# include (but do not traverse) symlinks
-			include = True
-
-		if include:
-			st = de.stat(follow_symlinks=resolve_symlink)
-			mtime = max(st.st_ctime_ns, st.st_mtime_ns)
-			pth = os.path.join(path, de.name)[2:] # remove leading './'
-			# contains either a boolean indicating executable stat for regular file
-			# or symlink target for symlink
-			info = None
-			if is_symlink:
-				info = os.readlink(pth)
-			else:
-				info = bool(st.st_mode & 0o111)
-			result[pth] = (info, mtime)
-
-def recursive_scan(statefile, resolve_symlink):
-	ret = {}
-	_recursive_scan(".", ret, resolve_symlink)
-	# do not include state file for syncing!
-	if statefile in ret:
-		del ret[statefile]
+		'size' is None for symlinks.
+		'digest' is always None here. It is filled in by _do_sync for files that
+		it has hashed or uploaded.
+		'inode' is None for symlinks. It is used to detect renamed files.
+	The current directory is scanned. See scanner.scan for 'cache' and 'filt'.
+	"""
+	ret, stats = scanner.scan(resolve_symlink, workers, cache=cache, filt=filt)
+	print(f"Scanned {stats}")
+	# do not include state files for syncing!
+	for fn in _state_file_names(stfile):
+		ret.pop(fn, None)
 	return ret
 
+def _state_file_names(stfile):
+	datafile = statefile.data_file_name(stfile)
+	return (stfile, datafile, datafile + '.tmp')
+
+def _load_state(fn):
+	"""
+	returns:
+		(state dict, state data)
+		The state data is a statefile.StateData, or a dict if 'fn' was written by
+		an older version which embeds the data in the JSON. The data will be
+		migrated to the binary format the next time the state is saved.
+	raises:
+		FileNotFoundError if either the state file or its data file is not found
+		ValueError if either of them is corrupt, see _state_error
+	"""
+	with open(fn, 'r') as f:
+		sw = json.load(f)
+	data = sw.pop('data', None)
+	if data is None:
+		data = statefile.StateData(statefile.data_file_name(fn))
+	return sw, data
+
+def _state_error(ex):
+	"""Describe the exception raised by _load_state"""
+	if isinstance(ex, FileNotFoundError):
+		return "State file not found."
+	return f"Unable to load state file: {ex}."
+
+def _save_state(fn, sw, data, dirs=None):
+	"""
+	'data' is a dict or a tree.Tree of
+	{relative path name: [target, mtime, size, digest, inode]}
+	'dirs' are the directory listings of the scan of 'data', see scanner.DirCache.
+	"""
+	statefile.write(statefile.data_file_name(fn), data.items(), dirs,
+		isinstance(data, tree.Tree))
+	sw.pop('data', None)
+	with open(fn, 'w') as f:
+		json.dump(sw, f)
+
 def _gen_state(args, empty):
-	sf = None
 	try:
-		try:
-			os.stat(args.statefile)
-			sf = open(args.statefile, 'a+')
-			sf.seek(0)
-			sw = json.load(sf)
-		except FileNotFoundError:
-			sw = {
-				"command": [],
-				"remotecwd": None,
-				"resolve_symlink": args.resolve_symlink,
-				"data": None
-			}
-
-		if sw['resolve_symlink'] != args.resolve_symlink:
-			print("Previous state's resolve symlink setting must match.",
-				file=sys.stderr)
-			return 1
-
-		if not empty:
-			sw["data"] = recursive_scan(args.statefile, args.resolve_symlink)
-		else:
-			sw["data"] = {}
+		with open(args.statefile, 'r') as f:
+			sw = json.load(f)
+	except FileNotFoundError:
+		sw = {
+			"transport": "stdio",
+			"command": [],
+			"remotecwd": None,
+			"resolve_symlink": args.resolve_symlink,
+			# gitignore-style rules, see filters.Rules
+			"filters": [],
+			"ignore_file": filters.DEFAULT_IGNORE_FILE,
+		}
 
-		if not sf:
-			sf = open(args.statefile, 'w')
-		else:
-			sf.truncate(0)
-			sf.seek(0)
-		json.dump(sw, sf)
-	finally:
-		if sf:
-			sf.close()
+	if sw['resolve_symlink'] != args.resolve_symlink:
+		print("Previous state's resolve symlink setting must match.",
+			file=sys.stderr)
+		return 1
 
+	cache = None
+	if not empty:
+		cache = scanner.DirCache()
+		data = recursive_scan(args.statefile, args.resolve_symlink,
+			args.scan_workers, cache, filters.Filter.from_state(sw))
+	else:
+		data = {}
+	_save_state(args.statefile, sw, data, cache and cache.new)
 	return 0
 
+def _with_stats(args, func, stats=None):
+	"""
+	returns:
+		func(args, stats), after writing the report of 'stats' (a new Stats by
+		default) if the command's --stats asks for it
+	"""
+	stats = stats or Stats()
+	ret = 1
+	try:
+		ret = func(args, stats)
+	finally:
+		if args.stats:
+			stats.write_report(args.stats, ok=ret == 0)
+	return ret
+
 def _do_sync(args):
+	return _with_stats(args, _do_sync_with_stats, Stats(args.progress))
+
+def _do_sync_with_stats(args, stats):
 	print("Loading state file ...")
 	try:
-		with open(args.statefile, 'r') as f:
-			sw = json.load(f)
-	except FileNotFoundError:
-		print("State file not found. Generate using the 'genstate' command.",
+		with stats.timer('load_state'):
+			sw, oldstate = _load_state(args.statefile)
+	except (FileNotFoundError, ValueError) as ex:
+		print(f"{_state_error(ex)} Generate using the 'genstate' command.",
 			file=sys.stderr)
 		return 1
 
-	if not args.dryrun:
-		if not sw['command']:
-			print("Please specify command to start the remote server.",
-				file=sys.stderr)
-			print(f"Put the command argv as an array in the 'command' entry in "\
-					f"'{args.statefile}'.", file=sys.stderr)
+	try:
+		return _do_sync_with_state(args, sw, oldstate, stats)
+	finally:
+		if isinstance(oldstate, statefile.StateData):
+			oldstate.close()
+
+def _check_remote_config(args, sw):
+	if (sw.get('transport') or 'stdio') == 'stdio' and not sw['command']:
+		print("Please specify command to start the remote server.",
+			file=sys.stderr)
+		print(f"Put the command argv as an array in the 'command' entry in "\
+				f"'{args.statefile}'.", file=sys.stderr)
+		return False
+	if not sw['remotecwd']:
+		print("Please specify target remote folder.",
+			file=sys.stderr)
+		print(f"Put the target remote folder in the 'remotecwd' entry in "\
+				f"'{args.statefile}'.", file=sys.stderr)
+		return False
+	return True
+
+def _do_sync_with_state(args, sw, oldstate, stats):
+	if not args.dryrun and not _check_remote_config(args, sw):
+		return 1
+
+	print("Scanning ...")
+	filt = filters.Filter.from_state(sw)
+	cache = scanner.DirCache(oldstate.dirs()
+		if isinstance(oldstate, statefile.StateData) else None)
+	if not args.dryrun and args.streams <= 1:
+		newstate = _stream_sync(args, sw, oldstate, stats, cache, filt)
+		if newstate is None:
+			print("Sync failed.")
 			return 1
-		if not sw['remotecwd']:
-			print("Please specify target remote folder.",
-				file=sys.stderr)
-			print(f"Put the target remote folder in the 'remotecwd' entry in "\
-					f"'{args.statefile}'.", file=sys.stderr)
+	else:
+		with stats.timer('scan'):
+			newstate = recursive_scan(args.statefile, sw['resolve_symlink'],
+				args.scan_workers, cache, filt)
+		stats.add('scanned_entries', len(newstate))
+
+		with stats.timer('diff'):
+			to_delete, to_update, remote_files, renames, copies, mkdirs = \
+				_compute_changes(oldstate, newstate, stats, not args.no_renames,
+				args.dedup != 'off', filters.ExcludedPaths(filt))
+
+		if args.dryrun:
+			_print_dryrun(to_delete, to_update, renames, copies)
+			return 0
+
+		# do the real thing
+		print("Syncing ...")
+		digests = {}
+		with stats.timer('sync'):
+			ok = run_sync(sw, newstate, to_delete, to_update, remote_files,
+				compress=args.compress, streams=args.streams, stats=stats,
+				verbose=not args.quiet, renames=renames, copies=copies,
+				hardlink=args.dedup == 'hardlink', mkdirs=mkdirs, digests=digests)
+		if not ok:
+			print("Sync failed.")
 			return 1
+		_record_digests(newstate, digests)
 
-	oldstate = sw['data']
-	print("Scanning ...")
-	newstate = recursive_scan(args.statefile, sw['resolve_symlink'])
+	# OK! don't forget update state file
+	with stats.timer('save_state'):
+		_save_state(args.statefile, sw, newstate, cache.new)
+	print("Sync successful.")
+	return 0
+
+def _stream_sync(args, sw, oldstate, stats, cache, filt):
+	"""
+	Scan, diff and push the changes in one go: the session is started first,
+	and directories are diffed and pushed as soon as they are scanned (see
+	_Diff). The changes that depend on the whole scan, such as the deletes, are
+	pushed once it is complete.
+	returns:
+		the new state (tree.Tree), or None if the sync failed
+	"""
+	session = clientcomm.Session(sw, args.compress, stats, not args.quiet)
+	newstate = None
+	try:
+		newstate = _stream_push(args, sw, oldstate, stats, cache, filt, session)
+	finally:
+		stats.end_progress()
+		session.end(newstate is not None)
+	return newstate
+
+def _stream_push(args, sw, oldstate, stats, cache, filt, session):
+	"""
+	The scanning and pushing of _stream_sync, with the session started.
+	returns:
+		the new state (tree.Tree), or None if the sync failed
+	"""
+	stats.set_total(0)
+	newstate = tree.Tree()
+	diff = _Diff(oldstate, newstate, stats, not args.no_renames,
+		args.dedup != 'off', filters.ExcludedPaths(filt), session)
+	scanstats = scanner.ScanStats()
+	dirs = _scan_dirs(args.statefile, sw['resolve_symlink'], args.scan_workers,
+		cache, filt, scanstats)
+	print("Syncing ...")
+	with stats.timer('sync'):
+		with stats.timer('scan'):
+			for k, oldv, v in _merge_walk(oldstate, newstate,
+					newstate.add_dirs(dirs)):
+				if not diff.add(k, oldv, v):
+					return None
+		print(f"Scanned {scanstats}")
+		stats.add('scanned_entries', len(newstate))
+
+		with stats.timer('diff'):
+			changes = diff.finish()
+		if changes is None:
+			return None
+		to_delete, to_update, remote_files, renames, copies, mkdirs = changes
+		if not diff.pushed and not to_delete and not to_update and \
+				not renames and not copies:
+			print("Nothing to be done!")
+		stats.add_total(sum(newstate[k][2] or 0 for k, v in to_update.items()
+			if v is True))
+		if not session.push(newstate, to_delete, to_update, remote_files,
+				renames, copies, args.dedup == 'hardlink', mkdirs):
+			return None
+	_record_digests(newstate, session.digests)
+	return newstate
+
+def _scan_dirs(stfile, resolve_symlink, workers, cache, filt, stats):
+	"""scanner.iter_scan of the current directory, leaving out the state files"""
+	skip = {} # {relative dir path: names of state files}
+	for fn in _state_file_names(stfile):
+		d, _, name = fn.rpartition('/')
+		skip.setdefault(d, set()).add(name)
+	for d, entries in scanner.iter_scan(resolve_symlink, workers, cache=cache,
+			filt=filt, stats=stats):
+		names = skip.get(d)
+		if names:
+			entries = [e for e in entries if e[0] not in names]
+		yield d, entries
+
+def _do_reconcile(args, stats):
+	print("Loading state file ...")
+	try:
+		with stats.timer('load_state'):
+			sw, oldstate = _load_state(args.statefile)
+	except (FileNotFoundError, ValueError) as ex:
+		try:
+			with open(args.statefile, 'r') as f:
+				sw = json.load(f)
+		except (FileNotFoundError, ValueError):
+			print(f"{_state_error(ex)} Generate using the 'genemptystate' "\
+				"command.", file=sys.stderr)
+			return 1
+		# the data file is lost or corrupt: everything is compared with the remote
+		oldstate = {}
+	try:
+		if not _check_remote_config(args, sw):
+			return 1
+		print("Scanning ...")
+		filt = filters.Filter.from_state(sw)
+		cache = scanner.DirCache()
+		with stats.timer('scan'):
+			newstate = recursive_scan(args.statefile, sw['resolve_symlink'],
+				args.scan_workers, cache, filt)
+			_carry_digests(oldstate, newstate)
+		stats.add('scanned_entries', len(newstate))
+	finally:
+		if isinstance(oldstate, statefile.StateData):
+			oldstate.close()
+
+	print("Listing remote files ...")
+	session = clientcomm.Session(sw, stats=stats, verbose=False)
+	ok = False
+	try:
+		with stats.timer('manifest'):
+			remote = session.manifest(not args.size_only)
+		ok = True
+	finally:
+		session.end(ok)
+	if remote is None:
+		return 1
+	print(f"Remote has {len(remote)} files and symlinks.")
+	with stats.timer('diff'):
+		extra, to_update, remote_files, remote_dirs = _compare_manifest(remote,
+			newstate, filters.ExcludedPaths(filt), _state_file_names(args.statefile),
+			args.dedup != 'off')
+		copies = _find_copies(newstate, to_update, remote_files) \
+			if args.dedup != 'off' else {}
+		mkdirs = _new_dirs(remote_dirs, itertools.chain(to_update, copies))
+	to_delete = extra if args.delete_extra else []
+
+	if args.dryrun:
+		_print_dryrun(to_delete, to_update, [], copies)
+	if extra and not args.delete_extra:
+		print(f"{len(extra)} files only exist on the remote. Use --delete-extra "\
+			"to delete them.")
+		if args.dryrun:
+			for k in extra:
+				print(f"  {k}")
+	if args.dryrun:
+		return 0
+
+	print("Syncing ...")
+	digests = {}
+	with stats.timer('sync'):
+		ok = run_sync(sw, newstate, to_delete, to_update, remote_files,
+			compress=args.compress, streams=args.streams, stats=stats,
+			verbose=not args.quiet, copies=copies,
+			hardlink=args.dedup == 'hardlink', mkdirs=mkdirs, digests=digests)
+	if not ok:
+		print("Sync failed.")
+		return 1
+	_record_digests(newstate, digests)
+	with stats.timer('save_state'):
+		_save_state(args.statefile, sw, newstate, cache.new)
+	print("Sync successful.")
+	return 0
+
+def _carry_digests(oldstate, newstate):
+	"""Copy digests of 'oldstate' to the entries of 'newstate' that have not changed"""
+	for k, oldv, v in _merge_walk(oldstate, newstate):
+		if oldv is None or v is None or not isinstance(v[0], bool) or \
+				not isinstance(oldv[0], bool):
+			continue
+		if v[1] <= oldv[1] and not _size_changed(v, oldv):
+			newstate[k] = v[:3] + (_entry_digest(oldv),) + v[4:]
 
-	to_delete = [k for k in oldstate if k not in newstate]
-	# dict of: {filename: data}
-	# if data is string, then it is a symlink
-	# if data is a bool, if True, then initiate upload. If False, open only
-	# (to update file attributes).
+def _compare_manifest(remote, newstate, excluded, ignored=(), copies=True):
+	"""
+	Compare the local state with the remote's files (see Session.manifest).
+	Files with the same size are compared by digest if the remote gave one,
+	hashing the local files as needed. Digests in 'newstate' are updated.
+	Remote files for which the callable 'excluded' returns True, and the ones
+	in 'ignored', are left out. If 'copies' is True, the files to be uploaded
+	that might have the contents of another file are hashed too.
+	returns:
+		(list of files only on the remote, dict of files to update and set of
+		files in the latter that exist on the remote as regular files, as in
+		_compute_changes, set of the remote directories)
+	"""
+	extra = []
 	to_update = {}
+	remote_files = set()
+	remote_dirs = set()
+	# same size on both sides: to be compared by digest
+	to_compare = []
+	for k, rv, v in _merge_walk(remote, newstate):
+		if rv is not None:
+			_add_parent_dirs(remote_dirs, k)
+		if v is None:
+			if k not in ignored and not excluded(k):
+				extra.append(k)
+			continue
+		if isinstance(v[0], str):
+			if rv is None or rv[0] != v[0]:
+				to_update[k] = v[0]
+		elif rv is None or isinstance(rv[0], str):
+			# new, or do not write through the remote symlink
+			to_update[k] = True
+		elif rv[2] != v[2]:
+			to_update[k] = True
+			remote_files.add(k)
+		elif rv[3] is not None:
+			to_compare.append(k)
+		elif rv[0] != v[0]:
+			to_update[k] = False
 
-	# additional criteria for update/delete
-	for k, v in newstate.items():
-		if k not in oldstate:
-			info, _ = v
-			if isinstance(info, bool):
-				# new file, always upload
-				to_update[k] = True
-			elif isinstance(info, str):
-				# symlink
-				to_update[k] = info
+	# files to be uploaded are only hashed if they might be copies of others,
+	# or to resume their upload
+	uploads = [k for k, u in to_update.items() if u is True and
+		newstate[k][3] is None]
+	kept_sizes = {v[2] for k, v in newstate.items()
+		if isinstance(v[0], bool) and to_update.get(k) is not True}
+	upload_sizes = Counter(newstate[k][2] for k in uploads)
+	to_hash = [k for k in to_compare if newstate[k][3] is None] + \
+		[k for k in uploads if newstate[k][2] >= clientcomm.RESUME_MIN_SZ or
+		(copies and newstate[k][2] >= COPY_MIN_SZ and
+		(newstate[k][2] in kept_sizes or upload_sizes[newstate[k][2]] > 1))]
+	if to_hash:
+		print(f"Hashing {len(to_hash)} files ...")
+		for k, digest in zip(to_hash, _hash_files(to_hash)):
+			v = newstate[k]
+			newstate[k] = v[:3] + (digest,) + v[4:]
+	for k in to_compare:
+		v = newstate[k]
+		if v[3] != remote[k][3]:
+			to_update[k] = True
+			remote_files.add(k)
+		elif v[0] != remote[k][0]:
+			to_update[k] = False
+	return extra, to_update, remote_files, remote_dirs
+
+def _do_watch(args, stats):
+	print("Loading state file ...")
+	try:
+		with stats.timer('load_state'):
+			sw, oldstate = _load_state(args.statefile)
+	except (FileNotFoundError, ValueError) as ex:
+		print(f"{_state_error(ex)} Generate using the 'genstate' command.",
+			file=sys.stderr)
+		return 1
+	try:
+		if not _check_remote_config(args, sw):
+			return 1
+		filt = filters.Filter.from_state(sw)
+		excluded = filters.ExcludedPaths(filt)
+		# start watching before scanning so that no changes are missed
+		try:
+			watcher = watch.TreeWatcher(sw['resolve_symlink'], excluded.dir_excluded)
+		except OSError as ex:
+			print(f"Unable to watch for changes: {ex}", file=sys.stderr)
+			return 1
+		print("Scanning ...")
+		cache = scanner.DirCache(oldstate.dirs()
+			if isinstance(oldstate, statefile.StateData) else None)
+		with stats.timer('scan'):
+			state = recursive_scan(args.statefile, sw['resolve_symlink'],
+				args.scan_workers, cache, filt)
+		with stats.timer('diff'):
+			changes = _compute_changes(oldstate, state, stats,
+				not args.no_renames, args.dedup != 'off', excluded)
+	finally:
+		if isinstance(oldstate, statefile.StateData):
+			oldstate.close()
+
+	# stop (and save the state file) on SIGTERM too
+	signal.signal(signal.SIGTERM, signal.default_int_handler)
+	with watcher:
+		return _watch_loop(args, sw, watcher, state, cache.new, changes, filt,
+			excluded, stats)
+
+def _watch_loop(args, sw, watcher, state, dirs, changes, filt, excluded, stats):
+	"""
+	Push 'changes' (see _compute_changes) of 'state' followed by any further
+	changes reported by 'watcher', using a single session. 'dirs' are the
+	directory listings of the scan of 'state' (see scanner.DirCache), saved
+	along with it: they are only used for directories that have not changed
+	since. 'filt' is the filters.Filter of the state and 'excluded' its
+	filters.ExcludedPaths. Pushes are accounted to 'stats'.
+	"""
+	session = clientcomm.Session(sw, args.compress, stats, not args.quiet)
+	# state of the remote. Only updated after a successful push.
+	synced = None
+	# whether 'state' covers the whole tree, or only the rescanned paths of
+	# 'oldsub'
+	full = True
+	oldsub = None
+	saved = True
+	last_save = time.monotonic()
+	pushing = False
+	try:
+		while True:
+			to_delete, to_update, remote_files, renames, copies, mkdirs = changes
+			changed = to_delete or to_update or renames or copies
+			if changed:
+				pushing = True
+				with stats.timer('sync'):
+					ok = session.push(state, to_delete, to_update, remote_files,
+						renames, copies, args.dedup == 'hardlink', mkdirs)
+				if not ok:
+					print("Sync failed.")
+					return 1
+				pushing = False
+				_record_digests(state, session.digests)
+				session.digests.clear()
+			if full:
+				synced = state
+			else:
+				for k in oldsub.keys() - state.keys():
+					del synced[k]
+				synced.update(state)
+			if full or changed:
+				saved = False
+				print("Watching for changes ...")
+
+			if not saved and time.monotonic() - last_save >= CHECKPOINT_INTERVAL:
+				_save_state(args.statefile, sw, synced, dirs)
+				saved = True
+				last_save = time.monotonic()
+
+			paths, overflowed = watcher.wait_changes(CHECKPOINT_INTERVAL)
+			if filt.ignore_file and any(os.path.basename(p) == filt.ignore_file
+					for p in paths):
+				# rules changed: directories might have become included
+				print("Ignore file changed. Scanning ...")
+				overflowed = True
+				excluded = filters.ExcludedPaths(filt)
+				watcher.excluded_dir = excluded.dir_excluded
+				watcher.add_tree(".")
+			elif overflowed:
+				print("Too many changes. Scanning ...")
+			full = overflowed
+			if overflowed:
+				cache = scanner.DirCache(dirs)
+				state = recursive_scan(args.statefile, sw['resolve_symlink'],
+					args.scan_workers, cache, filt)
+				dirs = cache.new
+				changes = _compute_changes(synced, state,
+					renames=not args.no_renames, copies=args.dedup != 'off',
+					excluded=excluded)
 			else:
-				raise TypeError("Unknown stat item")
+				oldsub, state = _rescan_paths(args, sw, synced, paths, excluded)
+				changes = _compute_changes(oldsub, state,
+					renames=not args.no_renames, copies=args.dedup != 'off',
+					excluded=excluded)
+	except KeyboardInterrupt:
+		print()
+		return 0
+	finally:
+		if pushing:
+			# interrupted in the middle of a message
+			session.terminate()
+		else:
+			session.close()
+		if not saved:
+			_save_state(args.statefile, sw, synced, dirs)
+
+def _rescan_paths(args, sw, state, paths, excluded):
+	"""
+	Rescan files and directories in 'paths' (relative path names), leaving out
+	the ones excluded according to 'excluded' (filters.ExcludedPaths).
+	returns:
+		(dict of old entries of 'state' at or under 'paths', dict of new entries)
+	"""
+	resolve_symlink = sw['resolve_symlink']
+	statefiles = _state_file_names(args.statefile)
+	oldsub = {}
+	newsub = {}
+	# paths that were, or might have been, directories
+	dirs = []
+	for pth in paths:
+		if pth in statefiles:
 			continue
+		# None if the parent directory is excluded
+		filt = excluded.dir_filter(pth.rpartition('/')[0])
+		entry = scanner.scan_entry(pth, resolve_symlink) if filt is not None else None
+		if entry is not None:
+			if not filt.excluded(pth, False):
+				newsub[pth] = entry
+		elif filt is not None and os.path.isdir(pth) and \
+				(resolve_symlink or not os.path.islink(pth)) and \
+				not filt.excluded(pth, True):
+			newsub.update(scanner.scan(resolve_symlink, args.scan_workers, pth,
+				filt=filt)[0])
+		if pth in state:
+			oldsub[pth] = state[pth]
+		elif entry is None:
+			dirs.append(pth + '/')
+	if dirs:
+		dirs = tuple(dirs)
+		oldsub.update((k, v) for k, v in state.items() if k.startswith(dirs))
+	for fn in statefiles:
+		newsub.pop(fn, None)
+	return oldsub, newsub
+
+def _compute_changes(oldstate, newstate, stats=None, renames=True, copies=True,
+		excluded=None):
+	"""
+	Compare states, and hash files that might have changed. Digests in
+	'newstate' are updated. Hashing is timed in 'stats', if given.
+	If 'renames' is True, moved files and directories are detected. If 'copies'
+	is True, files with the same contents are only uploaded once.
+	Entries of 'oldstate' that are missing from 'newstate' because the callable
+	'excluded' returns True for them are left alone on the remote, and carried
+	over to 'newstate'.
+	returns:
+		(list of files to delete, dict of files to update, set of files in the
+		latter that exist on the remote as regular files, list of (source,
+		destination) to be renamed on the remote before the rest, dict of
+		{destination: source} to be copied on the remote after the rest, list of
+		directories to be created on the remote, parents first)
+	"""
+	diff = _Diff(oldstate, newstate, stats, renames, copies, excluded)
+	for k, oldv, v in _merge_walk(oldstate, newstate):
+		diff.add(k, oldv, v)
+	return diff.finish()
+
+class _Diff:
+	"""
+	Changes between two states (see _compute_changes), given entry by entry in
+	sort order. Files that might have changed are hashed in the background
+	meanwhile.
+	If 'session' (clientcomm.Session) is given, changes are pushed to it as they
+	come, unless they might depend on the entries still to come: deletes, and
+	uploads of files that might be moved or copied from files on the remote.
+	These are left to finish().
+	"""
+	def __init__(self, oldstate, newstate, stats=None, renames=True, copies=True,
+			excluded=None, session=None):
+		self._oldstate = oldstate
+		self._newstate = newstate
+		self._stats = stats
+		self._renames = renames
+		self._copies = copies
+		self._excluded = excluded
+		self._session = session
+		self._to_delete = []
+		# dict of: {filename: data}
+		# if data is string, then it is a symlink
+		# if data is a bool, if True, then initiate upload. If False, open only
+		# (to update file attributes).
+		self._to_update = {}
+		# files to be uploaded that exist on the remote as regular files
+		self._remote_files = set()
+		# for detecting renames: {filename: old state entry} and set of filenames
+		# that have not been pushed
+		self._deleted = {}
+		self._added = set()
+		# directories that exist on the remote, or are created before the rest
+		self._remote_dirs = set()
+		# excluded entries, added to 'newstate' after walking it
+		self._kept = []
+		self._pool = ThreadPoolExecutor()
+		# files being hashed: (filename, old state entry or None, future of digest,
+		# whether to upload the file if changed or only to record the digest)
+		self._hashing = deque()
+		self._hashed = 0
+		self._hash_wait = 0.0
+		# number of changes pushed
+		self.pushed = 0
+		# the rest is for pushing only
+		# old paths that are not in 'newstate'
+		self._gone = set()
+		# {directory: whether files can be pushed in it}
+		self._pushable_dirs = {}
+		# {size: first new file of the size that has not been hashed, or None if
+		# it has}
+		self._new_sizes = {}
+		# see statefile.StateData.file_ids, and directories of a dict 'oldstate'
+		self._old_ids = None
+		self._old_dirs = None
+		# (size, digest) of the uploads pushed
+		self._uploaded = set()
+
+	def add(self, k, oldv, v):
+		"""
+		Compare old entry 'oldv' of 'k' with its new entry 'v', either of which
+		can be None.
+		returns:
+			False if pushing has failed
+		"""
+		if oldv is not None:
+			_add_parent_dirs(self._remote_dirs, k)
+		if v is None:
+			if self._excluded is not None and self._excluded(k):
+				self._kept.append((k, oldv))
+				return True
+			self._to_delete.append(k)
+			if self._renames:
+				self._deleted[k] = oldv
+			if self._session is not None:
+				self._gone.add(k)
+			return True
+
+		if oldv is None:
+			if self._renames:
+				self._added.add(k)
+			info = v[0]
+			if isinstance(info, bool):
+				# new file, always upload. It is read for the upload anyway, so it is
+				# only hashed if the digest is needed.
+				if self._wants_digest(k, v):
+					return self._hash(k, None)
+				return self._update(k, True, None)
+			if isinstance(info, str):
+				# symlink
+				return self._update(k, info, None)
+			raise TypeError("Unknown stat item")
 
-		oldv = oldstate[k]
 		if isinstance(v[0], bool) and isinstance(oldv[0], bool):
 			# both are files
-			if v[1] > oldv[1]:
-				# ctime/mtime is newer: upload
-				to_update[k] = True
-			elif v[0] != oldv[0]:
+			if v[1] > oldv[1] or _size_changed(v, oldv):
+				# ctime/mtime is newer or size changed: upload
+				return self._hash(k, oldv)
+			# unchanged: carry over the last known digest
+			self._newstate[k] = v[:3] + (_entry_digest(oldv),) + v[4:]
+			if v[0] != oldv[0]:
 				# executable state changed: just open and chmod
-				to_update[k] = False
+				return self._update(k, False, oldv)
+		elif v[0] != oldv[0]:
+			# either or both of them are symlinks. If we're here, either symlink
+			# contents changed, file becomes symlink (or vice versa),
+			# nonexecutable becomes executable (or vice versa).
+			return self._update(k, v[0] if isinstance(v[0], str) else True, oldv)
+		return True
+
+	def finish(self):
+		"""
+		Wait for the files being hashed, and compute the changes that have not
+		been pushed.
+		returns:
+			as _compute_changes, or None if pushing has failed
+		"""
+		ok = self._drain(0)
+		self._pool.shutdown()
+		if not ok:
+			return None
+		self._newstate.update(self._kept)
+		if self._hashed:
+			print(f"Hashed {self._hashed} files.")
+			if self._stats is not None:
+				self._stats.add_time('hash', self._hash_wait)
+				self._stats.add('hashed_files', self._hashed)
+
+		newstate = self._newstate
+		to_delete = self._to_delete
+		to_update = self._to_update
+		remote_files = self._remote_files
+		renamed = []
+		if self._deleted and self._added:
+			renamed = find_renames(self._deleted, self._added, newstate, to_delete,
+				to_update, remote_files, clientcomm.DELTA_MIN_SZ)
+		copied = _find_copies(newstate, to_update, remote_files) \
+			if self._copies else {}
+		mkdirs = _new_dirs(self._remote_dirs, itertools.chain(to_update, copied))
+		return to_delete, to_update, remote_files, renamed, copied, mkdirs
+
+	def _hash(self, k, oldv):
+		"""Upload file 'k' if hashing tells that its contents have changed"""
+		self._hashing.append((k, oldv, self._pool.submit(_hash_one, k), True))
+		return self._drain(HASH_AHEAD)
+
+	def _wants_digest(self, k, v):
+		"""
+		Whether new file 'k' (entry 'v') has to be hashed: to resume its upload,
+		or because it might be a moved file or a copy of another file
+		"""
+		size = v[2]
+		if size >= clientcomm.RESUME_MIN_SZ:
+			return True
+		old_size = size in self._file_ids()[1]
+		if self._renames and old_size:
+			return True
+		if not self._copies or size < COPY_MIN_SZ:
+			return False
+		if old_size:
+			return True
+		first = self._new_sizes.setdefault(size, k)
+		if first == k:
+			return False
+		if first is not None:
+			# the first one of the size has been handled already: only its digest
+			# is recorded
+			self._new_sizes[size] = None
+			self._hashing.append((first, None, self._pool.submit(_hash_one, first),
+				False))
+		return True
+
+	def _drain(self, ahead):
+		"""
+		Take the results of the files hashed so far, in order, waiting until at
+		most 'ahead' are left.
+		returns:
+			False if pushing has failed
+		"""
+		hashing = self._hashing
+		while hashing and (len(hashing) > ahead or hashing[0][2].done()):
+			k, oldv, fut, upload = hashing.popleft()
+			start = time.monotonic()
+			digest = fut.result()
+			self._hash_wait += time.monotonic() - start
+			self._hashed += 1
+			v = self._newstate[k]
+			v = self._newstate[k] = v[:3] + (digest,) + v[4:]
+			if not upload:
+				if digest is not None and k not in self._to_update:
+					# pushed already: later files with the contents wait for it
+					self._uploaded.add((v[2], digest))
+				continue
+			if digest is not None and oldv is not None and \
+					digest == _entry_digest(oldv) and v[2] == _entry_size(oldv):
+				# only the timestamp changed: no need to upload
+				if v[0] != oldv[0] and not self._update(k, False, oldv):
+					return False
+				continue
+			if not self._update(k, True, oldv):
+				return False
+		return True
+
+	def _update(self, k, update, oldv):
+		"""
+		Push update 'update' (see run_sync's 'to_update') of 'k', or leave it to
+		finish()
+		"""
+		# can be delta transferred
+		remote = update is True and oldv is not None and isinstance(oldv[0], bool)
+		v = self._newstate[k]
+		if self._session is None or not self._can_push(k, v, update, oldv):
+			self._to_update[k] = update
+			if remote:
+				self._remote_files.add(k)
+			return True
+
+		if not self._make_dirs(k.rpartition('/')[0]):
+			return False
+		if update is True:
+			if self._copies and v[2] >= COPY_MIN_SZ and v[3] is not None:
+				self._uploaded.add((v[2], v[3]))
+			if self._stats is not None:
+				self._stats.add_total(v[2] or 0)
+		self._added.discard(k)
+		self.pushed += 1
+		return self._session.put(k, update, v, remote)
+
+	def _can_push(self, k, v, update, oldv):
+		"""Whether the update of 'k' does not depend on the entries to come"""
+		if not self._dir_pushable(k.rpartition('/')[0]):
+			return False
+		if oldv is None and self._renames:
+			if not isinstance(v[0], bool):
+				# the whole directory might have been moved
+				return not len(self._oldstate)
+			if self._might_be_old(v):
+				return False
+		if update is True and self._copies and v[2] >= COPY_MIN_SZ and \
+				v[3] is not None:
+			if (v[2], v[3]) in self._uploaded:
+				# to be copied from the file that is being uploaded
+				return False
+			if bytes.fromhex(v[3]) in self._file_ids()[2]:
+				# might be copied from an existing remote file
+				return False
+		return True
+
+	def _dir_pushable(self, d):
+		"""
+		Whether files can be pushed in directory 'd': not if it, or any of its
+		parents, replaces a file that is still to be deleted
+		"""
+		ret = self._pushable_dirs.get(d)
+		if ret is None:
+			ret = not d or (d not in self._gone and
+				self._dir_pushable(d.rpartition('/')[0]))
+			self._pushable_dirs[d] = ret
+		return ret
+
+	def _might_be_old(self, v):
+		"""Whether new file entry 'v' might be a file of the old state moved here"""
+		inodes, _, digests = self._file_ids()
+		return v[4] in inodes or (v[3] is not None and bytes.fromhex(v[3]) in digests)
+
+	def _file_ids(self):
+		"""returns: statefile.StateData.file_ids of the old state"""
+		if self._old_ids is None:
+			old = self._oldstate
+			if isinstance(old, statefile.StateData):
+				self._old_ids = old.file_ids()
+			else:
+				self._old_ids = ({v[4] for v in old.values()
+					if isinstance(v[0], bool) and _entry_inode(v)},
+					{_entry_size(v) for v in old.values() if isinstance(v[0], bool)},
+					{bytes.fromhex(v[3]) for v in old.values()
+					if isinstance(v[0], bool) and _entry_digest(v)})
+		return self._old_ids
+
+	def _make_dirs(self, d):
+		"""
+		Push the creation of directory 'd' and of its parents, unless they are
+		known to exist on the remote
+		returns:
+			False if pushing has failed
+		"""
+		missing = []
+		while d and d not in self._remote_dirs:
+			if self._old_has_dir(d):
+				_add_parent_dirs(self._remote_dirs, d + '/')
+				break
+			missing.append(d)
+			d = d.rpartition('/')[0]
+		for d in reversed(missing):
+			if not self._session.put_mkdir(d):
+				return False
+			self._remote_dirs.add(d)
+		return True
+
+	def _old_has_dir(self, d):
+		"""Whether the old state has entries under directory 'd'"""
+		old = self._oldstate
+		if isinstance(old, statefile.StateData):
+			return old.has_prefix(d + '/')
+		if self._old_dirs is None:
+			self._old_dirs = set()
+			for k in old:
+				_add_parent_dirs(self._old_dirs, k)
+		return d in self._old_dirs
+
+def _add_parent_dirs(dirs, fn):
+	"""Add the parent directories of 'fn' to set 'dirs'"""
+	d = fn.rpartition('/')[0]
+	while d and d not in dirs:
+		dirs.add(d)
+		d = d.rpartition('/')[0]
+
+def _new_dirs(remote_dirs, fns):
+	"""
+	returns:
+		sorted list of the parent directories of 'fns' that are not in
+		'remote_dirs'. Parents sort before their subdirectories.
+	"""
+	new = set()
+	for k in fns:
+		d = k.rpartition('/')[0]
+		while d and d not in remote_dirs and d not in new:
+			new.add(d)
+			d = d.rpartition('/')[0]
+	return sorted(new)
+
+def _find_copies(newstate, to_update, remote_files):
+	"""
+	Find files to be uploaded whose contents are already on the remote, or are
+	the same as of another file to be uploaded. They are removed from
+	'to_update' and 'remote_files'.
+	returns:
+		{destination: source} of remote files to be copied after the uploads
+	"""
+	# {(size, digest): files to be uploaded}
+	groups = {}
+	for k, v in to_update.items():
+		e = newstate[k]
+		if v is True and e[2] >= COPY_MIN_SZ and e[3] is not None:
+			groups.setdefault((e[2], e[3]), []).append(k)
+	if not groups:
+		return {}
+	groups = {key: fns for key, fns in groups.items() if len(fns) > 1}
+	# contents already on the remote: {(size, digest): {executable: file}}
+	existing = {}
+	for k, e in newstate.items():
+		if isinstance(e[0], bool) and e[2] >= COPY_MIN_SZ and e[3] is not None and \
+				to_update.get(k) is not True:
+			existing.setdefault((e[2], e[3]), {}).setdefault(e[0], k)
+	ret = {}
+	for k, v in to_update.items():
+		e = newstate[k]
+		if v is not True or e[2] < COPY_MIN_SZ or e[3] is None:
+			continue
+		key = (e[2], e[3])
+		if key in existing:
+			# same permissions can be hardlinked
+			srcs = existing[key]
+			ret[k] = srcs.get(e[0]) or next(iter(srcs.values()))
+		elif key in groups and groups[key][0] != k:
+			# the first one is uploaded
+			ret[k] = groups[key][0]
+	for k in ret:
+		del to_update[k]
+		remote_files.discard(k)
+	return ret
+
+def _merge_walk(oldstate, newstate, newitems=None):
+	"""
+	Walk both states in sorted order, without looking up one from the other.
+	Entries of 'newstate' can be replaced meanwhile. 'newitems' iterates the
+	items of 'newstate' in sorted order instead, e.g. as it is being scanned.
+	yields:
+		(relative path name, old entry or None, new entry or None)
+	"""
+	olditer = tree.sorted_items(oldstate)
+	newiter = newitems if newitems is not None else tree.sorted_items(newstate)
+	old = next(olditer, None)
+	new = next(newiter, None)
+	while old is not None or new is not None:
+		if new is None or (old is not None and old[0] < new[0]):
+			yield old[0], old[1], None
+			old = next(olditer, None)
+		elif old is None or new[0] < old[0]:
+			yield new[0], None, new[1]
+			new = next(newiter, None)
 		else:
-			# either or both of them are symlinks
-			if v[0] != oldv[0]:
-				# If we're here, either symlink contents changed, file becomes
-				# symlink (or vice versa), nonexecutable becomes executable (or
-				# vice versa).
-				to_update[k] = v[0] if isinstance(v[0], str) else True
+			yield new[0], old[1], new[1]
+			old = next(olditer, None)
+			new = next(newiter, None)
 
-	if args.dryrun:
-		_print_dryrun(to_delete, to_update)
-		return 0
+def _entry_size(v):
+	# state entries written by older versions only have [target, mtime]
+	return v[2] if len(v) > 2 else None
 
-	# do the real thing
-	print("Syncing ...")
-	if not run_sync(sw, newstate, to_delete, to_update):
-		# failed
-		print("Sync failed.")
-		return 1
+def _size_changed(v, oldv):
+	"""Whether file entry 'v' has another size than old file entry 'oldv'"""
+	# unknown for entries of older versions, which are compared by mtime only
+	size = _entry_size(oldv)
+	return size is not None and v[2] != size
 
-	# OK! don't forget update state file
-	sw['data'] = newstate
-	with open(args.statefile, 'w') as f:
-		json.dump(sw, f)
-	print("Sync successful.")
-	return 0
+def _entry_digest(v):
+	return v[3] if len(v) > 3 else None
+
+def _entry_inode(v):
+	return v[4] if len(v) > 4 else None
+
+def _hash_one(fn):
+	try:
+		return shared.file_digest(fn)
+	except OSError:
+		# e.g. file removed after scanning. Let the upload report the error.
+		return None
+
+def _hash_files(fns):
+	"""Returns list of digests of files in 'fns', hashed in parallel"""
+	with ThreadPoolExecutor() as pool:
+		return list(pool.map(_hash_one, fns))
 
-def _print_dryrun(to_delete, to_update):
+def _record_digests(state, digests):
+	"""
+	Store the digests of the files hashed while uploading them (see
+	clientcomm.Session.digests) in 'state', unless their size has changed since
+	scanning
+	"""
+	for k, (length, digest) in digests.items():
+		v = state.get(k)
+		if v is not None and isinstance(v[0], bool) and v[2] == length:
+			state[k] = v[:3] + (digest,) + v[4:]
+
+def _print_dryrun(to_delete, to_update, renames, copies):
 	print()
+	if renames:
+		print("These files and directories will be renamed on the remote server:")
+		for src, dst in renames:
+			print(f"  {src} -> {dst}")
+		print()
 	if not to_delete:
 		print("(No remote files will be deleted)")
 	else:
@@ -184,6 +1073,11 @@ def _print_dryrun(to_delete, to_update):
 		print("These files will be uploaded to the remote server:")
 		for k in to_update:
 			print(f"  {k}")
+	if copies:
+		print()
+		print("These files will be copied from other files on the remote server:")
+		for dst, src in copies.items():
+			print(f"  {src} -> {dst}")
 
 def populate_subparsers(sp):
 	ssp = sp.add_subparsers(title="client commands", dest="clientcmd", required=True)
@@ -195,9 +1089,17 @@ def populate_subparsers(sp):
 		"regarded as new.")
 	parser_sync = ssp.add_parser("sync",
 		help="Perform synchronisation")
+	parser_watch = ssp.add_parser("watch",
+		help="Perform synchronisation, then keep synchronising changes as they "\
+		"happen until interrupted.")
+	parser_reconcile = ssp.add_parser("reconcile",
+		help="Compare the local files with the files on the remote instead of "\
+		"with the state, and upload the ones that differ. Use when the remote "\
+		"was modified or the state was lost.")
 
 	# add common options
-	for csp in [parser_genstate, parser_genemptystate, parser_sync]:
+	for csp in [parser_genstate, parser_genemptystate, parser_sync, parser_watch,
+			parser_reconcile]:
 		csp.add_argument("--cwd",
 			help="Directory to be synced (default: current directory).")
 		csp.add_argument("--statefile",
@@ -210,9 +1112,49 @@ def populate_subparsers(sp):
 			help="Resolve all symlinks and treat all of them as files",
 			action="store_true")
 
+	# options for commands that scan
+	for csp in [parser_genstate, parser_sync, parser_watch, parser_reconcile]:
+		csp.add_argument("--scan-workers", type=int, default=DEFAULT_SCAN_WORKERS,
+			help="Number of threads used to list and stat directories in parallel "\
+			f"(default: {DEFAULT_SCAN_WORKERS}).")
+
 	# sync specific options
-	parser_sync.add_argument("--dryrun", action="store_true",
-		help="List files that will be deleted and updated. No actions will be taken.")
+	for csp in [parser_sync, parser_reconcile]:
+		csp.add_argument("--dryrun", action="store_true",
+			help="List files that will be deleted and updated. No actions will be "\
+			"taken.")
+		csp.add_argument("--streams", type=int, default=DEFAULT_STREAMS,
+			help="Number of server sessions to sync with in parallel, each started "\
+			f"using the state's 'command' (default: {DEFAULT_STREAMS}).")
+	for csp in [parser_sync, parser_watch, parser_reconcile]:
+		csp.add_argument("--compress", default="auto",
+			choices=["auto", "zlib", "lzma", "none"],
+			help="Compression codec for file contents (default: 'auto', which picks "\
+			"the best codec supported by both sides).")
+		csp.add_argument("--quiet", "-q", action="store_true",
+			help="Do not print a message for each file. Errors are still printed.")
+		csp.add_argument("--dedup", default="copy",
+			choices=["copy", "hardlink", "off"],
+			help="Upload files with the same contents only once, and copy them on "\
+			"the remote (default: 'copy'), or hardlink them where their permissions "\
+			"match ('hardlink'). Files already on the remote are copied from too.")
+	for csp in [parser_sync, parser_watch]:
+		csp.add_argument("--no-renames", action="store_true",
+			help="Do not detect moved files and directories: upload them again "\
+			"under their new names instead of renaming them on the remote.")
+	for csp in [parser_sync, parser_watch, parser_reconcile]:
+		csp.add_argument("--stats", nargs="?", const="-", metavar="FILE",
+			help="Write timings and counters of each phase as JSON to FILE, or to "\
+			"stderr if FILE is not given (stdout carries the messages).")
+	parser_sync.add_argument("--progress", action="store_true",
+		help="Show upload progress, rate and ETA on stderr.")
+
+	# reconcile specific options
+	parser_reconcile.add_argument("--delete-extra", action="store_true",
+		help="Delete remote files that do not exist locally.")
+	parser_reconcile.add_argument("--size-only", action="store_true",
+		help="Regard files of the same size as equal, instead of having the "\
+		"server hash its files.")
 
 def main(args):
 	if args.cwd is not None:
@@ -226,5 +1168,9 @@ def main(args):
 		ret = _gen_state(args, True)
 	elif args.clientcmd == 'sync':
 		ret = _do_sync(args)
+	elif args.clientcmd == 'watch':
+		ret = _with_stats(args, _do_watch)
+	elif args.clientcmd == 'reconcile':
+		ret = _with_stats(args, _do_reconcile)
 
 	sys.exit(ret)
@@ -1,29 +1,128 @@
 from subprocess import Popen, PIPE
 import os
+import io
+import mmap
+import queue
+import socket
 import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from enum import Enum
 import shared
+import delta
+from stats import Stats
 from PythonLib.MyBytesIO import BIO
 
-MAX_BUFF_SZ = 1_048_576
+# message buffers are up to this size, depending on the server's limit and on
+# the available memory
+MAX_BUFF_SZ = 16 * 1_048_576
+# fraction of the available memory the message buffers of a session can take
+BUFF_MEM_FRACTION = 1 / 32
+# maximum number of bulk operation windows in flight
+MAX_WINDOWS = 4
+# files smaller than this are always uploaded whole
+DELTA_MIN_SZ = 1_048_576
+# files up to this size are sent along with the bulk operation
+INLINE_MAX_SZ = 65_536
+# uploads of files of at least this size can be resumed if interrupted
+RESUME_MIN_SZ = 64 * 1_048_576
+# initial size of each CHUNK_STREAM message, until the throughput is known.
+# The server does not buffer them, so they can be larger than the buffer size.
+STREAM_CHUNK_SZ = 8 * 1_048_576
+# chunks are sized to take about this long to send, within these bounds. See
+# _Tuner.
+CHUNK_TARGET_S = 0.05
+MIN_STREAM_CHUNK_SZ = 262_144
+MAX_STREAM_CHUNK_SZ = 64 * 1_048_576
+# writes of at least this size are used to measure the throughput
+THROUGHPUT_SAMPLE_MIN_SZ = 262_144
+# weight of new measurements in the moving average of _Tuner
+TUNE_WEIGHT = 0.25
+# if the first chunk of a file does not compress below this ratio, the rest of
+# the file is sent uncompressed
+COMPRESS_MIN_RATIO = 0.9
+# extension of files that are already compressed
+PRECOMPRESSED_EXTS = {
+	'.gz', '.tgz', '.bz2', '.tbz2', '.xz', '.txz', '.lz', '.lz4', '.lzma', '.zst',
+	'.zip', '.7z', '.rar', '.jar', '.war', '.apk', '.whl', '.deb', '.rpm',
+	'.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+	'.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+	'.mp4', '.m4v', '.mkv', '.mov', '.avi', '.webm',
+}
+# with multiple streams, files of at least this size are spread by size between
+# the streams, instead of by path hash
+SHARD_BIG_FILE_SZ = 8 * 1_048_576
+# cost of an operation in bytes, for balancing the streams
+SHARD_OP_COST = 4096
+# kind, size, mtime of MANIFEST_RESP entries
+_MANIFEST_ENTRY = struct.Struct("=BQq")
+CODEC_FEATURES = {
+	shared.Codec.ZLIB: shared.Feature.ZLIB,
+	shared.Codec.LZMA: shared.Feature.LZMA,
+}
 
 class BulkOpRetType(Enum):
 	GENERIC = 1
 	OPENFD = 2
 
+class UploadMode(Enum):
+	WHOLE = 1 # send all chunks after the file is opened
+	DELTA = 2 # send differences against the existing remote file
+	INLINE = 3 # contents are sent within the bulk operation
+	RENAME = 4 # no contents: an existing remote file or directory is moved here
+	COPY = 5 # no contents: an existing remote file is copied here
+	MKDIR = 6 # a directory is created here
+	RESUME = 7 # same as WHOLE, resuming an earlier interrupted upload if any
+
+class _BulkWindow:
+	"""A batch of bulk operations sent to the server"""
+	def __init__(self, rettypes, writes):
+		self.rettypes = rettypes
+		self.writes = writes
+		self.ticket = None
+		self.close_ticket = None
+		self.ops = None # _OpQueue: list of operations in this window
+		self.open_fds = None # _OpQueue: {remote fd: (relative file name, UploadMode)}
+		self.sent_at = None # time of sending the last request
+
 class _Client:
-	def __init__(self, fout, fin, remotecwd):
+	def __init__(self, fout, fin, remotecwd, compress='auto', stats=None):
 		self._fout = fout
 		self._fin = fin
-		self._buff = BIO(MAX_BUFF_SZ)
+		self.stats = stats or Stats()
+		# until the limits are negotiated
+		self._buff = BIO(shared.MIN_BUFF_SZ)
 		self._buffman = shared.BuffManager(self._buff)
+		self._rbuff = None # content of the last received message
+		self._reply_at = None # arrival time of the last received message
+		self.tuner = None # _Tuner, once the limits are known
 		self._maxofd = None
+		self._maxwindows = 1
 		self._svrmaxbuff = None
+		self._features = shared.Feature(0)
+		self._codec = shared.Codec.NONE
+		self._rawbuff = None # scratch buffer for data to be compressed
+		# send file contents straight from the file to the output (sendfile)
+		self._zerocopy = hasattr(os, 'sendfile')
 		self._hasbulkqueue = False
 		self._enqueued_bulkops_rets = []
 		self._enqueued_writes = 0
 
-		self._negotiate(remotecwd)
+		# Server responses are read by a separate thread so that we can keep
+		# sending requests without waiting for their responses. The server
+		# replies in the same order as the requests, so each request that
+		# expects a reply is given a sequence number (ticket).
+		self._replyq = queue.Queue()
+		self._sent_tickets = 0
+		self._recv_tickets = 0
+		self._stashed_replies = {} # {ticket: (cmd, payload, arrival time)}
+		self._reader = threading.Thread(target=self._reader_main, daemon=True)
+		self._reader.start()
+
+		self._negotiate(remotecwd, compress)
 
 	def _begin_msg(self, msgtype):
 		self._buff.seek(0)
@@ -32,56 +131,143 @@ class _Client:
 
 	def _send_msg(self):
 		self._buffman.end_msg()
-		self._fout.write(self._buffman.getbuffer())
+		buff = self._buffman.getbuffer()
+		start = time.monotonic()
+		self._fout.write(buff)
+		if self.tuner is not None:
+			self.tuner.add_transfer(len(buff), time.monotonic() - start)
+		self.stats.add('sent_bytes', len(buff))
 
-	def _recv_msg(self):
-		cmd = shared.read_all(self._fin, 1)
-		if not cmd:
-			raise RuntimeError("Premature connection end")
-		cmd = shared.MsgType(cmd[0])
-		arglen = struct.unpack("=I", shared.read_all(self._fin, 4))[0]
-		if arglen > len(self._buff):
-			raise RuntimeError("Server response exceeded buffer size")
-		self._buff.set_limit(arglen)
-		self._buff.seek(0)
-		shared.readinto_all(self._fin, self._buff.getbuffer())
-		return cmd
+	def _reader_main(self):
+		"""
+		Reader thread: put (cmd, payload, arrival time) of each server message to
+		the queue
+		"""
+		hdr = bytearray(5)
+		try:
+			while True:
+				if shared.readinto_all(self._fin, memoryview(hdr)) != len(hdr):
+					break
+				cmd = shared.MsgType(hdr[0])
+				payload = bytearray(struct.unpack_from("=I", hdr, 1)[0])
+				if shared.readinto_all(self._fin, memoryview(payload)) != len(payload):
+					break
+				self._replyq.put((cmd, payload, time.monotonic()))
+		finally:
+			# signals end of connection
+			self._replyq.put(None)
 
-	def _send_and_recv_msg(self, expectedcmd=None):
-		"""shortcut for self._send_msg and self._recv_msg"""
+	def _send_request(self):
+		"""Send message that expects a reply. Returns the reply's ticket."""
 		self._send_msg()
-		cmd = self._recv_msg()
+		self.stats.add('requests')
+		ticket = self._sent_tickets
+		self._sent_tickets += 1
+		return ticket
+
+	def _stash_reply(self, block):
+		try:
+			item = self._replyq.get(block)
+		except queue.Empty:
+			return False
+		if item is None:
+			# keep the end marker for subsequent waits
+			self._replyq.put(None)
+			raise RuntimeError("Premature connection end")
+		self._stashed_replies[self._recv_tickets] = item
+		self._recv_tickets += 1
+		return True
+
+	def _has_reply(self, ticket):
+		"""Check whether the reply for 'ticket' has arrived without blocking"""
+		while ticket not in self._stashed_replies:
+			if not self._stash_reply(False):
+				return False
+		return True
+
+	def _recv_msg(self, ticket, expectedcmd=None):
+		"""
+		Wait for the reply of 'ticket'. The reply's content is available from
+		self._rbuff afterwards, and its arrival time from self._reply_at.
+		"""
+		while ticket not in self._stashed_replies:
+			self._stash_reply(True)
+		cmd, payload, self._reply_at = self._stashed_replies.pop(ticket)
 		if expectedcmd is not None:
 			if cmd != expectedcmd:
 				raise RuntimeError(f"Unexpected response {cmd}, expected {expectedcmd}")
+		self._rbuff = io.BytesIO(payload)
 		return cmd
 
-	def _negotiate(self, remotecwd):
+	def _send_and_recv_msg(self, expectedcmd=None):
+		"""shortcut for self._send_request and self._recv_msg"""
+		return self._recv_msg(self._send_request(), expectedcmd)
+
+	def _negotiate(self, remotecwd, compress):
 		# check server version
 		self._begin_msg(shared.MsgType.VERSION)
 		self._send_and_recv_msg(shared.MsgType.VERSION_RESP)
-		server_ver = struct.unpack("=I", self._buff.read(4))[0]
-		if server_ver != 1:
+		server_ver = struct.unpack("=I", self._rbuff.read(4))[0]
+		if server_ver != shared.PROTOCOL_VERSION:
 			raise RuntimeError(f"Unknown server version: {server_ver}")
+		self._features = shared.Feature(struct.unpack("=I", self._rbuff.read(4))[0])
+		self._codec = _choose_codec(compress, self._features)
+		if not self.has_feature(shared.Feature.CHUNK_STREAM):
+			self._zerocopy = False
 
 		# get server limits
 		self._begin_msg(shared.MsgType.REQ_LIMIT)
-		self._send_and_recv_msg(shared.MsgType.LIMIT_RESP)
-		self._maxofd, self._svrmaxbuff = struct.unpack("=II", self._buff.read(8))
-		self._svrmaxbuff = min(self._svrmaxbuff, MAX_BUFF_SZ)
+		ticket = self._send_request()
+		sent_at = time.monotonic()
+		self._recv_msg(ticket, shared.MsgType.LIMIT_RESP)
+		self._maxofd, self._svrmaxbuff, self._maxwindows = \
+			struct.unpack("=III", self._rbuff.read(12))
+		self.stats.set('server_max_ofd', self._maxofd)
+		self.stats.set('server_buff_sz', self._svrmaxbuff)
+		self._svrmaxbuff = min(self._svrmaxbuff,
+			shared.fit_buffer_size(2, MAX_BUFF_SZ, BUFF_MEM_FRACTION))
+		self._maxwindows = max(1, min(self._maxwindows, MAX_WINDOWS))
+		self.stats.set('buff_sz', self._svrmaxbuff)
+		self.stats.set('max_windows', self._maxwindows)
+		self._buff = BIO(self._svrmaxbuff)
+		self._buffman = shared.BuffManager(self._buff)
+		self.tuner = _Tuner(self.stats, self._svrmaxbuff, self._maxwindows)
+		self.tuner.add_rtt(self._reply_at - sent_at)
 
 		# chdir
 		self._begin_msg(shared.MsgType.CHDIR)
 		remotecwd = remotecwd.encode('utf8')
 		self._buffman.append_bytes(remotecwd)
 		self._send_and_recv_msg(shared.MsgType.GEN_RESULT)
-		errnoval = struct.unpack("=H", self._buff.read(2))[0]
+		errnoval = struct.unpack("=H", self._rbuff.read(2))[0]
 		if errnoval != 0:
 			raise _gen_oserror(errnoval)
 
+	def join_reader(self):
+		"""Wait for the reader thread to see the end of connection"""
+		self._reader.join()
+
+	def close(self):
+		"""
+		Tell the server to exit. The peak memory use it reports, if it can, is
+		accounted to self.stats.
+		"""
+		self._begin_msg(shared.MsgType.EXIT)
+		if not self.has_feature(shared.Feature.EXIT_STATS):
+			self._send_msg()
+			return
+		ticket = self._send_request()
+		try:
+			self._recv_msg(ticket, shared.MsgType.EXIT_RESP)
+		except RuntimeError:
+			# the server is gone already
+			return
+		self.stats.add_server_rss(struct.unpack("=Q", self._rbuff.read(8))[0])
+
 	def _init_bulkop_queue(self):
 		if not self._hasbulkqueue:
 			self._begin_msg(shared.MsgType.BULKOP_BEGIN)
+			self._buff.set_limit(self.tuner.window_sz)
 			self._hasbulkqueue = True
 			self._enqueued_writes = 0
 			self._enqueued_bulkops_rets.clear()
@@ -116,7 +302,57 @@ class _Client:
 
 		return self._enqueue_bulk_open(BulkOpRetType.GENERIC, _enqueue)
 
-	def queue_upload(self, fn, target):
+	def queue_mkdir(self, fn):
+		self._init_bulkop_queue()
+
+		def _enqueue():
+			self._buffman.append_byte(shared.OpType.MKDIR.value)
+			fnb = fn.encode('utf8')
+			self._buffman.append_huint(len(fnb))
+			self._buffman.append_bytes(fnb)
+
+		return self._enqueue_bulk_open(BulkOpRetType.GENERIC, _enqueue)
+
+	def queue_rename(self, src, dst):
+		self._init_bulkop_queue()
+
+		def _enqueue():
+			self._buffman.append_byte(shared.OpType.RENAME.value)
+			for fn in (src, dst):
+				fnb = fn.encode('utf8')
+				self._buffman.append_huint(len(fnb))
+				self._buffman.append_bytes(fnb)
+
+		return self._enqueue_bulk_open(BulkOpRetType.GENERIC, _enqueue)
+
+	def queue_copy(self, src, dst, executable, hardlink=False):
+		self._init_bulkop_queue()
+		flags = shared.CopyFlag(0)
+		if executable:
+			flags |= shared.CopyFlag.EXECUTABLE
+		if hardlink:
+			flags |= shared.CopyFlag.HARDLINK
+
+		def _enqueue():
+			self._buffman.append_byte(shared.OpType.COPY.value)
+			self._buffman.append_byte(flags)
+			for fn in (src, dst):
+				fnb = fn.encode('utf8')
+				self._buffman.append_huint(len(fnb))
+				self._buffman.append_bytes(fnb)
+
+		return self._enqueue_bulk_open(BulkOpRetType.GENERIC, _enqueue)
+
+	def queue_upload(self, fn, target, size=None, delta=False, digest=None):
+		"""
+		args:
+			target: symlink target (str), or whether the file is executable (bool)
+			size: only for regular file. Expected file size, or None to only open
+				the file for updating its attributes.
+			delta: only for regular file. Contents will be sent using upload_delta.
+			digest: only for regular file. If given, the upload can be resumed
+				(see request_partial) if it is interrupted.
+		"""
 		self._init_bulkop_queue()
 		fn = fn.encode('utf8')
 
@@ -131,74 +367,522 @@ class _Client:
 				self._buffman.append_bytes(symlink_target)
 			rettype = BulkOpRetType.GENERIC
 		else:
-			# regular file, subject to OFD limitations
-			if self._enqueued_writes >= self._maxofd:
+			# regular file, subject to OFD limitations, which is shared between all
+			# bulk windows that can be in flight
+			if self._enqueued_writes >= max(1, self._maxofd // self._maxwindows):
 				return False
+			flags = shared.WriteFlag(0)
+			if target:
+				flags |= shared.WriteFlag.EXECUTABLE
+			if size is None:
+				flags |= shared.WriteFlag.NO_CONTENT
+			if delta:
+				flags |= shared.WriteFlag.DELTA
+			if digest is not None:
+				flags |= shared.WriteFlag.RESUME
 			def _enqueue():
-				# target is a bool: True to make it executable
 				self._buffman.append_byte(shared.OpType.WRITE.value)
-				self._buffman.append_byte(1 if target else 0)
+				self._buffman.append_byte(flags)
+				self._buffman.append_ulonglong(size or 0)
 				self._buffman.append_huint(len(fn))
 				self._buffman.append_bytes(fn)
+				if digest is not None:
+					self._buffman.append_bytes(bytes.fromhex(digest))
 				self._enqueued_writes += 1
 			rettype = BulkOpRetType.OPENFD
 
 		return self._enqueue_bulk_open(rettype, _enqueue)
 
+	@property
+	def max_windows(self):
+		"""Number of bulk operation windows that can be open at the same time"""
+		return self._maxwindows
+
+	def has_bulk_queue(self):
+		return self._hasbulkqueue
+
+	def queue_write_inline(self, fn, executable, data):
+		self._init_bulkop_queue()
+		fn = fn.encode('utf8')
+
+		def _enqueue():
+			self._buffman.append_byte(shared.OpType.WRITE_INLINE.value)
+			self._buffman.append_byte(1 if executable else 0)
+			self._buffman.append_huint(len(fn))
+			self._buffman.append_bytes(fn)
+			self._buffman.append_uint(len(data))
+			self._buffman.append_bytes(data)
+
+		return self._enqueue_bulk_open(BulkOpRetType.GENERIC, _enqueue)
+
 	def run_bulk_queue(self):
+		"""
+		Send the enqueued bulk operations without waiting for the results.
+		returns:
+			_BulkWindow to be passed to self.bulk_results and self.close_bulk_queue
+		"""
 		if not self._hasbulkqueue:
 			raise RuntimeError("Need to enqueue an operation first")
-		self._send_and_recv_msg(shared.MsgType.BULKOP_RESULTS)
+		window = _BulkWindow(self._enqueued_bulkops_rets, self._enqueued_writes)
+		window.ticket = self._send_request()
+		window.sent_at = time.monotonic()
 		self._hasbulkqueue = False
+		self._enqueued_bulkops_rets = []
+		return window
+
+	def bulk_results(self, window):
+		"""Wait for and return the results of the window's bulk operations"""
+		self._recv_msg(window.ticket, shared.MsgType.BULKOP_RESULTS)
+		rtt = self._reply_at - window.sent_at
+		self.stats.add_time('bulk_open_rtt', rtt)
+		self.tuner.add_rtt(rtt)
 		# convert result
-		return [(rettype, _convert_bulkopen_result(rettype, self._buff))
-			for rettype in self._enqueued_bulkops_rets]
+		return [(rettype, _convert_bulkopen_result(rettype, self._rbuff))
+			for rettype in window.rettypes]
 
-	def close_bulk_queue(self):
+	def close_bulk_queue(self, window):
+		"""
+		Close files opened by the oldest open window. Does not wait for the
+		results: use self.bulk_close_results for that.
+		"""
 		self._begin_msg(shared.MsgType.BULKOP_CLOSE)
-		self._send_and_recv_msg(shared.MsgType.BULKOP_CLOSE_RESULTS)
+		window.close_ticket = self._send_request()
+		window.sent_at = time.monotonic()
+
+	def bulk_close_results(self, window, block=True):
+		"""
+		returns:
+			list of (fd, errno) of files closed by self.close_bulk_queue, or None
+			if 'block' is False and the results have not arrived yet.
+		"""
+		if not block and not self._has_reply(window.close_ticket):
+			return None
+		self._recv_msg(window.close_ticket, shared.MsgType.BULKOP_CLOSE_RESULTS)
+		self.stats.add_time('bulk_close_rtt', self._reply_at - window.sent_at)
 		# convert result
-		return [_convert_bulkopen_result(BulkOpRetType.OPENFD, self._buff)
-			for _ in range(self._enqueued_writes)]
+		return [_convert_bulkopen_result(BulkOpRetType.OPENFD, self._rbuff)
+			for _ in range(window.writes)]
+
+	def request_partial(self, rfd):
+		"""
+		Ask how much of a file opened for a resumable upload the server has
+		already received. The server hashes it while other requests are sent.
+		returns:
+			ticket to be passed to self.partial_result
+		"""
+		self._begin_msg(shared.MsgType.PARTIAL_QUERY)
+		self._buffman.append_uint(rfd)
+		return self._send_request()
 
-	def upload_file(self, rfd, fh):
+	def partial_result(self, ticket):
+		"""
+		returns:
+			(length of the contents received, hex digest of them), for the 'ticket'
+			of self.request_partial
+		"""
+		self._recv_msg(ticket, shared.MsgType.PARTIAL_RESP)
+		length, digest = struct.unpack(f"=Q{shared.DIGEST_LEN}s",
+			self._rbuff.read(8 + shared.DIGEST_LEN))
+		return length, digest.hex()
+
+	def upload_file(self, rfd, fh, compress=True, hasher=None):
+		"""
+		Send the contents of 'fh' from its current position. If 'compress' is
+		True, the contents are sent compressed using the negotiated codec as long
+		as they compress well. 'hasher' (_Hasher), if given, is updated with the
+		contents sent.
+		"""
+		codec = self._codec if compress else shared.Codec.NONE
+		sampled = False
+		start = fh.tell()
 		total = 0 # total bytes written
 		while True:
-			self._begin_msg(shared.MsgType.CHUNK)
-			self._buffman.append_uint(rfd)
-			opbuff = self._buff.getbuffer()[self._buff.tell():]
+			if codec == shared.Codec.NONE and self._zerocopy:
+				return total + self._upload_zerocopy(rfd, fh, hasher)
+			if codec != shared.Codec.NONE:
+				rd, comp = self._read_compressed(fh, codec)
+				if not rd: # EOF
+					break
+				if hasher is not None:
+					hasher.update(memoryview(self._rawbuff)[:rd])
+				if not sampled:
+					sampled = True
+					if len(comp) > rd * COMPRESS_MIN_RATIO:
+						# not worth it: send the rest of the file as is
+						codec = shared.Codec.NONE
+				if codec != shared.Codec.NONE and len(comp) < rd:
+					self._begin_chunk_msg(shared.MsgType.CHUNK_COMPRESSED, rfd,
+						start + total)
+					self._buffman.append_byte(codec.value)
+					self._buffman.append_bytes(comp)
+				else:
+					self._begin_chunk_msg(shared.MsgType.CHUNK, rfd, start + total)
+					self._buffman.append_bytes(memoryview(self._rawbuff)[:rd])
+				self._send_msg()
+				self.stats.progress(rd)
+				total += rd
+				continue
+
+			self._begin_chunk_msg(shared.MsgType.CHUNK, rfd, start + total)
+			opbuff = self._buff.getbuffer()[self._buff.tell():][:self.tuner.chunk_sz]
 			rd = fh.readinto(opbuff)
 			if not rd: # EOF
 				break
+			if hasher is not None:
+				hasher.update(opbuff[:rd])
 			self._buff.seek(rd, 1)
 			# there is no reply while sending chunks to minimize round-trip
 			self._send_msg()
+			self.stats.progress(rd)
 			total += rd
 		return total
 
+	def _begin_chunk_msg(self, msgtype, rfd, offset):
+		self._begin_msg(msgtype)
+		self._buffman.append_uint(rfd)
+		self._buffman.append_ulonglong(offset)
+
+	def _upload_zerocopy(self, rfd, fh, hasher=None):
+		"""
+		Send the rest of 'fh' (from its current position) using CHUNK_STREAM
+		messages whose payloads are copied by the kernel (sendfile). See
+		upload_file for 'hasher'.
+		"""
+		offset = fh.tell()
+		size = os.fstat(fh.fileno()).st_size
+		total = 0
+		while offset < size:
+			count = min(self.tuner.chunk_sz, size - offset)
+			self._begin_chunk_msg(shared.MsgType.CHUNK_STREAM, rfd, offset)
+			self._buffman.end_msg(count)
+			start = time.monotonic()
+			self._fout.write(self._buffman.getbuffer())
+			self._sendfile(fh, offset, count, hasher)
+			self.tuner.add_transfer(count, time.monotonic() - start)
+			self.stats.add('sent_bytes', len(self._buffman.getbuffer()) + count)
+			self.stats.progress(count)
+			offset += count
+			total += count
+		return total
+
+	def _sendfile(self, fh, offset, count, hasher=None):
+		"""
+		Send exactly 'count' bytes of 'fh' starting from 'offset'. See upload_file
+		for 'hasher'.
+		"""
+		outfd = self._fout.fileno()
+		while count and self._zerocopy:
+			try:
+				sent = os.sendfile(outfd, fh.fileno(), offset, count)
+			except OSError:
+				# not supported for this output: use buffered copy from now on
+				self._zerocopy = False
+				break
+			if not sent:
+				break
+			if hasher is not None:
+				# read back what was sent, which is in the page cache by now
+				hasher.update_from(fh.fileno(), offset, sent)
+			offset += sent
+			count -= sent
+		# buffered copy of the rest
+		while count:
+			data = os.pread(fh.fileno(), min(count, shared.DEFAULT_BUFF_SZ), offset)
+			if not data:
+				# file shrunk after we've announced the size: pad with zeros. The
+				# file will be synced again on the next run as its mtime changed.
+				data = bytes(min(count, shared.DEFAULT_BUFF_SZ))
+			if hasher is not None:
+				hasher.update(data)
+			shared.write_all(self._fout, data)
+			offset += len(data)
+			count -= len(data)
+
+	def _read_compressed(self, fh, codec):
+		"""
+		Read the next chunk of 'fh' into self._rawbuff and compress it.
+		returns:
+			(number of bytes read, compressed data)
+		"""
+		if self._rawbuff is None:
+			# room for message header + fd + offset
+			self._rawbuff = bytearray(self._svrmaxbuff - 17)
+		rd = fh.readinto(memoryview(self._rawbuff)[:self.tuner.chunk_sz])
+		if not rd:
+			return 0, None
+		return rd, shared.compress(codec, memoryview(self._rawbuff)[:rd])
+
+	def has_feature(self, feature):
+		return feature in self._features
+
+	def request_delta_sigs(self, rfd):
+		"""
+		Ask for the block signatures of the remote file, which the server computes
+		while other requests are sent.
+		returns:
+			ticket to be passed to self.upload_delta
+		"""
+		self._begin_msg(shared.MsgType.DELTA_SIGS)
+		self._buffman.append_uint(rfd)
+		return self._send_request()
+
+	def upload_delta(self, rfd, fh, ticket, hasher=None):
+		"""
+		Send only the parts of 'fh' that differ from the remote file, given the
+		'ticket' of self.request_delta_sigs. 'hasher' (_Hasher), if given, is
+		updated with the contents of 'fh' if they are sent.
+		returns:
+			Number of literal bytes sent, or None if the remote file cannot be used
+			as a basis (caller should fall back to self.upload_file).
+		"""
+		self._recv_msg(ticket, shared.MsgType.DELTA_SIGS_RESP)
+		errnoval, bs, basissz, count = struct.unpack("=HIQI", self._rbuff.read(18))
+		if errnoval != 0 or not count:
+			return None
+		size = os.fstat(fh.fileno()).st_size
+		if not size:
+			# cannot be mmap'ed
+			return None
+		sigs = [struct.unpack(f"=I{delta.STRONG_SUM_LEN}s",
+			self._rbuff.read(delta.SIG_ENTRY_SZ)) for _ in range(count)]
+
+		total = 0
+		with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			if hasher is not None:
+				hasher.update(mm)
+			self._begin_delta_msg(rfd)
+			for kind, a, b in delta.gen_delta(mm, bs, basissz, sigs):
+				if kind == delta.BLOCKREF:
+					if self._buff_room() < 9:
+						self._send_msg()
+						self._begin_delta_msg(rfd)
+					self._buffman.append_byte(delta.BLOCKREF)
+					self._buffman.append_uint(a)
+					self._buffman.append_uint(b)
+					continue
+				while a < b:
+					room = self._buff_room() - 5
+					if room <= 0:
+						self._send_msg()
+						self._begin_delta_msg(rfd)
+						continue
+					ln = min(room, b - a)
+					self._buffman.append_byte(delta.LITERAL)
+					self._buffman.append_uint(ln)
+					self._buffman.append_bytes(mm[a:a + ln])
+					a += ln
+					total += ln
+			self._send_msg()
+		self.stats.add('delta_literal_bytes', total)
+		self.stats.progress(size)
+		return total
+
+	def _request_manifest(self, flags):
+		self._begin_msg(shared.MsgType.MANIFEST)
+		self._buffman.append_byte(flags.value)
+		return self._send_request()
+
+	def manifest(self, digests=True):
+		"""
+		List the remote files and symlinks. The next page is requested before
+		the current one is processed, so that the server keeps listing and
+		hashing meanwhile.
+		yields:
+			(relative path name, (target, mtime, size, digest)) where 'target'
+			and 'size' are as in client.recursive_scan and 'digest' is only given
+			if 'digests' is True
+		"""
+		flags = shared.ManifestFlag.DIGESTS if digests else shared.ManifestFlag(0)
+		ticket = self._request_manifest(flags)
+		done = False
+		while not done:
+			nextticket = self._request_manifest(flags | shared.ManifestFlag.CONTINUE)
+			self._recv_msg(ticket, shared.MsgType.MANIFEST_RESP)
+			done = bool(self._rbuff.read(1)[0])
+			page = []
+			while True:
+				hdr = self._rbuff.read(_MANIFEST_ENTRY.size)
+				if not hdr:
+					break
+				kind, size, mtime = _MANIFEST_ENTRY.unpack(hdr)
+				kind = shared.EntryKind(kind)
+				fn = self._read_string()
+				data = self._read_string(False)
+				if kind == shared.EntryKind.SYMLINK:
+					entry = (data.decode('utf8', 'surrogateescape'), mtime, None, None)
+				else:
+					entry = (kind == shared.EntryKind.EXECUTABLE, mtime, size,
+						data.hex() if data else None)
+				page.append((fn, entry))
+			ticket = nextticket
+			yield from page
+		# reply of the last CONTINUE, after the listing was done
+		self._recv_msg(ticket, shared.MsgType.MANIFEST_RESP)
+
+	def _read_string(self, decode=True):
+		"""Read 16 bit length followed by the UTF8 string from the last reply"""
+		ret = self._rbuff.read(struct.unpack("=H", self._rbuff.read(2))[0])
+		return ret.decode('utf8', 'surrogateescape') if decode else ret
+
+	def _begin_delta_msg(self, rfd):
+		self._begin_msg(shared.MsgType.DELTA)
+		self._buffman.append_uint(rfd)
+
+	def _buff_room(self):
+		return len(self._buff) - self._buff.tell()
+
+class _Tuner:
+	"""
+	Sizes of the chunks and of the bulk operation windows, from the minimum
+	round-trip time and a moving average of the throughput. Round trips of bulk
+	operations include the time the server spends on them, which grows with the
+	window size: only the minimum tells the latency of the link.
+	Chunks take about CHUNK_TARGET_S to send. Windows grow from
+	shared.DEFAULT_BUFF_SZ (unless the buffers are smaller) so that the windows
+	in flight cover the bandwidth-delay product.
+	"""
+	def __init__(self, stats, buffsz, maxwindows):
+		self._stats = stats
+		self._buffsz = buffsz
+		self._maxwindows = maxwindows
+		self.rtt = None # seconds
+		self.throughput = None # bytes per second
+		self.chunk_sz = STREAM_CHUNK_SZ
+		# smaller windows would not save round trips, but cost more of them when
+		# the server is slower than the link
+		self._min_window_sz = min(shared.DEFAULT_BUFF_SZ, buffsz)
+		self.window_sz = self._min_window_sz
+		self._publish()
+
+	def add_rtt(self, seconds):
+		if self.rtt is not None and seconds >= self.rtt:
+			return
+		self.rtt = seconds
+		self._update()
+
+	def add_transfer(self, nbytes, seconds):
+		"""Account the time taken to send 'nbytes'"""
+		if nbytes < THROUGHPUT_SAMPLE_MIN_SZ or seconds <= 0:
+			return
+		self.throughput = _moving_average(self.throughput, nbytes / seconds)
+		self._update()
+
+	def _update(self):
+		if self.throughput is None:
+			return
+		self.chunk_sz = _pow2_within(self.throughput * CHUNK_TARGET_S,
+			MIN_STREAM_CHUNK_SZ, MAX_STREAM_CHUNK_SZ)
+		if self.rtt is not None:
+			# the window being filled is not in flight yet
+			bdp = self.throughput * self.rtt
+			self.window_sz = _pow2_within(bdp / max(1, self._maxwindows - 1),
+				self._min_window_sz, self._buffsz)
+		self._publish()
+
+	def _publish(self):
+		self._stats.set('chunk_sz', self.chunk_sz)
+		self._stats.set('window_sz', self.window_sz)
+		if self.rtt is not None:
+			self._stats.set('rtt_ms', round(self.rtt * 1000, 3))
+		if self.throughput is not None:
+			self._stats.set('throughput_bytes_per_s', round(self.throughput))
+
+def _moving_average(avg, value):
+	return value if avg is None else avg + (value - avg) * TUNE_WEIGHT
+
+def _pow2_within(value, lo, hi):
+	"""The smallest power of two of at least 'value', within 'lo' and 'hi'"""
+	ret = lo
+	while ret < value and ret < hi:
+		ret *= 2
+	return min(ret, hi)
+
+class _Hasher:
+	"""shared.file_digest of file contents, computed as they are sent"""
+	def __init__(self):
+		self._hash = shared.new_digest()
+		self.length = 0
+
+	def update(self, data):
+		self._hash.update(data)
+		self.length += len(data)
+
+	def update_from(self, fd, offset, count):
+		"""Hash 'count' bytes of file descriptor 'fd' starting from 'offset'"""
+		while count:
+			data = os.pread(fd, min(count, shared.DIGEST_BLOCK_SZ), offset)
+			if not data:
+				break
+			self.update(data)
+			offset += len(data)
+			count -= len(data)
+
+	def result(self):
+		"""returns: (length hashed, hex digest)"""
+		return self.length, self._hash.hexdigest()
+
 class _OpQueue:
-	def __init__(self, client):
+	def __init__(self, client, verbose=True):
 		self._client = client
-		self._enqueued_ops = [] # list of (relative file name, operations data)
-		self._open_fds = {} # dict {remote fd: relative file name}
+		self._stats = client.stats
+		# per-file messages. Errors are always printed.
+		self._log = print if verbose else _no_log
+		# list of (relative file name, operations data, UploadMode). The data of
+		# renames and copies is the source name.
+		self._enqueued_ops = []
+		self._sent = deque() # windows whose results have not been processed
+		self._closing = deque() # windows whose close results are pending
+		# files enqueued for upload without a digest, to be hashed as they are sent
+		self._unhashed = set()
+		# {file name: (length, digest)} of the files hashed as they were sent,
+		# until the server has written them
+		self._hashed = {}
+		# the same, once written
+		self.digests = {}
 
-	def _do_process_queue(self):
+	def _process_results(self, window):
 		"""Do not call this function directly. Call self.do_process_queue instead."""
-		res = self._client.run_bulk_queue()
-		if len(res) != len(self._enqueued_ops):
+		res = self._client.bulk_results(window)
+		if len(res) != len(window.ops):
 			raise RuntimeError("Server sent invalid response for bulk open")
 
-		for i in range(len(self._enqueued_ops)):
-			op = self._enqueued_ops[i]
+		window.open_fds = {}
+		for i in range(len(window.ops)):
+			op = window.ops[i]
 			rettype, retval = res[i]
-			if op[1] is None:
+			if op[2] == UploadMode.RENAME:
+				if rettype != BulkOpRetType.GENERIC:
+					raise RuntimeError("Invalid response for rename request")
+				if retval[0] != 0:
+					print(f"Error renaming '{op[1]}' to '{op[0]}': {os.strerror(retval[0])}")
+					return False
+				self._stats.add('files_renamed')
+				self._log(f"Renamed '{op[1]}' -> '{op[0]}'")
+			elif op[2] == UploadMode.COPY:
+				if rettype != BulkOpRetType.GENERIC:
+					raise RuntimeError("Invalid response for copy request")
+				if retval[0] != 0:
+					print(f"Error copying '{op[1]}' to '{op[0]}': {os.strerror(retval[0])}")
+					return False
+				self._stats.add('files_copied')
+				self._log(f"Copied '{op[1]}' -> '{op[0]}'")
+			elif op[2] == UploadMode.MKDIR:
+				if rettype != BulkOpRetType.GENERIC:
+					raise RuntimeError("Invalid response for mkdir request")
+				if retval[0] != 0:
+					print(f"Error creating directory '{op[0]}': {os.strerror(retval[0])}")
+					return False
+				self._stats.add('dirs_created')
+				self._log(f"Created directory '{op[0]}'")
+			elif op[1] is None:
 				# delete request
 				if rettype != BulkOpRetType.GENERIC:
 					raise RuntimeError("Invalid response for delete request")
 				if retval[0] != 0:
 					print(f"Error deleting '{op[0]}': {os.strerror(retval[0])}")
 					return False
-				print(f"Deleted '{op[0]}'")
+				self._stats.add('files_deleted')
+				self._log(f"Deleted '{op[0]}'")
 			elif isinstance(op[1], str):
 				# symlink request
 				if rettype != BulkOpRetType.GENERIC:
@@ -206,7 +890,18 @@ class _OpQueue:
 				if retval[0] != 0:
 					print(f"Error creating symlink '{op[0]}': {os.strerror(retval[0])}")
 					return False
-				print(f"Created symlink '{op[0]}' -> '{op[1]}'")
+				self._stats.add('files_updated')
+				self._log(f"Created symlink '{op[0]}' -> '{op[1]}'")
+			elif op[2] == UploadMode.INLINE:
+				if rettype != BulkOpRetType.GENERIC:
+					raise RuntimeError("Invalid response for inline write request")
+				if retval[0] != 0:
+					print(f"Error writing file '{op[0]}': {os.strerror(retval[0])}")
+					return False
+				self._stats.add('files_updated')
+				self._stats.add('inline_files')
+				self._written(op[0])
+				self._log(f"File '{op[0]}' uploaded")
 			else:
 				# regular file
 				if rettype != BulkOpRetType.OPENFD:
@@ -218,45 +913,135 @@ class _OpQueue:
 				# some files are open only to update permission: we won't register
 				# their open fd here
 				if op[1]:
-					self._open_fds[fd] = op[0]
+					window.open_fds[fd] = (op[0], op[2])
 				else:
-					print(f"Permission updated for '{op[0]}'")
+					self._stats.add('files_updated')
+					self._log(f"Permission updated for '{op[0]}'")
 
 		# OK
 		return True
 
-	def _do_upload_files(self):
+	def _upload_files(self, window):
 		"""Do not call this function directly. Call self.do_process_queue instead."""
-		for rfd, fn in self._open_fds.items():
-			print(f"Uploading '{fn}' ...")
+		# the server reads the remote files of delta transfers, and the partial
+		# files of resumed uploads, while the other files are uploaded
+		tickets = {}
+		for rfd, (_, mode) in window.open_fds.items():
+			if mode == UploadMode.DELTA:
+				tickets[rfd] = self._client.request_delta_sigs(rfd)
+			elif mode == UploadMode.RESUME:
+				tickets[rfd] = self._client.request_partial(rfd)
+		for rfd, (fn, mode) in sorted(window.open_fds.items(),
+				key=lambda x: x[0] in tickets):
+			self._log(f"Uploading '{fn}' ...")
+			hasher = None
+			if fn in self._unhashed:
+				self._unhashed.discard(fn)
+				hasher = _Hasher()
 			with open(fn, 'rb', buffering=0) as f:
-				self._client.upload_file(rfd, f)
+				if mode == UploadMode.DELTA:
+					with self._stats.timer('upload_delta'):
+						if self._client.upload_delta(rfd, f, tickets[rfd],
+								hasher) is not None:
+							self._hash_done(fn, hasher)
+							continue
+				elif mode == UploadMode.RESUME:
+					f.seek(self._resume_offset(fn, f, tickets[rfd]))
+				with self._stats.timer('upload_file'):
+					self._client.upload_file(rfd, f, _should_compress(fn), hasher)
+			self._hash_done(fn, hasher)
+		self._client.close_bulk_queue(window)
+		self._closing.append(window)
 
-		for rfd, errnoval in self._client.close_bulk_queue():
-			if rfd not in self._open_fds:
-				# permssion update only. skip.
-				continue
-			fn = self._open_fds[rfd]
-			if errnoval == 0:
-				print(f"File '{fn}' uploaded")
-			else:
-				print(f"Error uploading '{fn}': {os.strerror(errnoval)}")
-				return False
+	def _resume_offset(self, fn, fh, ticket):
+		"""
+		returns:
+			length of the start of 'fh' that the server has received by an earlier
+			upload of 'fn', given the 'ticket' of _Client.request_partial
+		"""
+		offset, digest = self._client.partial_result(ticket)
+		if not offset:
+			return 0
+		# e.g. the file was modified during the earlier upload
+		with self._stats.timer('resume_verify'):
+			same = shared.fd_digest(fh.fileno(), offset) == digest
+		if not same:
+			print(f"Partial upload of '{fn}' does not match: uploading it whole")
+			self._stats.add('resume_mismatches')
+			return 0
+		self._log(f"Resuming '{fn}' from {offset} bytes ...")
+		self._stats.add('resumed_bytes', offset)
+		return offset
+
+	def _process_close_results(self, block):
+		"""Do not call this function directly. Call self.do_process_queue instead."""
+		while self._closing:
+			res = self._client.bulk_close_results(self._closing[0], block)
+			if res is None:
+				# not arrived yet
+				break
+			window = self._closing.popleft()
+			for rfd, errnoval in res:
+				if rfd not in window.open_fds:
+					# permssion update only. skip.
+					continue
+				fn, _ = window.open_fds[rfd]
+				if errnoval == 0:
+					self._stats.add('files_updated')
+					self._written(fn)
+					self._log(f"File '{fn}' uploaded")
+				else:
+					print(f"Error uploading '{fn}': {os.strerror(errnoval)}")
+					return False
 
 		# OK
 		return True
 
-	def do_process_queue(self):
-		"""Perform additional checks as well as cleaning the queue once finished"""
-		try:
-			self._open_fds.clear()
-			if not self._do_process_queue():
+	def _hash_done(self, fn, hasher):
+		if hasher is not None:
+			self._hashed[fn] = hasher.result()
+
+	def _written(self, fn):
+		"""Account file 'fn' as written by the server"""
+		hashed = self._hashed.pop(fn, None)
+		if hashed is not None:
+			self.digests[fn] = hashed
+
+	def do_process_queue(self, wait=True):
+		"""
+		Send the enqueued operations as a new bulk window.
+		If 'wait' is True, all windows in flight are completed. Otherwise, only
+		the oldest windows are completed so that a new window can be sent.
+		"""
+		if self._client.has_bulk_queue():
+			window = self._client.run_bulk_queue()
+			window.ops = self._enqueued_ops
+			self._enqueued_ops = []
+			self._sent.append(window)
+
+		limit = 0 if wait else self._client.max_windows - 1
+		while len(self._sent) > limit:
+			window = self._sent.popleft()
+			if not self._process_results(window):
 				return False
-			if not self._do_upload_files():
+			self._upload_files(window)
+			if not self._process_close_results(False):
 				return False
-			return True
-		finally:
-			self._enqueued_ops.clear()
+		if wait:
+			return self._process_close_results(True)
+		return True
+
+	def _read_small_file(self, fn):
+		"""Returns the contents of 'fn' if it can be sent inline, None otherwise"""
+		if not self._client.has_feature(shared.Feature.WRITE_INLINE):
+			return None
+		try:
+			with open(fn, 'rb', buffering=0) as f:
+				data = f.read(INLINE_MAX_SZ + 1)
+		except OSError:
+			# let the regular upload path report the error
+			return None
+		return data if len(data) <= INLINE_MAX_SZ else None
 
 	def enqueue(self, fn, update_data, **kwargs):
 		"""
@@ -268,25 +1053,118 @@ class _OpQueue:
 				bool for file addition (True to upload content, False to just open)
 			executable:
 				Only for normal file. Set to True to make remote file executable.
+			delta:
+				Only for normal file. Set to True if the remote file already exists
+				and can be used as a basis for delta transfer.
+			size:
+				Only for normal file. Size of the file as of scanning. Small files
+				are sent inline with the bulk operation.
+			digest:
+				Only for normal file. Digest of the contents as of scanning. Uploads
+				of large files are resumable if it is given. Otherwise, the contents
+				are hashed as they are sent, see Session.digests.
 		"""
+		mode = None
 		if update_data is None:
 			rs = self._client.queue_delete(fn)
+		elif update_data is True:
+			data = None
+			if kwargs.get('size', 0) <= INLINE_MAX_SZ:
+				data = self._read_small_file(fn)
+			if data is not None:
+				mode = UploadMode.INLINE
+				rs = self._client.queue_write_inline(fn, kwargs['executable'], data)
+				if rs:
+					self._stats.progress(len(data))
+					if kwargs.get('digest') is None:
+						hasher = _Hasher()
+						hasher.update(data)
+						self._hash_done(fn, hasher)
+			else:
+				size = kwargs.get('size', 0)
+				if kwargs.get('delta', False) and \
+						self._client.has_feature(shared.Feature.DELTA) and \
+						size >= DELTA_MIN_SZ:
+					mode = UploadMode.DELTA
+				elif kwargs.get('digest') is not None and size >= RESUME_MIN_SZ and \
+						self._client.has_feature(shared.Feature.RESUME):
+					mode = UploadMode.RESUME
+				else:
+					mode = UploadMode.WHOLE
+				rs = self._client.queue_upload(fn, kwargs['executable'], size,
+					mode == UploadMode.DELTA,
+					kwargs['digest'] if mode == UploadMode.RESUME else None)
+				if rs and kwargs.get('digest') is None:
+					self._unhashed.add(fn)
 		else:
 			rs = self._client.queue_upload(fn, kwargs['executable'])
 
 		if rs:
 			# enqueue successful
-			self._enqueued_ops.append((fn, update_data))
+			self._enqueued_ops.append((fn, update_data, mode))
 			return True
 
-		# if we're here, queue buffer is full, process the existing queue
-		if not self.do_process_queue():
+		# if we're here, queue buffer is full, send the existing queue
+		if not self.do_process_queue(wait=False):
 			# queue processing failed. tell caller
 			return False
 		# at this point, queue processing was successful, retry enqueueing
 		# this queue again
 		return self.enqueue(fn, update_data, **kwargs)
 
+	def enqueue_rename(self, src, dst):
+		"""Rename remote file or directory 'src' to 'dst'"""
+		if self._client.queue_rename(src, dst):
+			self._enqueued_ops.append((dst, src, UploadMode.RENAME))
+			return True
+		if not self.do_process_queue(wait=False):
+			return False
+		return self.enqueue_rename(src, dst)
+
+	def enqueue_mkdir(self, fn):
+		"""Create remote directory 'fn'"""
+		if self._client.queue_mkdir(fn):
+			self._enqueued_ops.append((fn, None, UploadMode.MKDIR))
+			return True
+		if not self.do_process_queue(wait=False):
+			return False
+		return self.enqueue_mkdir(fn)
+
+	def enqueue_copy(self, src, dst, executable, hardlink=False):
+		"""Make remote file 'dst' a copy (or a hardlink) of remote file 'src'"""
+		if self._client.queue_copy(src, dst, executable, hardlink):
+			self._enqueued_ops.append((dst, src, UploadMode.COPY))
+			return True
+		if not self.do_process_queue(wait=False):
+			return False
+		return self.enqueue_copy(src, dst, executable, hardlink)
+
+def _choose_codec(compress, features):
+	"""
+	Pick a codec supported by both sides.
+	'compress' is either 'auto' (best available), 'none', or a codec name.
+	"""
+	if compress == 'none':
+		return shared.Codec.NONE
+	usable = features & shared.available_codecs()
+	if compress == 'auto':
+		for codec in (shared.Codec.ZLIB, shared.Codec.LZMA):
+			if CODEC_FEATURES[codec] in usable:
+				return codec
+		return shared.Codec.NONE
+	codec = shared.Codec[compress.upper()]
+	if CODEC_FEATURES[codec] not in usable:
+		print(f"Compression codec '{compress}' is not supported by both sides. "\
+			"Sending uncompressed.")
+		return shared.Codec.NONE
+	return codec
+
+def _no_log(*args):
+	pass
+
+def _should_compress(fn):
+	return os.path.splitext(fn)[1].lower() not in PRECOMPRESSED_EXTS
+
 def _gen_oserror(errnoval):
 	return OSError(errnoval, os.strerror(errnoval))
 
@@ -297,20 +1175,247 @@ def _convert_bulkopen_result(rettype, bio):
 		return struct.unpack("=iH", bio.read(6))
 	raise RuntimeError("Unknown rettype")
 
-def run_sync(sw, newstate, to_delete, to_update):
-	if not to_delete and not to_update:
-		print("Nothing to be done!")
-		return True
-	p = Popen(sw['command'], stdout=PIPE, stdin=PIPE)
+class Session:
+	"""
+	Connection to a remote server, given by the state's 'transport': either
+	'stdio' (default) to start the server using the state's 'command', or the
+	address of a server started with 'server --listen' ('tcp:host:port' or
+	'unix:path'). The session can be used to push any number of changes.
+	"""
+	def __init__(self, sw, compress='auto', stats=None, verbose=True):
+		transport = sw.get('transport') or 'stdio'
+		self._proc = None
+		self._sock = None
+		if transport == 'stdio':
+			self._proc = Popen(sw['command'], stdout=PIPE, stdin=PIPE)
+			fout, fin = self._proc.stdin.raw, self._proc.stdout.raw
+		else:
+			self._sock = shared.connect(transport)
+			fout = fin = shared.SocketStream(self._sock)
+		try:
+			self._client = _Client(fout, fin, sw['remotecwd'], compress, stats)
+		except:
+			# e.g. the server could not be started or has refused the directory
+			if self._proc is not None:
+				self._proc.terminate()
+				self._proc.wait()
+			else:
+				self._sock.close()
+			raise
+		self._opqueue = _OpQueue(self._client, verbose)
 
-	client = _Client(p.stdin.raw, p.stdout.raw, sw['remotecwd'])
-	opqueue = _OpQueue(client)
+	@property
+	def digests(self):
+		"""
+		{file name: (length, digest)} of the files uploaded so far without a
+		digest, hashed as they were sent (see shared.file_digest). The length
+		tells whether the file has changed since it was scanned. Entries can be
+		removed once recorded.
+		"""
+		return self._opqueue.digests
 
-	for k in to_delete:
-		if not opqueue.enqueue(k, None):
+	def push(self, newstate, to_delete, to_update, remote_files, renames=(),
+			copies=None, hardlink=False, mkdirs=()):
+		"""
+		Apply the changes to the remote and wait for them to complete.
+		See run_sync for the arguments.
+		returns:
+			True on success
+		"""
+		if copies and not self._client.has_feature(shared.Feature.COPY):
+			# upload them all
+			to_update = {**to_update, **dict.fromkeys(copies, True)}
+			copies = None
+		if renames and not self._client.has_feature(shared.Feature.RENAME):
+			print("Server does not support renames. Sync with --no-renames.")
 			return False
+		for src, dst in renames:
+			if not self._opqueue.enqueue_rename(src, dst):
+				return False
+		for k in to_delete:
+			if not self._opqueue.enqueue(k, None):
+				return False
+		for k in mkdirs:
+			if not self.put_mkdir(k):
+				return False
+		for k, v in to_update.items():
+			if not self.put(k, v, newstate[k], k in remote_files):
+				return False
+		if copies:
+			# the sources have to be uploaded first
+			if not self._opqueue.do_process_queue():
+				return False
+			for dst, src in copies.items():
+				executable = newstate[dst][0]
+				# hardlinks share the permissions too
+				if not self._opqueue.enqueue_copy(src, dst, executable,
+						hardlink and executable == newstate[src][0]):
+					return False
+		# the remaining operations
+		return self._opqueue.do_process_queue()
+
+	def put(self, fn, update, entry, remote=False):
+		"""
+		Send update 'update' of 'fn' (see run_sync's 'to_update') without waiting
+		for it to complete. 'entry' is its new state entry. 'remote' tells that
+		it exists on the remote as a regular file.
+		returns:
+			False if an operation has failed
+		"""
+		return self._opqueue.enqueue(fn, update, executable=entry[0], delta=remote,
+			size=entry[2], digest=entry[3])
+
+	def put_mkdir(self, fn):
+		"""Send the creation of remote directory 'fn'. See put."""
+		# otherwise the server creates them when a file cannot be created
+		if not self._client.has_feature(shared.Feature.MKDIR):
+			return True
+		return self._opqueue.enqueue_mkdir(fn)
+
+	def manifest(self, digests=True):
+		"""
+		returns:
+			dict of the remote files and symlinks, see _Client.manifest, or None
+			if the server cannot list them
+		"""
+		if not self._client.has_feature(shared.Feature.MANIFEST):
+			print("Server does not support listing its files.")
+			return None
+		return dict(self._client.manifest(digests))
+
+	def close(self):
+		self._client.close()
+		self._disconnect()
+
+	def end(self, ok):
+		"""
+		close() the session if 'ok' is True. Otherwise there might be operations
+		in flight: terminate() it.
+		"""
+		if ok:
+			self.close()
+		else:
+			self.terminate()
+
+	def terminate(self):
+		"""Close without telling the server, e.g. when interrupted mid-message"""
+		if self._proc is not None:
+			self._proc.terminate()
+		self._disconnect()
+
+	def _disconnect(self):
+		if self._proc is not None:
+			self._proc.stdin.close()
+			self._proc.wait()
+		else:
+			try:
+				self._sock.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				# already disconnected
+				pass
+			self._client.join_reader()
+			self._sock.close()
+
+def _path_shard(fn, streams):
+	return zlib.crc32(fn.encode('utf8')) % streams
+
+def _shard(newstate, to_delete, to_update, streams):
+	"""
+	Split the operations between 'streams' sessions. Files of at least
+	SHARD_BIG_FILE_SZ bytes are given to the least loaded session, largest
+	first. Everything else is assigned by the hash of its path.
+	A file is always sent by a single session: splitting a huge file into
+	offset ranges sent by several sessions is not supported (yet).
+	returns:
+		list of (to_delete, to_update) for each session
+	"""
+	shards = [([], {}) for _ in range(streams)]
+	loads = [0] * streams
+	for k in to_delete:
+		i = _path_shard(k, streams)
+		shards[i][0].append(k)
+		loads[i] += SHARD_OP_COST
+	big = []
 	for k, v in to_update.items():
-		if not opqueue.enqueue(k, v, executable=newstate[k][0]):
+		size = (newstate[k][2] or 0) if v is True else 0
+		if size >= SHARD_BIG_FILE_SZ:
+			big.append((size, k))
+			continue
+		i = _path_shard(k, streams)
+		shards[i][1][k] = v
+		loads[i] += size + SHARD_OP_COST
+	for size, k in sorted(big, reverse=True):
+		i = loads.index(min(loads))
+		shards[i][1][k] = to_update[k]
+		loads[i] += size + SHARD_OP_COST
+	return shards
+
+def _run_stream(sw, newstate, to_delete, to_update, remote_files, compress,
+		stats, verbose, digests, renames=(), copies=None, hardlink=False,
+		mkdirs=()):
+	if not to_delete and not to_update and not renames and not copies and \
+			not mkdirs:
+		return True
+	session = Session(sw, compress, stats, verbose)
+	ok = False
+	try:
+		ok = session.push(newstate, to_delete, to_update, remote_files, renames,
+			copies, hardlink, mkdirs)
+	finally:
+		session.end(ok)
+	if digests is not None:
+		digests.update(session.digests)
+	return ok
+
+def run_sync(sw, newstate, to_delete, to_update, remote_files, compress='auto',
+		streams=1, stats=None, verbose=True, renames=(), copies=None,
+		hardlink=False, mkdirs=(), digests=None):
+	"""
+	'remote_files' is a set of files in 'to_update' that already exist on the
+	remote as regular files (and can be delta transferred).
+	'renames' is a list of (source, destination) remote paths to be renamed, in
+	order, before anything else.
+	'copies' is a dict of {destination: source} remote files to be copied
+	after everything else, or hardlinked if 'hardlink' is True.
+	'mkdirs' is a list of directories to be created on the remote before the
+	files, parents first.
+	If 'streams' is more than 1, that many servers are started and the
+	operations are split between them. Returns True only if all of them
+	succeeded.
+	'stats' is a stats.Stats to account the transfer to. Per-file messages are
+	only printed if 'verbose' is True.
+	'digests' is a dict updated with the Session.digests of the uploads.
+	"""
+	if not to_delete and not to_update and not renames and not copies:
+		print("Nothing to be done!")
+		return True
+	stats = stats or Stats()
+	stats.set_total(sum(newstate[k][2] or 0 for k, v in to_update.items()
+		if v is True))
+	try:
+		streams = max(1, min(streams, len(to_delete) + len(to_update)))
+		if streams == 1:
+			return _run_stream(sw, newstate, to_delete, to_update, remote_files,
+				compress, stats, verbose, digests, renames, copies, hardlink, mkdirs)
+		# the other operations are on the renamed paths, in the new directories.
+		# Files replaced by directories have to be deleted before.
+		replaced = set(mkdirs).intersection(to_delete)
+		if replaced:
+			to_delete = [k for k in to_delete if k not in replaced]
+		if not _run_stream(sw, newstate, sorted(replaced), {}, remote_files,
+				compress, stats, verbose, None, renames, mkdirs=mkdirs):
+			return False
+
+		shards = _shard(newstate, to_delete, to_update, streams)
+		with ThreadPoolExecutor(max_workers=streams) as pool:
+			futs = [pool.submit(_run_stream, sw, newstate, d, u, remote_files,
+				compress, stats, verbose, digests) for d, u in shards]
+			# wait for all of them, even if one has failed
+			results = [fut.result() for fut in futs]
+		if not all(results):
 			return False
-	# the remaining operations
-	return opqueue.do_process_queue()
+		# sources of the copies are uploaded by then
+		return _run_stream(sw, newstate, [], {}, remote_files, compress, stats,
+			verbose, None, copies=copies, hardlink=hardlink)
+	finally:
+		stats.end_progress()
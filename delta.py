@@ -0,0 +1,125 @@
+import zlib
+import math
+import hashlib
+
+MIN_BLOCK_SZ = 4096
+STRONG_SUM_LEN = 16
+# each signature entry: uint32 weak + strong digest
+SIG_ENTRY_SZ = 4 + STRONG_SUM_LEN
+# maximum number of bytes the delta generator will scan byte-by-byte (in
+# Python, about half a second per MiB) looking for shifted blocks. Past this point,
+# only block-aligned matches are attempted so that diffing a largely rewritten
+# file does not take longer than sending it whole.
+ROLL_BUDGET = 2 * 1_048_576
+
+_ADLER_MOD = 65521
+
+# delta instruction kinds
+LITERAL = 0
+BLOCKREF = 1
+
+def strong_sum(data):
+	return hashlib.blake2b(data, digest_size=STRONG_SUM_LEN).digest()
+
+def block_size(filesz, maxblocks):
+	"""
+	Choose a block size for a basis file of the given size such that there
+	will be no more than 'maxblocks' blocks.
+	"""
+	bs = max(MIN_BLOCK_SZ, math.isqrt(filesz))
+	return max(bs, -(-filesz // maxblocks))
+
+def gen_signatures(fh, bs):
+	"""
+	Yields (weak checksum, strong checksum) of each 'bs' sized block in 'fh'.
+	The last block might be shorter than 'bs'.
+	"""
+	while True:
+		blk = fh.read(bs)
+		if not blk:
+			break
+		yield zlib.adler32(blk), strong_sum(blk)
+
+def gen_delta(data, bs, basissz, sigs, roll_budget=ROLL_BUDGET):
+	"""
+	Compare 'data' (a buffer of the new file contents, e.g. an mmap) against the
+	signatures of the basis file.
+	yields:
+		(LITERAL, start, end) for data[start:end] that has to be sent verbatim
+		(BLOCKREF, index, count) for 'count' consecutive basis blocks starting
+		from block 'index'
+	"""
+	n = len(data)
+	table = {}
+	for idx, (weak, _) in enumerate(sigs):
+		table.setdefault(weak, []).append(idx)
+
+	def _blocklen(idx):
+		return min(bs, basissz - idx * bs)
+
+	def _match(weak, start, end):
+		cands = table.get(weak)
+		if not cands:
+			return None
+		strong = None
+		for idx in cands:
+			if _blocklen(idx) != end - start:
+				continue
+			if strong is None:
+				strong = strong_sum(data[start:end])
+			if sigs[idx][1] == strong:
+				return idx
+		return None
+
+	run = None # [first block index, count]
+	litstart = 0
+	pos = 0
+	while pos < n:
+		end = min(pos + bs, n)
+		idx = _match(zlib.adler32(data[pos:end]), pos, end)
+		if idx is None and roll_budget > 0 and end - pos == bs and end < n:
+			# roll the weak checksum one byte at a time to find blocks that
+			# have shifted (e.g. after an insertion)
+			rollend = min(pos + bs, n - bs)
+			window = data[pos:rollend + bs]
+			roll_budget -= rollend - pos
+			weak = zlib.adler32(window[:bs])
+			a = weak & 0xffff
+			b = weak >> 16
+			for i in range(rollend - pos):
+				out = window[i]
+				a = (a - out + window[i + bs]) % _ADLER_MOD
+				b = (b - bs * out + a - 1) % _ADLER_MOD
+				if ((b << 16) | a) in table:
+					idx = _match((b << 16) | a, pos + i + 1, pos + i + 1 + bs)
+					if idx is not None:
+						pos += i + 1
+						end = pos + bs
+						break
+			else:
+				# no match within this window: treat as literal
+				pos = rollend
+				continue
+		elif idx is None:
+			pos = end
+			continue
+
+		# found a matching block
+		if litstart < pos:
+			if run:
+				yield (BLOCKREF, *run)
+				run = None
+			yield (LITERAL, litstart, pos)
+		if run and run[0] + run[1] == idx:
+			run[1] += 1
+		else:
+			if run:
+				yield (BLOCKREF, *run)
+			run = [idx, 1]
+		pos = end
+		litstart = pos
+
+	if run:
+		yield (BLOCKREF, *run)
+	if litstart < n:
+		yield (LITERAL, litstart, n)
@@ -0,0 +1,232 @@
+import os
+import re
+
+# per-directory rules file, see Filter.for_dir
+DEFAULT_IGNORE_FILE = ".s2rignore"
+
+_GLOB_CHARS = re.compile(r"[*?\[\\]")
+
+def _translate(pattern):
+	"""Translate a gitignore glob (without leading '/') to a regex"""
+	ret = []
+	i = 0
+	n = len(pattern)
+	while i < n:
+		c = pattern[i]
+		if pattern.startswith("**/", i) and (i == 0 or pattern[i - 1] == '/'):
+			# any number of directories, including none
+			ret.append("(?:.*/)?")
+			i += 3
+			continue
+		if pattern.startswith("**", i) and i + 2 == n and (i == 0 or pattern[i - 1] == '/'):
+			# everything inside
+			ret.append(".*")
+			break
+		if c == '*':
+			ret.append("[^/]*")
+		elif c == '?':
+			ret.append("[^/]")
+		elif c == '[':
+			cls = _translate_class(pattern, i)
+			if cls is None:
+				ret.append(re.escape(c))
+			else:
+				regex, i = cls
+				ret.append(regex)
+		elif c == '\\' and i + 1 < n:
+			i += 1
+			ret.append(re.escape(pattern[i]))
+		else:
+			ret.append(re.escape(c))
+		i += 1
+	return "".join(ret)
+
+def _translate_class(pattern, i):
+	"""
+	Translate the '[...]' class starting at pattern[i]. As with gitignore, a
+	']' right after the '[' (or after the '!' or '^' negating it) is part of
+	the class.
+	returns:
+		(regex, index of the closing ']'), or None if the class is unterminated
+		or invalid (e.g. '[z-a]'), in which case the '[' is taken literally
+	"""
+	n = len(pattern)
+	j = i + 1
+	negate = j < n and pattern[j] in "!^"
+	if negate:
+		j += 1
+	start = j
+	chars = []
+	while j < n and (pattern[j] != ']' or j == start):
+		c = pattern[j]
+		if c == '\\' and j + 1 < n:
+			j += 1
+			chars.append(re.escape(pattern[j]))
+		elif c == '-' and j > start and j + 1 < n and pattern[j + 1] != ']':
+			chars.append(c)
+		else:
+			chars.append(re.escape(c))
+		j += 1
+	if j >= n:
+		return None
+	# '/' is never matched
+	regex = "[" + ("^/" if negate else "") + "".join(chars) + "]"
+	try:
+		re.compile(regex)
+	except re.error:
+		return None
+	return regex, j
+
+class _Group:
+	"""Consecutive rules of the same kind, matched at once"""
+	def __init__(self, include, dir_only):
+		self.include = include
+		self.dir_only = dir_only
+		self.names = set() # plain names matching at any depth
+		self.patterns = []
+		self.regex = None
+
+class Rules:
+	"""
+	Compiled gitignore-style rules, for paths relative to the directory of the
+	rules:
+		'#' starts a comment, '!' re-includes what previous rules excluded,
+		a trailing '/' only matches directories, and rules containing a '/' other
+		than a trailing one are relative to the directory of the rules. Other
+		rules match names at any depth. '*', '?' and '[...]' do not match '/',
+		'**' matches any number of directories.
+	As with gitignore, the last matching rule decides.
+	"""
+	def __init__(self, lines):
+		self._groups = []
+		for line in lines:
+			self._add(line)
+		for g in self._groups:
+			if g.patterns:
+				g.regex = re.compile("|".join(f"(?:{p})" for p in g.patterns))
+
+	def __bool__(self):
+		return bool(self._groups)
+
+	def _add(self, line):
+		line = line.rstrip("\n")
+		if not line.endswith("\\ "):
+			line = line.rstrip(" ")
+		if not line or line.startswith("#"):
+			return
+		include = line.startswith("!")
+		if include or line.startswith("\\!") or line.startswith("\\#"):
+			line = line[1:]
+		dir_only = line.endswith("/")
+		line = line.rstrip("/")
+		if not line:
+			return
+		if self._groups and (self._groups[-1].include, self._groups[-1].dir_only) \
+				== (include, dir_only):
+			group = self._groups[-1]
+		else:
+			group = _Group(include, dir_only)
+			self._groups.append(group)
+		if "/" in line:
+			group.patterns.append(_translate(line.lstrip("/")))
+		elif not _GLOB_CHARS.search(line):
+			group.names.add(line)
+		else:
+			group.patterns.append("(?:.*/)?" + _translate(line))
+
+	def match(self, relpath, is_dir):
+		"""
+		returns:
+			True if 'relpath' is excluded, False if it is included by a '!' rule,
+			None if no rule matches
+		"""
+		name = relpath.rpartition("/")[2]
+		for g in reversed(self._groups):
+			if g.dir_only and not is_dir:
+				continue
+			if name in g.names or (g.regex is not None and g.regex.fullmatch(relpath)):
+				return not g.include
+		return None
+
+class Filter:
+	"""
+	Rules in effect in a directory: the rules of the directory itself, then the
+	ones of its parent directories, and finally the rules of the state file.
+	Paths are relative path names, as in client.recursive_scan.
+	"""
+	def __init__(self, rules, ignore_file=DEFAULT_IGNORE_FILE, base="", parent=None):
+		self._rules = rules
+		self._base = base
+		self._parent = parent
+		self.ignore_file = ignore_file
+
+	@classmethod
+	def from_state(cls, sw):
+		"""
+		Filter of the state's configuration, which applies to the current
+		directory before its own ignore file.
+		"""
+		return cls(Rules(sw.get('filters') or ()), sw.get('ignore_file',
+			DEFAULT_IGNORE_FILE))
+
+	def excluded(self, path, is_dir):
+		"""Whether 'path' in the directory of this filter is excluded"""
+		f = self
+		while f is not None:
+			res = f._rules.match(path[len(f._base) + 1:] if f._base else path, is_dir)
+			if res is not None:
+				return res
+			f = f._parent
+		return False
+
+	def for_dir(self, path, has_ignore_file=None):
+		"""
+		Filter of subdirectory 'path' of the directory of this filter, with the
+		rules of its ignore file, if any. 'has_ignore_file' can be given if
+		known.
+		"""
+		base = "" if path == "." else path
+		if not self.ignore_file or has_ignore_file is False:
+			return self
+		try:
+			with open(os.path.join(path, self.ignore_file), 'r',
+					errors='surrogateescape') as f:
+				rules = Rules(f)
+		except (FileNotFoundError, NotADirectoryError):
+			return self
+		if not rules:
+			return self
+		return Filter(rules, self.ignore_file, base, self)
+
+class ExcludedPaths:
+	"""
+	Tells whether paths (relative path names) or one of their parent directories
+	are excluded, reading ignore files of the parent directories as needed.
+	"""
+	def __init__(self, filt):
+		# {relative dir path: (filter in the directory, whether it is excluded)}
+		self._dirs = {"": (filt.for_dir("."), False)}
+
+	def _dir(self, d):
+		ret = self._dirs.get(d)
+		if ret is None:
+			filt, excluded = self._dir(d.rpartition("/")[0])
+			if not excluded:
+				excluded = filt.excluded(d, True)
+				if not excluded:
+					filt = filt.for_dir(d)
+			ret = self._dirs[d] = (filt, excluded)
+		return ret
+
+	def dir_excluded(self, d):
+		return self._dir(d)[1]
+
+	def dir_filter(self, d):
+		"""Filter in effect in directory 'd', or None if it is excluded"""
+		filt, excluded = self._dir(d)
+		return None if excluded else filt
+
+	def __call__(self, path):
+		"""Whether file 'path' is excluded"""
+		filt, excluded = self._dir(path.rpartition("/")[0])
+		return excluded or filt.excluded(path, False)
@@ -0,0 +1,212 @@
+import os
+from bisect import bisect_left
+
+def _size(v):
+	return v[2] if len(v) > 2 else None
+
+def _digest(v):
+	return v[3] if len(v) > 3 else None
+
+def _inode(v):
+	return v[4] if len(v) > 4 else None
+
+def _is_file(v):
+	return isinstance(v[0], bool)
+
+def _is_nested(a, b):
+	"""Whether paths 'a' and 'b' are the same, or one is under the other"""
+	return a == b or b.startswith(a + '/') or a.startswith(b + '/')
+
+def _under(sortedpaths, d):
+	"""Paths in sorted list 'sortedpaths' under directory 'd'"""
+	# '0' comes right after '/'
+	return sortedpaths[bisect_left(sortedpaths, d + '/'):bisect_left(sortedpaths, d + '0')]
+
+def _same_entry(oldv, newv):
+	"""Whether 'newv' is probably 'oldv' at another place"""
+	if not _is_file(oldv) or not _is_file(newv):
+		return oldv[0] == newv[0]
+	if _size(oldv) != newv[2]:
+		return False
+	if _digest(oldv) is not None and _digest(newv) is not None:
+		return _digest(oldv) == _digest(newv)
+	return _inode(oldv) is not None and _inode(oldv) == _inode(newv)
+
+def _match_files(deleted, added, newstate, unverified_min_sz):
+	"""
+	Pair added files with deleted ones of the same inode and size, or of the same
+	contents.
+	returns:
+		{added path: (deleted path, whether the contents are known to be equal)}
+	"""
+	by_inode = {}
+	by_digest = {}
+	for k, v in deleted.items():
+		if not _is_file(v):
+			continue
+		if _inode(v) is not None:
+			by_inode.setdefault((_inode(v), v[2]), []).append(k)
+		if _digest(v) is not None:
+			by_digest.setdefault((v[2], _digest(v)), []).append(k)
+
+	used = set()
+	pairs = {}
+	for k in sorted(added):
+		v = newstate[k]
+		if not _is_file(v):
+			continue
+		match = None
+		for old in by_inode.get((_inode(v), v[2]), ()):
+			if old in used or _is_nested(old, k):
+				continue
+			olddigest = _digest(deleted[old])
+			if olddigest is not None and olddigest == _digest(v):
+				match = (old, True)
+			elif olddigest is None and v[2] >= unverified_min_sz:
+				# probably the same file, but the contents might have changed too:
+				# only worth it if the contents can be delta transferred
+				match = (old, False)
+			if match is not None:
+				break
+		if match is None and _digest(v) is not None:
+			for old in by_digest.get((v[2], _digest(v)), ()):
+				if old not in used and not _is_nested(old, k):
+					match = (old, True)
+					break
+		if match is not None:
+			used.add(match[0])
+			pairs[k] = match
+	return pairs
+
+def _match_dirs(pairs, deleted, added, newstate):
+	"""
+	Find directories that were moved as a whole, judging from the file pairs.
+	returns:
+		list of (old directory, new directory)
+	"""
+	cands = {} # {(old dir, new dir): number of pairs suggesting it}
+	for new, (old, _) in pairs.items():
+		oldparts = old.split('/')
+		newparts = new.split('/')
+		common = 0
+		while common < min(len(oldparts), len(newparts)) and \
+				oldparts[-1 - common] == newparts[-1 - common]:
+			common += 1
+		common = min(common, len(oldparts) - 1, len(newparts) - 1)
+		if not common:
+			# same file name in a different place, or renamed within a directory
+			continue
+		cand = ('/'.join(oldparts[:-common]), '/'.join(newparts[:-common]))
+		if not _is_nested(*cand):
+			cands[cand] = cands.get(cand, 0) + 1
+	if not cands:
+		return []
+
+	deleted_sorted = sorted(deleted)
+	new_sorted = sorted(newstate)
+	accepted = []
+	# outermost first, then the most supported
+	for (olddir, newdir), n in sorted(cands.items(),
+			key=lambda x: (len(x[0][0]), -x[1], x[0])):
+		if any(_is_nested(olddir, a) or _is_nested(olddir, b) or
+				_is_nested(newdir, a) or _is_nested(newdir, b) for a, b in accepted):
+			continue
+		if os.path.lexists(olddir):
+			# not everything has moved
+			continue
+		olds = _under(deleted_sorted, olddir)
+		same = sum(1 for o in olds
+			if _same_entry(deleted[o], newstate.get(newdir + o[len(olddir):], (None,))))
+		if same * 2 <= len(olds):
+			# mostly not moved to 'newdir'
+			continue
+		# the new directory must not exist on the remote yet
+		if newdir in deleted or (newdir in newstate and newdir not in added):
+			continue
+		if _under(deleted_sorted, newdir) or \
+				any(k not in added for k in _under(new_sorted, newdir)):
+			continue
+		accepted.append((olddir, newdir))
+	return accepted
+
+def find_renames(deleted, added, newstate, to_delete, to_update, remote_files,
+		unverified_min_sz):
+	"""
+	Detect files and directories that were moved, so that they can be renamed on
+	the remote instead of being deleted and uploaded again.
+	Files are matched by inode and size (if they are at least
+	'unverified_min_sz' bytes: the contents are then delta transferred in case
+	they also changed), or by content digest.
+	args:
+		deleted: {path: old entry} of the entries that no longer exist
+		added: set of paths that are new
+		newstate, to_delete, to_update, remote_files: as in
+			client._compute_changes. The last three are updated.
+	returns:
+		list of (remote source path, remote destination path) to be renamed, in
+		order, before the other operations
+	"""
+	pairs = _match_files(deleted, added, newstate, unverified_min_sz)
+	if not pairs:
+		return []
+	dirs = _match_dirs(pairs, deleted, added, newstate)
+
+	def _loc(path):
+		"""Location on the remote of an old path, after the directory renames"""
+		for olddir, newdir in dirs:
+			if path.startswith(olddir + '/'):
+				return newdir + path[len(olddir):]
+		return path
+
+	def _reconcile(k, oldv, verified):
+		"""Remote file 'k' has the contents of 'oldv'"""
+		newv = newstate[k]
+		if not verified:
+			remote_files.add(k)
+		elif newv[0] != oldv[0]:
+			# executable state changed: just open and chmod
+			to_update[k] = False
+		else:
+			del to_update[k]
+
+	renames = list(dirs)
+	handled = set() # deleted paths that are not to be deleted as is
+	extra_deletes = []
+	# remote paths holding old contents because of the directory renames
+	moved = {_loc(o): o for o in deleted if _loc(o) != o}
+	for k, (o, verified) in sorted(pairs.items()):
+		src = _loc(o)
+		if src == k:
+			# moved along with its directory: see below
+			continue
+		if k in moved or src in pairs:
+			# renaming would clobber a file that is still needed
+			continue
+		renames.append((src, k))
+		handled.add(o)
+		_reconcile(k, deleted[o], verified)
+
+	for k, o in moved.items():
+		if o in handled:
+			# renamed again to somewhere else
+			continue
+		handled.add(o)
+		oldv = deleted[o]
+		newv = newstate.get(k)
+		if newv is None:
+			extra_deletes.append(k)
+		elif k in pairs and pairs[k][0] == o:
+			_reconcile(k, oldv, pairs[k][1])
+		elif not _is_file(newv):
+			# the symlink is replaced
+			if newv[0] == oldv[0]:
+				del to_update[k]
+		elif _is_file(oldv):
+			# different contents, but it can be used as a delta basis
+			remote_files.add(k)
+		else:
+			# do not write through the old symlink
+			extra_deletes.append(k)
+
+	to_delete[:] = [k for k in to_delete if k not in handled] + extra_deletes
+	return renames
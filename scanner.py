@@ -0,0 +1,239 @@
+import os
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tree import Tree
+
+# kinds of directory listing entries
+LIST_FILE = 0
+LIST_SYMLINK = 1
+LIST_DIR = 2
+# directories modified this shortly (ns) before the scan started might be
+# modified again within the same timestamp: their listings are not cached
+RACY_NS = 2_000_000_000
+
+class ScanStats:
+	def __init__(self):
+		self.dirs = 0
+		self.cached_dirs = 0
+		self.entries = 0
+		self.elapsed = 0.0
+
+	def __str__(self):
+		elapsed = max(self.elapsed, 1e-9)
+		ret = f"{self.dirs} directories, {self.entries} entries in " \
+			f"{self.elapsed:.2f}s ({self.dirs / elapsed:.0f} dirs/s, " \
+			f"{self.entries / elapsed:.0f} entries/s)"
+		if self.cached_dirs:
+			ret += f", {self.cached_dirs} directories unchanged"
+		return ret
+
+class DirCache:
+	"""
+	Directory listings of the previous scan ('old'), and of the current one
+	('new'). Directories that have not changed since the previous scan are not
+	listed again: only their known entries are stat'ed.
+	Listings are dicts of {relative dir path ('.' for the current directory):
+	(inode, mtime, (list of names, bytes of their LIST_* kinds))}
+	"""
+	def __init__(self, old=None):
+		self.old = old or {}
+		self.new = {}
+
+def _make_entry(pth, st, is_symlink):
+	mtime = max(st.st_ctime_ns, st.st_mtime_ns)
+	# contains either a boolean indicating executable stat for regular file
+	# or symlink target for symlink
+	if is_symlink:
+		return (os.readlink(pth), mtime, None, None, None)
+	return (bool(st.st_mode & 0o111), mtime, st.st_size, None, st.st_ino)
+
+def scan_entry(pth, resolve_symlink):
+	"""
+	Stat a single path, as _scan_dir would.
+	returns:
+		entry, or None if 'pth' does not exist or is not a file nor symlink
+		Directories are returned as None too: use scan to scan them.
+	"""
+	try:
+		st = os.stat(pth, follow_symlinks=resolve_symlink)
+		is_symlink = stat.S_ISLNK(st.st_mode)
+		if not is_symlink and not stat.S_ISREG(st.st_mode):
+			return None
+		return _make_entry(pth, st, is_symlink)
+	except OSError:
+		return None
+
+def _scan_dir(path, resolve_symlink, cache=None, racy_after=0, filt=None):
+	"""
+	Scan a single directory, using its listing in 'cache' (DirCache) if it has
+	not changed. Entries excluded by 'filt' (filters.Filter of the parent
+	directory) are skipped.
+	returns:
+		(list of (name, [target, mtime, size, digest, inode]) of the files and
+		symlinks, list of (subdirectory, its parent's filter) to be scanned,
+		number of directory entries, (relative dir path, listing) to be cached
+		or None, whether the cached listing was used)
+		See client.recursive_scan for the entry format.
+	"""
+	relpath = path[2:] or "."
+	key = None
+	if cache is not None:
+		st = os.stat(path)
+		# entries added, removed or renamed update the directory's mtime
+		key = (st.st_ino, max(st.st_ctime_ns, st.st_mtime_ns))
+		cached = cache.old.get(relpath)
+		if cached is not None and cached[:2] == key:
+			ret = _stat_listing(path, cached[2], resolve_symlink, filt, True)
+			if ret is not None:
+				return ret + (len(cached[2][0]), (relpath, cached), True)
+
+	listing = _list_dir(path, resolve_symlink)
+	entries, subdirs = _stat_listing(path, listing, resolve_symlink, filt, False)
+	dirinfo = None
+	if key is not None and key[1] < racy_after:
+		dirinfo = (relpath, key + (listing,))
+	return entries, subdirs, len(listing[0]), dirinfo, False
+
+def _list_dir(path, resolve_symlink):
+	"""
+	returns:
+		(list of names, bytes of their LIST_* kinds) of the files and
+		directories in 'path'
+	"""
+	names = []
+	kinds = bytearray()
+	for de in os.scandir(path):
+		if de.is_symlink() and not resolve_symlink:
+			# include (but do not traverse) symlinks
+			kind = LIST_SYMLINK
+		elif de.is_dir():
+			kind = LIST_DIR
+		elif de.is_file():
+			kind = LIST_FILE
+		else:
+			# ignore non-file
+			continue
+		names.append(de.name)
+		kinds.append(kind)
+	return names, bytes(kinds)
+
+def _stat_listing(path, listing, resolve_symlink, filt, strict):
+	"""
+	Stat the entries of a directory listing that are not excluded.
+	returns:
+		(entries, subdirectories) as _scan_dir. If 'strict', returns None if
+		the listing turns out to be outdated (e.g. a file was replaced by a
+		directory). Otherwise, such entries are skipped.
+	"""
+	names, kinds = listing
+	if filt is not None:
+		filt = filt.for_dir(path[2:] or ".", filt.ignore_file in names)
+	entries = []
+	subdirs = []
+	prefix = path + "/"
+	for name, kind in zip(names, kinds):
+		full = prefix + name
+		pth = full[2:] # remove leading './'
+		if filt is not None and filt.excluded(pth, kind == LIST_DIR):
+			continue
+		try:
+			st = os.stat(full, follow_symlinks=resolve_symlink)
+		except OSError:
+			# removed in the meantime
+			if strict:
+				return None
+			continue
+		if kind == LIST_DIR:
+			if stat.S_ISDIR(st.st_mode):
+				subdirs.append((full, filt))
+			elif strict:
+				return None
+			continue
+		is_symlink = kind == LIST_SYMLINK
+		if stat.S_ISLNK(st.st_mode) if is_symlink else stat.S_ISREG(st.st_mode):
+			entries.append((name, _make_entry(pth, st, is_symlink)))
+		elif strict:
+			return None
+	return entries, subdirs
+
+def _dir_sort_key(subdir):
+	# directories are walked in the order of their paths followed by '/', which
+	# is how they sort among the files (see statefile.sort_key)
+	return subdir[0] + '/'
+
+def iter_scan(resolve_symlink, workers=1, root=".", cache=None, filt=None,
+		stats=None):
+	"""
+	Scan as scan() does, yielding the entries of each directory as soon as it is
+	scanned. Directories come parents first, in the order of their paths
+	followed by '/'. If 'workers' is more than 1, the directories found so far
+	are scanned ahead in parallel. 'stats' (ScanStats) is updated as the scan
+	goes.
+	yields:
+		(relative dir path ('' for the current directory), list of (name, entry)
+		of its files and symlinks)
+	"""
+	stats = stats if stats is not None else ScanStats()
+	start = time.monotonic()
+	racy_after = time.time_ns() - RACY_NS
+
+	def _collect(scanres):
+		entries, subdirs, count, dirinfo, cached = scanres
+		stats.dirs += 1
+		stats.cached_dirs += cached
+		stats.entries += count
+		if dirinfo is not None:
+			cache.new[dirinfo[0]] = dirinfo[1]
+		subdirs.sort(key=_dir_sort_key)
+		return entries, subdirs
+
+	if root != ".":
+		root = os.path.join(".", root)
+	if workers <= 1:
+		todo = [(root, filt)]
+		while todo:
+			d, f = todo.pop()
+			entries, subdirs = _collect(_scan_dir(d, resolve_symlink, cache,
+				racy_after, f))
+			todo.extend(reversed(subdirs))
+			stats.elapsed = time.monotonic() - start
+			yield d[2:], entries
+	else:
+		pool = ThreadPoolExecutor(max_workers=workers)
+		try:
+			# [(dir, future of its _scan_dir)], the next one last
+			todo = [(root, pool.submit(_scan_dir, root, resolve_symlink, cache,
+				racy_after, filt))]
+			while todo:
+				d, fut = todo.pop()
+				entries, subdirs = _collect(fut.result())
+				# submitted in walk order, so that the next ones are done first
+				todo.extend(reversed([(sd, pool.submit(_scan_dir, sd, resolve_symlink,
+					cache, racy_after, f)) for sd, f in subdirs]))
+				stats.elapsed = time.monotonic() - start
+				yield d[2:], entries
+		finally:
+			# e.g. the caller stopped early
+			pool.shutdown(cancel_futures=True)
+	stats.elapsed = time.monotonic() - start
+
+def scan(resolve_symlink, workers=1, root=".", cache=None, filt=None):
+	"""
+	Scan the current directory recursively, or only the subdirectory 'root'
+	(relative path name) of it.
+	If 'workers' is more than 1, directories are listed and stat'ed in parallel
+	using a pool of that many threads. The result is the same either way.
+	If 'cache' (DirCache) is given, unchanged directories are not listed, and
+	the listings of this scan are put in 'cache.new'.
+	If 'filt' (filters.Filter of the parent of 'root') is given, excluded files
+	are skipped and excluded directories are not entered.
+	returns:
+		(tree.Tree of {relative path name: entry}, ScanStats)
+	"""
+	result = Tree()
+	stats = ScanStats()
+	for d, entries in iter_scan(resolve_symlink, workers, root, cache, filt,
+			stats):
+		result.add_dir(d, entries)
+	return result, stats
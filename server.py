@@ -1,80 +1,226 @@
 import sys
 import os
+import json
 import struct
+import signal
+import resource
+from errno import EIO, EINVAL, ENOSYS, EOPNOTSUPP, EXDEV
+import stat
+import tempfile
+import queue
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import shared
+import delta
 from PythonLib.MyBytesIO import BIO
 
-_fin = sys.stdin.buffer.raw
-_fout = sys.stdout.buffer.raw
-
-MAX_OFD = 200 # max open file handle
+# max open file handles of bulk operations. It is lowered to fit RLIMIT_NOFILE,
+# see _max_ofd.
+MAX_OFD = 1024
+MIN_OFD = 16
+# max number of directory fds kept open to create files relative to their
+# directory. They are opened in addition to the MAX_OFD file handles.
+DIR_FD_CACHE = 64
+# fds used for anything else: stdio, files being copied or hashed, etc.
+FD_RESERVE = DIR_FD_CACHE + 64
+MAX_BULK_WINDOWS = 8 # max number of bulk operations that can be open at once
+# I/O size of copies
 BUFF_SZ = 1_048_576
+# message and writer buffers are up to this size, if enough memory is available
+MAX_BUFF_SZ = 16 * 1_048_576
+# fraction of the available memory the message and writer buffers can take
+BUFF_MEM_FRACTION = 1 / 16
+WRITER_THREADS = 4
+# number of message sized buffers for chunks received but not written yet
+WRITER_BUFFS = 8
+# threads hashing files listed by MANIFEST, and threads handling the requests
+# that read whole files (see _Server._reply_in_background)
+HASH_THREADS = 4
+# max number of entries in a MANIFEST_RESP, so that pages arrive steadily even
+# when hashing large files
+MANIFEST_PAGE_ENTRIES = 4096
+# the progress of resumable uploads is saved every this many bytes, in
+# addition to when the file is closed
+JOURNAL_INTERVAL = 64 * 1_048_576
+# kind, size, mtime of MANIFEST_RESP entries
+_MANIFEST_ENTRY = struct.Struct("=BQq")
 
 class _Server:
-	def __init__(self):
+	def __init__(self, fin, fout):
+		self._fin = fin
+		self._fout = fout
 		self._handler = {
 			shared.MsgType.VERSION: self._handler_version,
 			shared.MsgType.REQ_LIMIT: self._handler_req_limit,
 			shared.MsgType.CHDIR: self._handler_chdir,
 			shared.MsgType.BULKOP_BEGIN: self._handler_bulkop_begin,
 			shared.MsgType.BULKOP_CLOSE: self._handler_bulkop_close,
+			shared.MsgType.DELTA_SIGS: self._handler_delta_sigs,
+			shared.MsgType.DELTA: self._handler_delta,
+			shared.MsgType.MANIFEST: self._handler_manifest,
+			shared.MsgType.PARTIAL_QUERY: self._handler_partial_query,
+		}
+		# handlers that read their own arguments from the input stream.
+		# They are given the argument length.
+		self._streamhandler = {
 			shared.MsgType.CHUNK: self._handler_chunk,
+			shared.MsgType.CHUNK_COMPRESSED: self._handler_chunk_compressed,
+			shared.MsgType.CHUNK_STREAM: self._handler_chunk_stream,
 		}
 		self._ophandler = {
 			shared.OpType.WRITE: self._handler_openwrite,
 			shared.OpType.SYMLINK: self._handler_create_symlink,
+			shared.OpType.WRITE_INLINE: self._handler_write_inline,
+			shared.OpType.RENAME: self._handler_rename,
+			shared.OpType.COPY: self._handler_copy,
+			shared.OpType.MKDIR: self._handler_mkdir,
 			shared.OpType.DELETE: self._handler_delete,
 		}
-		# pay attention to these size if adjusting above limits
-		self._buff = BIO(BUFF_SZ)
-		self._replybuff = BIO(BUFF_SZ // 2)
+		self._maxofd = _max_ofd()
+		# the message buffer, the reply buffer (half) and the writer buffers
+		buffsz = shared.fit_buffer_size(WRITER_BUFFS + 2, MAX_BUFF_SZ,
+			BUFF_MEM_FRACTION)
+		self._buff = BIO(buffsz)
+		self._replybuff = BIO(buffsz // 2)
 		self._replybuffman = shared.BuffManager(self._replybuff)
-		self._bulkopactive = False
-		self._bulkofd = {} # map fd: [file object, truncation required, write errno]
+		# each bulk operation window is a dict of {fd: _WriteHandle}. The oldest
+		# window is closed first.
+		self._bulkwindows = deque()
+		self._bulkofd = {} # map fd: _WriteHandle, for all open windows
+		# whether data can be moved from input to files using splice
+		self._splice = hasattr(os, 'splice')
+		# chunks are written in the background while the next ones are received
+		self._writers = _WriterPool(WRITER_THREADS, WRITER_BUFFS, buffsz)
+		# listing in progress for MANIFEST
+		self._manifest = None
+		self._dirfds = _DirFds(DIR_FD_CACHE)
+		# requests that read whole files are handled in the background so that
+		# chunks keep being received meanwhile. Replies are sent in the order of
+		# the requests: [reply or None if not ready] of the background requests,
+		# and of the requests after them.
+		self._bgpool = ThreadPoolExecutor(HASH_THREADS)
+		self._replylock = threading.Lock()
+		self._pendingreplies = deque()
+
+	def abort(self):
+		"""Discard files that are still open, e.g. after the client disconnected"""
+		self._bgpool.shutdown()
+		self._writers.close()
+		if self._manifest is not None:
+			self._manifest.close()
+			self._manifest = None
+		self._dirfds.clear()
+		for wh in self._bulkofd.values():
+			wh.errno = wh.errno or EIO
+			wh.close()
+		self._bulkofd.clear()
+		self._bulkwindows.clear()
 
 	def main(self):
 		while True:
-			cmd = shared.read_all(_fin, 1)
+			cmd = shared.read_all(self._fin, 1)
 			if not cmd:
 				# EOF (e.g. client terminated prematurely)
 				break
 			cmd = shared.MsgType(cmd[0])
-			arglen = struct.unpack("=I", shared.read_all(_fin, 4))[0]
+			arglen = struct.unpack("=I", shared.read_all(self._fin, 4))[0]
+			if cmd in self._streamhandler:
+				self._streamhandler[cmd](arglen)
+				continue
 			if arglen > self._buff.capacity():
 				raise ValueError(f"Input size of {arglen} bytes is too big")
 			self._buff.set_limit(arglen)
-			rd = shared.readinto_all(_fin, self._buff.getbuffer())
+			rd = shared.readinto_all(self._fin, self._buff.getbuffer())
 			if rd != arglen:
 				raise ValueError(f"Got {rd} bytes expected {arglen} bytes")
 			self._buff.seek(0)
 			self._replybuff.seek(0)
 			if cmd == shared.MsgType.EXIT:
+				self._handler_exit()
 				break
 			self._handler[cmd]()
 
+	def _send_reply(self):
+		"""Send the reply in self._replybuffman, after the pending ones"""
+		with self._replylock:
+			if self._pendingreplies:
+				self._pendingreplies.append([bytes(self._replybuffman.getbuffer())])
+			else:
+				self._fout.write(self._replybuffman.getbuffer())
+
+	def _reply_in_background(self, func, *args):
+		"""
+		Handle a request by running func(*args) in the background. It returns the
+		encoded reply, and must not raise: the client would wait for the reply
+		forever.
+		returns:
+			future of func()
+		"""
+		slot = [None]
+		with self._replylock:
+			self._pendingreplies.append(slot)
+		fut = self._bgpool.submit(func, *args)
+		fut.add_done_callback(lambda f: self._complete_reply(slot, f))
+		return fut
+
+	def _complete_reply(self, slot, fut):
+		"""Send the reply of a background request, and the ones held behind it"""
+		with self._replylock:
+			slot[0] = fut.result()
+			try:
+				while self._pendingreplies and self._pendingreplies[0][0] is not None:
+					shared.write_all(self._fout, self._pendingreplies.popleft()[0])
+			except OSError:
+				# client disconnected: the main loop sees it too
+				self._pendingreplies.clear()
+
 	def _handler_version(self):
 		"""
 		args: None
 		returns:
 			uint32_t version
+			uint32_t supported features (shared.Feature)
 		"""
 		self._replybuffman.begin_msg(shared.MsgType.VERSION_RESP)
-		self._replybuffman.append_uint(1) # version 1
+		self._replybuffman.append_uint(shared.PROTOCOL_VERSION)
+		self._replybuffman.append_uint(shared.Feature.DELTA |
+			shared.Feature.WRITE_INLINE | shared.Feature.CHUNK_STREAM |
+			shared.Feature.EXIT_STATS | shared.Feature.RENAME | shared.Feature.COPY |
+			shared.Feature.MANIFEST | shared.Feature.MKDIR | shared.Feature.RESUME |
+			shared.available_codecs())
+		self._replybuffman.end_msg()
+		self._send_reply()
+
+	def _handler_exit(self):
+		"""
+		Sent before the connection is closed.
+		args: None
+		returns:
+			uint64_t peak memory use of the server process (KiB). With 'server
+			--listen', it includes the earlier sessions.
+		"""
+		self._replybuffman.begin_msg(shared.MsgType.EXIT_RESP)
+		self._replybuffman.append_ulonglong(
+			resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
 		self._replybuffman.end_msg()
-		_fout.write(self._replybuffman.getbuffer())
+		self._send_reply()
 
 	def _handler_req_limit(self):
 		"""
 		args: None
 		returns:
-			uint32_t max outstanding write requests in bulkop
+			uint32_t max outstanding write requests in all open bulkops
 			uint32_t max arg length
+			uint32_t max number of open bulkops
+		The first two depend on the resources of the host.
 		"""
 		self._replybuffman.begin_msg(shared.MsgType.LIMIT_RESP)
-		self._replybuffman.append_uint(MAX_OFD)
+		self._replybuffman.append_uint(self._maxofd)
 		self._replybuffman.append_uint(self._buff.capacity())
+		self._replybuffman.append_uint(MAX_BULK_WINDOWS)
 		self._replybuffman.end_msg()
-		_fout.write(self._replybuffman.getbuffer())
+		self._send_reply()
 
 	def _handler_chdir(self):
 		"""
@@ -84,6 +230,8 @@ class _Server:
 			uint16_t errno
 		"""
 		fn = self._buff.read().decode('utf8')
+		# cached directories are relative to the previous directory
+		self._dirfds.clear()
 		try:
 			try:
 				os.chdir(fn)
@@ -97,17 +245,16 @@ class _Server:
 		self._replybuffman.begin_msg(shared.MsgType.GEN_RESULT)
 		self._replybuffman.append_huint(errno)
 		self._replybuffman.end_msg()
-		_fout.write(self._replybuffman.getbuffer())
+		self._send_reply()
 
 	def _handler_bulkop_begin(self):
 		"""
 		args: (list of openwrite/delete requests)
 		returns: (list of openwrite/delete responses)
 		"""
-		if self._bulkopactive:
-			raise RuntimeError("Previous bulk operations have not been finished")
-		self._bulkopactive = True
-		self._bulkofd.clear()
+		if len(self._bulkwindows) >= MAX_BULK_WINDOWS:
+			raise RuntimeError("Too many bulk operations have not been finished")
+		self._bulkwindows.append({})
 
 		self._replybuffman.begin_msg(shared.MsgType.BULKOP_RESULTS)
 
@@ -122,57 +269,244 @@ class _Server:
 			self._ophandler[optype]()
 
 		self._replybuffman.end_msg()
-		_fout.write(self._replybuffman.getbuffer())
+		self._send_reply()
 
 	def _handler_bulkop_close(self):
 		"""
+		Close files opened by the oldest bulk operation.
 		args: None
 		returns:
 			list of:
 				int32_t fd
 				uint16_t errno
 		"""
-		if not self._bulkopactive:
+		if not self._bulkwindows:
 			raise RuntimeError("No previous bulk operation have been done!")
-		self._bulkopactive = False
+		window = self._bulkwindows.popleft()
+		# write errors are only known once the pending writes are done
+		self._writers.flush()
 		self._replybuffman.begin_msg(shared.MsgType.BULKOP_CLOSE_RESULTS)
-		for fd, v in self._bulkofd.items():
-			fh, _, errno = v
-			fh.close()
+		for fd, wh in window.items():
+			del self._bulkofd[fd]
+			if wh.bgjob is not None:
+				# the client waits for the reply before closing: only if misbehaving
+				wh.bgjob.result()
+			errno = wh.close()
 			self._replybuffman.append_uint(fd)
 			self._replybuffman.append_hsint(errno)
 		self._replybuffman.end_msg()
-		_fout.write(self._replybuffman.getbuffer())
+		self._send_reply()
+
+	def _begin_chunk(self, arglen, hdrlen):
+		"""
+		Read the header of a CHUNK* message and receive its data into a writer
+		buffer.
+		returns:
+			(_WriteHandle, header, buffer, data length)
+		"""
+		if not self._bulkwindows:
+			raise ValueError("Writing chunks when no open file")
+		datalen = arglen - hdrlen
+		if datalen < 0 or datalen > self._buff.capacity():
+			raise ValueError(f"Invalid chunk size of {arglen} bytes")
+		hdr = shared.read_all(self._fin, hdrlen)
+		if len(hdr) != hdrlen:
+			raise ValueError("Premature end of input")
+		fd = struct.unpack_from("=i", hdr)[0]
+		buf = self._writers.get_buffer()
+		rd = shared.readinto_all(self._fin, memoryview(buf)[:datalen])
+		if rd != datalen:
+			self._writers.put_buffer(buf)
+			raise ValueError(f"Got {rd} bytes expected {datalen} bytes")
+		return self._bulkofd[fd], hdr, buf, datalen
 
-	def _handler_chunk(self):
+	def _handler_chunk(self, arglen):
 		"""
+		The data is written by the writer pool.
 		args:
 			uint32_t fd
+			uint64_t offset
 			bytearray datalen
 		returns: None
 		"""
-		if not self._bulkopactive:
+		wh, hdr, buf, datalen = self._begin_chunk(arglen, 12)
+		offset = struct.unpack_from("=Q", hdr, 4)[0]
+		self._writers.submit(wh, offset, buf, datalen)
+
+	def _handler_chunk_compressed(self, arglen):
+		"""
+		The data is decompressed and written by the writer pool.
+		args:
+			uint32_t fd
+			uint64_t offset (of the uncompressed data)
+			uint8_t codec (shared.Codec)
+			bytearray compressed data
+		returns: None
+		"""
+		wh, hdr, buf, datalen = self._begin_chunk(arglen, 13)
+		offset = struct.unpack_from("=Q", hdr, 4)[0]
+		codec = shared.Codec(hdr[12])
+		self._writers.submit(wh, offset, buf, datalen, codec)
+
+	def _handler_chunk_stream(self, arglen):
+		"""
+		Same as CHUNK, but the data is not buffered: it is spliced directly from
+		the input into the file if possible.
+		args:
+			uint32_t fd
+			uint64_t offset
+			bytearray data
+		returns: None
+		"""
+		if not self._bulkwindows:
 			raise ValueError("Writing chunks when no open file")
+		fd, offset = struct.unpack("=iQ", shared.read_all(self._fin, 12))
+		wh = self._bulkofd[fd]
+		remaining = arglen - 12
+		wh.extend(offset + remaining)
+		while remaining and self._splice and not wh.errno:
+			try:
+				moved = os.splice(self._fin.fileno(), wh.fh.fileno(), remaining,
+					offset_dst=offset)
+			except OSError as ex:
+				if ex.errno in (EINVAL, ENOSYS):
+					# e.g. input is not a pipe: use buffered copy from now on
+					self._splice = False
+					break
+				wh.errno = ex.errno
+				break
+			if not moved:
+				raise ValueError("Premature end of input")
+			if wh.partial is not None:
+				wh.partial.advance(offset, moved)
+			remaining -= moved
+			offset += moved
+
+		# buffered copy by the writer pool (which discards it on write error)
+		while remaining:
+			datalen = min(remaining, self._buff.capacity())
+			buf = self._writers.get_buffer()
+			rd = shared.readinto_all(self._fin, memoryview(buf)[:datalen])
+			if rd != datalen:
+				self._writers.put_buffer(buf)
+				raise ValueError("Premature end of input")
+			self._writers.submit(wh, offset, buf, datalen)
+			remaining -= rd
+			offset += rd
+
+	def _handler_delta_sigs(self):
+		"""
+		Compute block signatures of the current contents of an opened file.
+		args:
+			int32_t fd
+		returns:
+			uint16_t errno
+			uint32_t block size
+			uint64_t basis file size
+			uint32_t block count
+			list of:
+				uint32_t weak checksum
+				bytearray(16) strong checksum
+		"""
+		if not self._bulkwindows:
+			raise ValueError("Requesting signatures when no open file")
 		fd = struct.unpack("=i", self._buff.read(4))[0]
-		# [file object, truncation needed, errno (from writing)]
-		arr = self._bulkofd[fd]
-		fh = arr[0]
-
-		# truncate needed?
-		if not arr[1]:
-			arr[1] = True
-			fh.truncate(0)
-			fh.seek(0)
-
-		# error check
-		if arr[2]:
-			# previous error occured: skip
-			return
+		wh = self._bulkofd[fd]
+		maxblocks = (self._replybuff.capacity() - 32) // delta.SIG_ENTRY_SZ
+		# reading the whole file takes a while: it is done in the background
+		wh.bgjob = self._reply_in_background(_delta_sigs, wh, maxblocks)
 
+	def _handler_delta(self):
+		"""
+		Reconstruct file from the basis (as of DELTA_SIGS) and the given delta.
+		args:
+			uint32_t fd
+			list of either:
+				uint8_t 0 (literal)
+				uint32_t length
+				bytearray data
+			or:
+				uint8_t 1 (block reference)
+				uint32_t starting block index
+				uint32_t block count
+		returns: None
+		"""
+		if not self._bulkwindows:
+			raise ValueError("Writing delta when no open file")
+		fd = struct.unpack("=i", self._buff.read(4))[0]
+		wh = self._bulkofd[fd]
+		if wh.errno:
+			return
 		try:
-			fh.write(self._buff.read())
+			wh.open_delta_output()
+			while True:
+				kind = self._buff.read(1)
+				if not kind:
+					break
+				if kind[0] == delta.LITERAL:
+					ln = struct.unpack("=I", self._buff.read(4))[0]
+					shared.write_all(wh.delta, self._buff.read(ln))
+				else:
+					idx, count = struct.unpack("=II", self._buff.read(8))
+					wh.copy_basis_blocks(idx, count)
 		except OSError as ex:
-			arr[2] = ex.errno
+			wh.errno = ex.errno
+
+	def _handler_partial_query(self):
+		"""
+		Query how much of a file opened with WriteFlag.RESUME was received by
+		previous sessions. The client checks the digest of it against its file:
+		only the contents from there on need to be sent then. The digest is
+		computed in the background, see _reply_in_background.
+		args:
+			int32_t fd
+		returns:
+			uint64_t length
+			bytearray(16) digest of the first 'length' bytes
+		"""
+		if not self._bulkwindows:
+			raise ValueError("Querying partial upload when no open file")
+		fd = struct.unpack("=i", self._buff.read(4))[0]
+		wh = self._bulkofd[fd]
+		wh.bgjob = self._reply_in_background(_partial_resp, wh)
+
+	def _handler_manifest(self):
+		"""
+		List the files and symlinks under the current directory, one page at a
+		time. A new listing is started unless CONTINUE is given. The last page
+		has 'done' set. Files of a page are hashed in parallel.
+		args:
+			uint8_t flags (shared.ManifestFlag)
+		returns:
+			uint8_t done
+			list of:
+				uint8_t kind (shared.EntryKind)
+				uint64_t size
+				int64_t mtime (ns)
+				uint16_t fn_len
+				string fn
+				uint16_t data_len
+				bytearray data (symlink target, or the file's digest if requested and
+					the file is readable)
+		"""
+		flags = shared.ManifestFlag(self._buff.read(1)[0])
+		if shared.ManifestFlag.CONTINUE not in flags:
+			if self._manifest is not None:
+				self._manifest.close()
+			self._manifest = _ManifestWalk(shared.ManifestFlag.DIGESTS in flags)
+		page = []
+		done = True
+		if self._manifest is not None:
+			page, done = self._manifest.next_page(self._replybuff.capacity() - 16)
+			if done:
+				self._manifest.close()
+				self._manifest = None
+		self._replybuffman.begin_msg(shared.MsgType.MANIFEST_RESP)
+		self._replybuffman.append_byte(int(done))
+		for entry in page:
+			self._replybuffman.append_bytes(entry)
+		self._replybuffman.end_msg()
+		self._send_reply()
 
 	def _handler_delete(self):
 		"""
@@ -185,7 +519,7 @@ class _Server:
 		fn = self._read_string()
 		errno = 0
 		try:
-			os.unlink(fn)
+			self._in_dir(fn, lambda dfd, name: os.unlink(name, dir_fd=dfd), False)
 		except FileNotFoundError:
 			# not a problem! the file is already gone anyway!
 			pass
@@ -193,6 +527,72 @@ class _Server:
 			errno = ex.errno
 		self._replybuffman.append_huint(errno)
 
+	def _handler_rename(self):
+		"""
+		Rename a file or a directory. Existing files in the destination are
+		replaced.
+		args:
+			uint16_t src_len
+			string src
+			uint16_t dst_len
+			string dst
+		returns:
+			uint16_t errno
+		"""
+		src = self._read_string()
+		dst = self._read_string()
+		try:
+			_file_creation(dst, lambda: os.rename(src, dst))
+			errno = 0
+		except OSError as ex:
+			errno = ex.errno
+		# cached directories might have been moved
+		self._dirfds.clear()
+		self._replybuffman.append_huint(errno)
+
+	def _handler_copy(self):
+		"""
+		Create or replace a file with a copy of an existing one. The copy is
+		made by the filesystem (e.g. reflinked) where supported.
+		args:
+			uint8_t flags (shared.CopyFlag)
+			uint16_t src_len
+			string src
+			uint16_t dst_len
+			string dst
+		returns:
+			uint16_t errno
+		"""
+		flags = shared.CopyFlag(self._buff.read(1)[0])
+		src = self._read_string()
+		dst = self._read_string()
+		try:
+			_file_creation(dst, lambda: _copy_file(src, dst,
+				shared.CopyFlag.EXECUTABLE in flags, shared.CopyFlag.HARDLINK in flags))
+			errno = 0
+		except OSError as ex:
+			errno = ex.errno
+		self._replybuffman.append_huint(errno)
+
+	def _handler_mkdir(self):
+		"""
+		Create a directory. Its parent is expected to exist (directories are
+		sent parents first), but is created too if missing. Existing
+		directories are not an error.
+		args:
+			uint16_t fn_len
+			string fn
+		returns:
+			uint16_t errno
+		"""
+		fn = self._read_string()
+		try:
+			self._in_dir(fn, _mkdir)
+			errno = 0
+		except OSError as ex:
+			errno = ex.errno
+		self._replybuffman.append_huint(errno)
+
 	def _handler_create_symlink(self):
 		"""
 		args:
@@ -206,7 +606,7 @@ class _Server:
 		fn = self._read_string()
 		target = self._read_string()
 		try:
-			_file_creation(fn, lambda: os.symlink(target, fn))
+			self._in_dir(fn, lambda dfd, name: _create_symlink(target, name, dfd))
 			errno = 0
 		except OSError as ex:
 			errno = ex.errno
@@ -215,21 +615,35 @@ class _Server:
 	def _handler_openwrite(self):
 		"""
 		args:
-			uint8_t executable (0 = regular, 1 = executable)
+			uint8_t flags (shared.WriteFlag)
+			uint64_t expected file size
 			uint16_t fn_len
 			string fn
+			bytearray(16) digest of the contents (only if flags has RESUME)
 		returns:
 			int32_t fd
 			uint16_t errno
 		"""
-		executable = bool(self._buff.read(1)[0])
+		flags = shared.WriteFlag(self._buff.read(1)[0])
+		size = struct.unpack("=Q", self._buff.read(8))[0]
 		fn = self._read_string()
+		partial = None
+		if shared.WriteFlag.RESUME in flags:
+			partial = _Partial(fn, size, self._buff.read(shared.DIGEST_LEN))
 		fh = [None]
 
-		def _handler():
-			fh[0] = open(fn, 'ab', buffering=0)
+		def _handler(dfd, name):
+			if partial is not None:
+				# the target is replaced once complete: no need to unshare it
+				fh[0] = partial.open()
+				return
+			_unshare(dfd, name, fn, bool(flags & (shared.WriteFlag.NO_CONTENT |
+				shared.WriteFlag.DELTA)))
+			# not opened in append mode as splice does not support that
+			fh[0] = open(os.open(name, os.O_WRONLY | os.O_CREAT, 0o666, dir_fd=dfd),
+				'wb', buffering=0)
 		try:
-			_file_creation(fn, _handler)
+			self._in_dir(fn, _handler)
 			errno = 0
 		except OSError as ex:
 			errno = ex.errno
@@ -240,12 +654,68 @@ class _Server:
 
 		if fh:
 			# OK
-			# store (file object, truncated?, errno)
-			self._bulkofd[fh.fileno()] = [fh, False, 0]
+			wh = _WriteHandle(fn, fh, flags, partial)
+			self._bulkofd[fh.fileno()] = wh
+			self._bulkwindows[-1][fh.fileno()] = wh
 			try:
-				_set_file_executable(fh, executable)
+				_set_file_executable(fh, shared.WriteFlag.EXECUTABLE in flags)
 			except OSError as ex:
 				print(f"Error setting mode for {fn}: {ex}", file=sys.stderr)
+			if not flags & (shared.WriteFlag.NO_CONTENT | shared.WriteFlag.DELTA) and \
+					not wh.end:
+				try:
+					_preallocate(fh, size)
+				except OSError as ex:
+					wh.errno = ex.errno
+
+	def _handler_write_inline(self):
+		"""
+		Create or replace a file with the given contents.
+		args:
+			uint8_t executable (0 = regular, 1 = executable)
+			uint16_t fn_len
+			string fn
+			uint32_t data_len
+			bytearray data
+		returns:
+			uint16_t errno
+		"""
+		executable = bool(self._buff.read(1)[0])
+		fn = self._read_string()
+		datalen = struct.unpack("=I", self._buff.read(4))[0]
+		data = self._buff.read(datalen)
+		fh = [None]
+
+		def _handler(dfd, name):
+			_unshare(dfd, name, fn, False)
+			fh[0] = open(os.open(name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666,
+				dir_fd=dfd), 'wb', buffering=0)
+		try:
+			self._in_dir(fn, _handler)
+			with fh[0]:
+				shared.write_all(fh[0], data)
+				_set_file_executable(fh[0], executable)
+			errno = 0
+		except OSError as ex:
+			errno = ex.errno
+		self._replybuffman.append_huint(errno)
+
+	def _in_dir(self, fn, func, create_dirs=True):
+		"""
+		Perform func(directory fd, name) on path 'fn', with the cached fd of its
+		directory (None for the current directory). If 'create_dirs' is True,
+		the directory is created if missing, and func() is retried.
+		"""
+		parent, name = os.path.split(fn)
+		try:
+			return func(self._dirfds.get(parent), name)
+		except FileNotFoundError:
+			if not create_dirs or not parent:
+				raise
+		# the directory, or a cached one, might have been removed meanwhile
+		self._dirfds.clear()
+		os.makedirs(parent, exist_ok=True)
+		return func(self._dirfds.get(parent), name)
 
 	def _read_string(self):
 		"""
@@ -255,6 +725,402 @@ class _Server:
 		ret = self._buff.read(retlen).decode('utf8')
 		return ret
 
+class _WriterPool:
+	"""
+	Threads that write received chunks to their files. Chunks of the same fd are
+	written by the same thread, in the order they were submitted.
+	"""
+	def __init__(self, threads, buffs, buffsz):
+		# receiving blocks when all buffers are waiting to be written. They are
+		# allocated as needed, as most sessions only need a few.
+		self._free = queue.Queue()
+		self._unallocated = buffs
+		self._buffsz = buffsz
+		self._queues = [queue.Queue() for _ in range(threads)]
+		self._threads = [threading.Thread(target=self._main, args=(q,), daemon=True)
+			for q in self._queues]
+		for t in self._threads:
+			t.start()
+
+	def get_buffer(self):
+		if self._unallocated and self._free.empty():
+			self._unallocated -= 1
+			return bytearray(self._buffsz)
+		return self._free.get()
+
+	def put_buffer(self, buf):
+		self._free.put(buf)
+
+	def submit(self, wh, offset, buf, datalen, codec=shared.Codec.NONE):
+		"""Write 'datalen' bytes of 'buf' to 'wh'. 'buf' is returned to the pool."""
+		self._queues[wh.fh.fileno() % len(self._queues)].put(
+			(wh, offset, buf, datalen, codec))
+
+	def flush(self):
+		"""Wait until all submitted chunks are written"""
+		for q in self._queues:
+			q.join()
+
+	def close(self):
+		for q in self._queues:
+			q.put(None)
+		for t in self._threads:
+			t.join()
+
+	def _main(self, q):
+		while True:
+			job = q.get()
+			if job is None:
+				q.task_done()
+				return
+			wh, offset, buf, datalen, codec = job
+			try:
+				_write_chunk(wh, offset, memoryview(buf)[:datalen], codec)
+			except Exception as ex:
+				print(f"Error writing chunk for {wh.fn}: {ex!r}", file=sys.stderr)
+				wh.errno = wh.errno or EIO
+			finally:
+				self._free.put(buf)
+				q.task_done()
+
+class _DirFds:
+	"""
+	LRU cache of fds of directories under the current directory, so that paths
+	are resolved relative to their directory instead of from the current
+	directory each time. Directories are opened relative to their (cached)
+	parent as well. At most 'size' fds are kept open.
+	"""
+	def __init__(self, size):
+		self._size = size
+		self._fds = OrderedDict() # {relative dir path: fd}
+
+	def get(self, d):
+		"""
+		returns:
+			fd of directory 'd', or None if it is the current directory
+		raises:
+			OSError if the directory cannot be opened
+		"""
+		if not d:
+			return None
+		fd = self._fds.get(d)
+		if fd is not None:
+			self._fds.move_to_end(d)
+			return fd
+		parent, name = os.path.split(d)
+		fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY, dir_fd=self.get(parent))
+		self._fds[d] = fd
+		if len(self._fds) > self._size:
+			os.close(self._fds.popitem(last=False)[1])
+		return fd
+
+	def clear(self):
+		for fd in self._fds.values():
+			os.close(fd)
+		self._fds.clear()
+
+class _ManifestWalk:
+	"""Listing of the current directory in progress, for MANIFEST"""
+	def __init__(self, digests):
+		self._todo = ["."] # directories not listed yet
+		self._listed = deque() # (fn, shared.EntryKind, size, mtime, target) not sent
+		self._pool = ThreadPoolExecutor(HASH_THREADS) if digests else None
+
+	def close(self):
+		if self._pool is not None:
+			self._pool.shutdown()
+			self._pool = None
+
+	def _list_next_dir(self):
+		"""returns False if there are no more directories to be listed"""
+		if not self._todo:
+			return False
+		d = self._todo.pop()
+		try:
+			it = os.scandir(d)
+		except OSError:
+			# removed in the meantime, or not accessible
+			return True
+		with it:
+			for de in it:
+				fn = de.name if d == "." else f"{d}/{de.name}"
+				try:
+					if de.is_dir(follow_symlinks=False):
+						self._todo.append(fn)
+						continue
+					st = de.stat(follow_symlinks=False)
+					target = None
+					if stat.S_ISLNK(st.st_mode):
+						kind = shared.EntryKind.SYMLINK
+						target = os.readlink(fn)
+					elif stat.S_ISREG(st.st_mode) and \
+							not de.name.endswith((".s2rtmp", ".s2rpart", ".s2rpart.json")):
+						kind = shared.EntryKind.EXECUTABLE if st.st_mode & 0o100 \
+							else shared.EntryKind.FILE
+					else:
+						continue
+				except OSError:
+					continue
+				self._listed.append((fn, kind, st.st_size, st.st_mtime_ns, target))
+		return True
+
+	def next_page(self, room):
+		"""
+		returns:
+			(list of encoded MANIFEST_RESP entries of at most 'room' bytes in total,
+			whether the listing is complete)
+		"""
+		entries = []
+		while len(entries) < MANIFEST_PAGE_ENTRIES:
+			if not self._listed:
+				if self._list_next_dir():
+					continue
+				break
+			fn, kind, size, mtime, target = self._listed[0]
+			fn = fn.encode('utf8', 'surrogateescape')
+			data = b"" if target is None else target.encode('utf8', 'surrogateescape')
+			entrysz = _MANIFEST_ENTRY.size + 4 + len(fn) + max(len(data),
+				shared.DIGEST_LEN)
+			if entrysz > room:
+				break
+			room -= entrysz
+			self._listed.popleft()
+			entries.append([_MANIFEST_ENTRY.pack(kind.value, size, mtime), fn, data,
+				self._pool is not None and target is None])
+
+		hashed = [e for e in entries if e[3]]
+		if hashed:
+			for e, digest in zip(hashed, self._pool.map(_file_digest,
+					[e[1] for e in hashed])):
+				e[2] = digest
+		page = [hdr + struct.pack("=H", len(fn)) + fn + struct.pack("=H",
+			len(data)) + data for hdr, fn, data, _ in entries]
+		return page, not self._listed and not self._todo
+
+def _file_digest(fn):
+	"""returns binary digest of file 'fn', or empty bytes if it cannot be read"""
+	try:
+		return bytes.fromhex(shared.file_digest(fn))
+	except OSError:
+		return b""
+
+def _write_chunk(wh, offset, data, codec=shared.Codec.NONE):
+	if wh.errno:
+		# previous error occured: skip
+		return
+	if codec != shared.Codec.NONE:
+		try:
+			data = shared.decompress(codec, data)
+		except ValueError as ex:
+			print(f"Error decompressing chunk for {wh.fn}: {ex}", file=sys.stderr)
+			wh.errno = EIO
+			return
+	wh.extend(offset + len(data))
+	try:
+		_pwrite_all(wh.fh.fileno(), data, offset)
+	except OSError as ex:
+		wh.errno = ex.errno
+		return
+	if wh.partial is not None:
+		wh.partial.advance(offset, len(data))
+
+class _Partial:
+	"""
+	Resumable upload (WriteFlag.RESUME): the contents are written to a hidden
+	partial file next to the target, which replaces the target once complete.
+	The length received so far is saved in a journal along with the size and
+	digest of the contents, so that a later session can resume the upload if
+	this one is interrupted.
+	"""
+	def __init__(self, fn, size, digest):
+		parent, name = os.path.split(fn)
+		self.fn = os.path.join(parent, f".{name}.s2rpart")
+		self._journalfn = self.fn + ".json"
+		self._size = size
+		self._digest = digest
+		self.resumed = 0 # length received by previous sessions
+		self._lock = threading.Lock()
+		self._done = 0 # length received contiguously from the start
+		self._saved = 0 # length as of the last saved journal
+		self._ahead = {} # {start: end} of chunks received after a gap
+
+	def open(self):
+		"""returns the partial file opened for writing"""
+		try:
+			with open(self._journalfn, 'r') as f:
+				journal = json.load(f)
+			if journal['size'] == self._size and journal['digest'] == self._digest.hex():
+				self.resumed = journal['done']
+		except (OSError, ValueError, KeyError, TypeError):
+			pass
+		# readable too, to tell the digest of the contents received earlier
+		fh = open(os.open(self.fn, os.O_RDWR | os.O_CREAT, 0o666), 'wb', buffering=0)
+		if os.fstat(fh.fileno()).st_size < self.resumed:
+			self.resumed = 0
+		self._done = self._saved = self.resumed
+		return fh
+
+	def advance(self, offset, length):
+		"""Account a chunk as written. Called by the writer pool too."""
+		with self._lock:
+			if offset > self._done:
+				self._ahead[offset] = max(self._ahead.get(offset, 0), offset + length)
+				return
+			self._done = max(self._done, offset + length)
+			while self._done in self._ahead:
+				self._done = max(self._done, self._ahead.pop(self._done))
+			if self._done - self._saved >= JOURNAL_INTERVAL:
+				self._save()
+
+	def _save(self):
+		tmpfn = _tmp_name(self._journalfn)
+		with open(tmpfn, 'w') as f:
+			json.dump({'size': self._size, 'digest': self._digest.hex(),
+				'done': self._done}, f)
+		os.replace(tmpfn, self._journalfn)
+		self._saved = self._done
+
+	def save(self):
+		"""Save the progress of an interrupted upload"""
+		with self._lock:
+			if self._done > self._saved:
+				try:
+					self._save()
+				except OSError as ex:
+					print(f"Error saving progress of {self.fn}: {ex}", file=sys.stderr)
+
+	def commit(self, fn):
+		"""
+		Replace 'fn' with the complete partial file. The contents received earlier
+		are not verified again: the client has checked them when resuming.
+		"""
+		os.rename(self.fn, fn)
+		self._unlink_journal()
+
+	def _unlink_journal(self):
+		try:
+			os.unlink(self._journalfn)
+		except FileNotFoundError:
+			pass
+
+def _delta_sigs(wh, maxblocks):
+	"""returns: encoded DELTA_SIGS_RESP of the basis of _WriteHandle 'wh'"""
+	try:
+		wh.open_basis()
+		basissz = os.fstat(wh.basis.fileno()).st_size
+		bs = delta.block_size(basissz, maxblocks)
+		sigs = [struct.pack("=I", weak) + strong
+			for weak, strong in delta.gen_signatures(wh.basis, bs)]
+		wh.basisbs = bs
+		errno = 0
+	except Exception as ex:
+		if not isinstance(ex, OSError):
+			print(f"Error reading {wh.fn}: {ex!r}", file=sys.stderr)
+		errno = getattr(ex, 'errno', None) or EIO
+		bs = basissz = 0
+		sigs = []
+	return _encode_reply(shared.MsgType.DELTA_SIGS_RESP,
+		struct.pack("=HIQI", errno, bs, basissz, len(sigs)), *sigs)
+
+def _partial_resp(wh):
+	"""returns: encoded PARTIAL_RESP of _WriteHandle 'wh'"""
+	length = 0 if wh.partial is None else wh.partial.resumed
+	digest = bytes(shared.DIGEST_LEN)
+	if length:
+		try:
+			digest = bytes.fromhex(shared.fd_digest(wh.fh.fileno(), length))
+		except Exception as ex:
+			# start over
+			print(f"Error reading {wh.partial.fn}: {ex!r}", file=sys.stderr)
+			length = 0
+	return _encode_reply(shared.MsgType.PARTIAL_RESP, struct.pack("=Q", length),
+		digest)
+
+def _encode_reply(msgtype, *parts):
+	"""returns: message of type 'msgtype' with the payload made of 'parts'"""
+	payload = b"".join(parts)
+	return struct.pack("=BI", msgtype.value, len(payload)) + payload
+
+class _WriteHandle:
+	"""State of a file opened by the WRITE bulk operation"""
+	def __init__(self, fn, fh, flags, partial=None):
+		self.fn = fn
+		self.fh = fh
+		self.flags = flags
+		# _Partial if the contents are written to a partial file
+		self.partial = partial
+		# end of the furthest chunk received
+		self.end = 0 if partial is None else partial.resumed
+		self._endlock = threading.Lock() # extended by the writer pool too
+		self.errno = 0 # errno from writing
+		# delta transfer: basis file object, block size, and output temp file
+		self.basis = None
+		self.basisbs = 0
+		self.delta = None
+		self.deltafn = None
+		# future of the background request on the file, if any
+		self.bgjob = None
+
+	def extend(self, end):
+		with self._endlock:
+			self.end = max(self.end, end)
+
+	def open_basis(self):
+		if self.basis is None:
+			self.basis = open(self.fn, 'rb', buffering=0)
+
+	def open_delta_output(self):
+		if self.delta is None:
+			if self.basis is None:
+				raise ValueError("Delta received before signatures requested")
+			parent, name = os.path.split(self.fn)
+			fd, self.deltafn = tempfile.mkstemp(prefix=f".{name}.",
+				suffix=".s2rtmp", dir=parent or ".")
+			self.delta = open(fd, 'wb', buffering=0)
+
+	def copy_basis_blocks(self, idx, count):
+		bs = self.basisbs
+		offset = idx * bs
+		remaining = count * bs
+		while remaining:
+			data = os.pread(self.basis.fileno(), min(remaining, BUFF_SZ), offset)
+			if not data:
+				break
+			shared.write_all(self.delta, data)
+			offset += len(data)
+			remaining -= len(data)
+
+	def close(self):
+		"""Close all files and returns the write errno"""
+		try:
+			if self.errno:
+				if self.partial is not None:
+					self.partial.save()
+			elif self.delta is not None:
+				# replace the target with the reconstructed file
+				os.fchmod(self.delta.fileno(),
+					os.fstat(self.fh.fileno()).st_mode & 0o7777)
+				os.rename(self.deltafn, self.fn)
+				self.deltafn = None
+			elif shared.WriteFlag.NO_CONTENT not in self.flags:
+				# file might be preallocated larger than what we've received
+				if os.fstat(self.fh.fileno()).st_size != self.end:
+					os.ftruncate(self.fh.fileno(), self.end)
+				if self.partial is not None:
+					self.partial.commit(self.fn)
+		except OSError as ex:
+			self.errno = ex.errno
+		finally:
+			for fh in (self.fh, self.basis, self.delta):
+				if fh is not None:
+					fh.close()
+			if self.deltafn is not None:
+				try:
+					os.unlink(self.deltafn)
+				except OSError:
+					pass
+		return self.errno
+
 def _set_file_executable(fh, executable):
 	mode = os.fstat(fh.fileno()).st_mode & 0o777
 	newmode = None
@@ -267,6 +1133,146 @@ def _set_file_executable(fh, executable):
 	if newmode:
 		os.fchmod(fh.fileno(), newmode)
 
+def _preallocate(fh, size):
+	"""Discard the file's old contents and reserve 'size' bytes for the new one"""
+	fd = fh.fileno()
+	os.ftruncate(fd, 0)
+	if not size:
+		return
+	if hasattr(os, 'posix_fallocate'):
+		try:
+			os.posix_fallocate(fd, 0, size)
+			return
+		except OSError as ex:
+			if ex.errno not in (EINVAL, EOPNOTSUPP):
+				raise
+	# not supported by the filesystem/platform: at least set the size
+	os.ftruncate(fd, size)
+
+def _max_ofd():
+	"""
+	Number of files bulk operations can keep open: up to MAX_OFD, within
+	RLIMIT_NOFILE. The soft limit is raised towards the hard limit if needed.
+	"""
+	soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	want = MAX_OFD + FD_RESERVE
+	if soft != resource.RLIM_INFINITY and soft < want:
+		newsoft = want if hard == resource.RLIM_INFINITY else min(want, hard)
+		if newsoft > soft:
+			try:
+				resource.setrlimit(resource.RLIMIT_NOFILE, (newsoft, hard))
+				soft = newsoft
+			except (ValueError, OSError):
+				pass
+	if soft == resource.RLIM_INFINITY:
+		return MAX_OFD
+	return max(MIN_OFD, min(MAX_OFD, soft - FD_RESERVE))
+
+def _pwrite_all(fd, data, offset):
+	data = memoryview(data)
+	while len(data):
+		wr = os.pwrite(fd, data, offset)
+		if not wr:
+			raise OSError(EIO, "Write returned zero bytes")
+		data = data[wr:]
+		offset += wr
+
+def _tmp_name(fn):
+	parent, name = os.path.split(fn)
+	return os.path.join(parent, f".{name}.{os.getpid()}.s2rtmp")
+
+def _copy_contents(fin, fout):
+	"""Copy from the current offset of file 'fin' to the current offset of 'fout'"""
+	if hasattr(os, 'copy_file_range'):
+		# done by the filesystem, without going through userspace. Filesystems
+		# that support it share the data blocks (reflink).
+		try:
+			while os.copy_file_range(fin.fileno(), fout.fileno(), 1 << 30):
+				pass
+			return
+		except OSError as ex:
+			if ex.errno not in (EXDEV, ENOSYS, EINVAL, EOPNOTSUPP):
+				raise
+	# continue from where copy_file_range left the offsets
+	while True:
+		data = fin.read(BUFF_SZ)
+		if not data:
+			break
+		shared.write_all(fout, data)
+
+def _copy_file(src, dst, executable, hardlink=False):
+	"""
+	Atomically replace 'dst' with a copy of 'src'. If 'hardlink' is True,
+	'dst' is made a hardlink of 'src' if possible, in which case 'executable'
+	is ignored.
+	"""
+	tmpfn = _tmp_name(dst)
+	if hardlink:
+		try:
+			os.link(src, tmpfn)
+		except FileNotFoundError:
+			raise
+		except OSError:
+			# e.g. too many links, or not supported by the filesystem
+			hardlink = False
+	if not hardlink:
+		with open(src, 'rb', buffering=0) as fin:
+			fout = open(os.open(tmpfn, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666),
+				'wb', buffering=0)
+			try:
+				with fout:
+					_copy_contents(fin, fout)
+					_set_file_executable(fout, executable)
+			except:
+				os.unlink(tmpfn)
+				raise
+	try:
+		os.replace(tmpfn, dst)
+	except OSError:
+		os.unlink(tmpfn)
+		raise
+
+def _unshare(dfd, name, fn, keep_contents):
+	"""
+	Make sure that modifying file 'name' of directory 'dfd' (path 'fn') in place
+	does not modify other hardlinks of it, e.g. made by the COPY operation.
+	"""
+	try:
+		st = os.stat(name, dir_fd=dfd, follow_symlinks=False)
+	except FileNotFoundError:
+		return
+	if st.st_nlink < 2 or not stat.S_ISREG(st.st_mode):
+		return
+	if keep_contents:
+		_copy_file(fn, fn, bool(st.st_mode & 0o100))
+	else:
+		os.unlink(name, dir_fd=dfd)
+
+def _create_symlink(target, fn, dfd=None):
+	"""
+	Create symlink 'fn' (relative to directory fd 'dfd', if given),
+	atomically replacing the existing file
+	"""
+	try:
+		os.symlink(target, fn, dir_fd=dfd)
+		return
+	except FileExistsError:
+		pass
+	tmpfn = _tmp_name(fn)
+	os.symlink(target, tmpfn, dir_fd=dfd)
+	try:
+		os.replace(tmpfn, fn, src_dir_fd=dfd, dst_dir_fd=dfd)
+	except OSError:
+		os.unlink(tmpfn, dir_fd=dfd)
+		raise
+
+def _mkdir(dfd, name):
+	try:
+		os.mkdir(name, dir_fd=dfd)
+	except FileExistsError:
+		if not stat.S_ISDIR(os.stat(name, dir_fd=dfd).st_mode):
+			raise
+
 def _file_creation(fn, func):
 	"""
 	Perform func(), retry by recreating directory if failing
@@ -278,6 +1284,47 @@ def _file_creation(fn, func):
 		os.makedirs(parentdirs, exist_ok=True)
 		func()
 
-def main():
-	inst = _Server()
-	inst.main()
+def _serve(listen):
+	"""Serve clients connecting to address 'listen', one after another"""
+	sock = shared.listen(listen)
+	# relative remote paths are relative to where we are started
+	startcwd = os.open(".", os.O_RDONLY)
+	print(f"Listening on {listen}", file=sys.stderr)
+	try:
+		while True:
+			conn, peer = sock.accept()
+			print(f"Serving {peer or 'client'}", file=sys.stderr)
+			shared.set_nodelay(conn)
+			stream = shared.SocketStream(conn)
+			inst = _Server(stream, stream)
+			try:
+				inst.main()
+			except Exception as ex:
+				print(f"Session ended with error: {ex!r}", file=sys.stderr)
+			finally:
+				inst.abort()
+				conn.close()
+				os.fchdir(startcwd)
+	finally:
+		sock.close()
+		if listen.startswith("unix:"):
+			os.unlink(listen[5:])
+
+def populate_parser(parser):
+	parser.add_argument("--listen", metavar="ADDRESS",
+		help="Serve clients connecting to 'tcp:host:port' or 'unix:path' instead of "\
+		"serving a single client over stdin/stdout.")
+
+def main(args):
+	if args.listen:
+		signal.signal(signal.SIGTERM, signal.default_int_handler)
+		try:
+			_serve(args.listen)
+		except KeyboardInterrupt:
+			pass
+		return
+	inst = _Server(sys.stdin.buffer.raw, sys.stdout.buffer.raw)
+	try:
+		inst.main()
+	finally:
+		inst.abort()
@@ -1,8 +1,71 @@
-from enum import Enum
+from enum import Enum, IntFlag
 from collections.abc import ByteString
+import os
 import struct
+import socket
+import stat
+import hashlib
+import zlib
+try:
+	import lzma
+except ImportError:
+	# lzma is an optional part of the Python build
+	lzma = None
 from PythonLib.MyBytesIO import BIO
 
+PROTOCOL_VERSION = 2
+
+class Feature(IntFlag):
+	"""Optional capabilities advertised by the server in VERSION_RESP"""
+	DELTA = 1
+	ZLIB = 2
+	LZMA = 4
+	WRITE_INLINE = 8
+	CHUNK_STREAM = 16
+	# EXIT is answered with EXIT_RESP
+	EXIT_STATS = 32
+	RENAME = 64
+	COPY = 128
+	MANIFEST = 256
+	MKDIR = 512
+	RESUME = 1024
+
+class WriteFlag(IntFlag):
+	"""Flags of the WRITE bulk operation"""
+	EXECUTABLE = 1
+	# open only to update file attributes
+	NO_CONTENT = 2
+	# contents will be sent as delta: keep the existing contents as the basis
+	DELTA = 4
+	# write to a partial file that is kept if the upload is interrupted, to be
+	# resumed by a later session. See MsgType.PARTIAL_QUERY.
+	RESUME = 8
+
+class CopyFlag(IntFlag):
+	"""Flags of the COPY bulk operation"""
+	EXECUTABLE = 1
+	# hardlink to the source if possible, instead of copying its contents
+	HARDLINK = 2
+
+class ManifestFlag(IntFlag):
+	"""Flags of the MANIFEST message"""
+	# send the content digest of files
+	DIGESTS = 1
+	# only continue a listing in progress: do not start a new one
+	CONTINUE = 2
+
+class EntryKind(Enum):
+	"""Kind of the entries of MANIFEST_RESP"""
+	FILE = 0
+	EXECUTABLE = 1
+	SYMLINK = 2
+
+class Codec(Enum):
+	"""Compression codec of CHUNK_COMPRESSED payloads"""
+	NONE = 0
+	ZLIB = 1
+	LZMA = 2
+
 class MsgType(Enum):
 	# client requests
 	VERSION = 1
@@ -12,18 +75,43 @@ class MsgType(Enum):
 	BULKOP_CLOSE = 8
 	CHUNK = 9
 	EXIT = 10
+	DELTA_SIGS = 11
+	DELTA = 12
+	CHUNK_COMPRESSED = 13
+	CHUNK_STREAM = 14
+	MANIFEST = 15
+	PARTIAL_QUERY = 16
 	# server responses
 	VERSION_RESP = 100
 	LIMIT_RESP = 101
 	GEN_RESULT = 102
 	BULKOP_RESULTS = 103
 	BULKOP_CLOSE_RESULTS = 104
+	DELTA_SIGS_RESP = 105
+	EXIT_RESP = 106
+	MANIFEST_RESP = 107
+	PARTIAL_RESP = 108
 
 class OpType(Enum):
 	WRITE = 1
 	SYMLINK = 2
+	WRITE_INLINE = 3
+	RENAME = 4
+	COPY = 5
+	MKDIR = 6
 	DELETE = 10
 
+DIGEST_LEN = 16
+DIGEST_BLOCK_SZ = 1_048_576
+
+# message buffers are sized between these, depending on the available memory
+MIN_BUFF_SZ = 262_144
+DEFAULT_BUFF_SZ = 1_048_576
+
+ZLIB_LEVEL = 6
+LZMA_PRESET = 1
+_DECOMPRESS_ERRORS = (zlib.error,) + ((lzma.LZMAError,) if lzma else ())
+
 _readall_buff = BIO(256)
 
 class BuffManager:
@@ -40,16 +128,20 @@ class BuffManager:
 		self._data.seek(4, 1)
 		self._lastmsglenpos = self._data.tell()
 
-	def end_msg(self):
+	def end_msg(self, extra=0):
+		"""
+		'extra' is the number of bytes of the message's payload that are sent
+		separately after the buffer's content.
+		"""
 		# update msg size
 		curpos = self._data.tell()
-		msgsize = curpos - self._lastmsglenpos
+		msgsize = curpos - self._lastmsglenpos + extra
 		self._data.seek(self._lastmsglenpos - 4)
 		self.append_uint(msgsize)
 		self._data.seek(curpos)
 
 	def append_bytes(self, v):
-		if not isinstance(v, ByteString):
+		if not isinstance(v, (ByteString, memoryview)):
 			raise TypeError("Expected byte-like type")
 		self._data.write(v)
 
@@ -75,6 +167,9 @@ class BuffManager:
 	def append_hsint(self, v):
 		self._data.write(struct.pack("=h", v))
 
+	def append_ulonglong(self, v):
+		self._data.write(struct.pack("=Q", v))
+
 	def getbuffer(self):
 		return self._data.getbuffer()[:self._data.tell()]
 
@@ -110,3 +205,165 @@ def write_all(fh, data):
 		total += wr
 		data = data[wr:]
 	return total
+
+class SocketStream:
+	"""Connected socket with the interface of the raw stdio streams"""
+	def __init__(self, sock):
+		self._sock = sock
+
+	def readinto(self, b):
+		return self._sock.recv_into(b)
+
+	def write(self, data):
+		self._sock.sendall(data)
+		return len(data)
+
+	def fileno(self):
+		return self._sock.fileno()
+
+def _parse_address(addr):
+	"""
+	Parse 'tcp:host:port' or 'unix:path'.
+	returns:
+		(address family, address)
+	"""
+	kind, _, rest = addr.partition(':')
+	if kind == 'unix' and rest:
+		return socket.AF_UNIX, rest
+	if kind == 'tcp':
+		host, _, port = rest.rpartition(':')
+		if port.isdigit():
+			host = host.strip('[]')
+			family = socket.AF_INET6 if ':' in host else socket.AF_INET
+			return family, (host, int(port))
+	raise ValueError(f"Invalid address '{addr}': expected 'tcp:host:port' or "\
+		"'unix:path'")
+
+def listen(addr):
+	family, sockaddr = _parse_address(addr)
+	sock = socket.socket(family, socket.SOCK_STREAM)
+	try:
+		if family == socket.AF_UNIX:
+			# remove stale socket from the previous run
+			try:
+				if stat.S_ISSOCK(os.stat(sockaddr).st_mode):
+					os.unlink(sockaddr)
+			except FileNotFoundError:
+				pass
+		else:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		sock.bind(sockaddr)
+		sock.listen()
+	except:
+		sock.close()
+		raise
+	return sock
+
+def connect(addr):
+	family, sockaddr = _parse_address(addr)
+	sock = socket.socket(family, socket.SOCK_STREAM)
+	try:
+		sock.connect(sockaddr)
+	except:
+		sock.close()
+		raise
+	set_nodelay(sock)
+	return sock
+
+def set_nodelay(sock):
+	"""Messages are written whole: send them right away"""
+	if sock.family != socket.AF_UNIX:
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+def file_digest(fn, size=None):
+	"""Returns hex digest of the contents of file 'fn', or of its first 'size' bytes"""
+	with open(fn, 'rb', buffering=0) as f:
+		return fd_digest(f.fileno(), size)
+
+def fd_digest(fd, size=None):
+	"""Same as file_digest, for file descriptor 'fd'. Its offset is not changed."""
+	h = new_digest()
+	offset = 0
+	while size is None or offset < size:
+		want = DIGEST_BLOCK_SZ if size is None else min(DIGEST_BLOCK_SZ, size - offset)
+		data = os.pread(fd, want, offset)
+		if not data:
+			break
+		h.update(data)
+		offset += len(data)
+	return h.hexdigest()
+
+def new_digest():
+	"""returns a hash object of file_digest, to hash contents as they are read"""
+	return hashlib.blake2b(digest_size=DIGEST_LEN)
+
+def available_memory():
+	"""
+	returns:
+		bytes of memory that can be allocated without swapping (within the
+		cgroup's limit, if any), or None if unknown
+	"""
+	ret = None
+	try:
+		with open("/proc/meminfo", 'r') as f:
+			for line in f:
+				if line.startswith("MemAvailable:"):
+					ret = int(line.split()[1]) * 1024
+					break
+	except (OSError, ValueError, IndexError):
+		pass
+	if ret is None:
+		try:
+			ret = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+		except (OSError, ValueError, AttributeError):
+			pass
+	try:
+		with open("/sys/fs/cgroup/memory.max", 'r') as f:
+			limit = f.read().strip()
+		if limit != "max":
+			with open("/sys/fs/cgroup/memory.current", 'r') as f:
+				room = max(0, int(limit) - int(f.read()))
+			ret = room if ret is None else min(ret, room)
+	except (OSError, ValueError):
+		pass
+	return ret
+
+def fit_buffer_size(count, max_sz, mem_fraction):
+	"""
+	returns:
+		the largest power of two size, between MIN_BUFF_SZ and 'max_sz', of which
+		'count' buffers fit in 'mem_fraction' of the available memory.
+		DEFAULT_BUFF_SZ if the available memory is unknown.
+	"""
+	mem = available_memory()
+	if mem is None:
+		return min(DEFAULT_BUFF_SZ, max_sz)
+	sz = max_sz
+	while sz > MIN_BUFF_SZ and count * sz > mem * mem_fraction:
+		sz //= 2
+	return max(sz, MIN_BUFF_SZ)
+
+def available_codecs():
+	"""Returns shared.Feature flags of compression codecs usable on this host"""
+	ret = Feature.ZLIB
+	if lzma is not None:
+		ret |= Feature.LZMA
+	return ret
+
+def compress(codec, data):
+	if codec == Codec.ZLIB:
+		return zlib.compress(data, ZLIB_LEVEL)
+	if codec == Codec.LZMA:
+		return lzma.compress(data, preset=LZMA_PRESET)
+	raise ValueError(f"Cannot compress using {codec}")
+
+def decompress(codec, data):
+	"""Raises ValueError if 'data' cannot be decompressed"""
+	try:
+		if codec == Codec.ZLIB:
+			return zlib.decompress(data)
+		if codec == Codec.LZMA and lzma is not None:
+			return lzma.decompress(data)
+	except _DECOMPRESS_ERRORS as ex:
+		raise ValueError(str(ex)) from ex
+	raise ValueError(f"Cannot decompress using {codec}")
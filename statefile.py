@@ -0,0 +1,387 @@
+import os
+import sys
+import mmap
+import struct
+from array import array
+
+MAGIC = b'S2RS'
+VERSION = 1
+# every n-th record stores its full path so that lookups can start from there
+RESTART_INTERVAL = 16
+DIGEST_LEN = 16
+
+# entry kinds
+KIND_FILE = 0
+KIND_EXECUTABLE = 1
+KIND_SYMLINK = 2
+KIND_MASK = 0x7f
+HAS_DIGEST = 0x80
+
+# magic, version, entry count, then offsets of: path records, restart points,
+# kinds, mtimes, sizes, digests, inodes, directory listings (0 if none)
+_HEADER = struct.Struct("<4sIQQQQQQQQQ")
+_RECORD_HDR = struct.Struct("<HH")
+_STRLEN = struct.Struct("<H")
+# inode, mtime, entry count, length of the names
+_DIR_HDR = struct.Struct("<QqII")
+
+def data_file_name(statefile):
+	"""
+	Name of the binary file that holds the state data of 'statefile'. It is
+	appended to the name so that it never is 'statefile' itself, nor the data
+	file of another state file.
+	"""
+	return statefile + '.data'
+
+def sort_key(path):
+	"""Entries are sorted by their UTF8 encoded paths"""
+	return path.encode('utf8')
+
+class StateData:
+	"""
+	Read-only view of the binary state data file. Behaves like a read-only dict
+	of {relative path name: [target, mtime, size, digest, inode]} (see
+	client.recursive_scan), except that iteration is always in sort_key order.
+	Entries are decoded from the memory-mapped file on demand.
+
+	File layout (all integers are little endian):
+		header (see _HEADER)
+		path records, sorted:
+			uint16_t length of prefix shared with the previous path
+			uint16_t length of the rest of the path
+			string rest of the path
+			(symlinks only) uint16_t target length, string target
+		uint64_t offset of path record (relative to the first record), for every
+			RESTART_INTERVAL-th entry
+		uint8_t kind (KIND_*, optionally with HAS_DIGEST) for each entry
+		int64_t mtime for each entry
+		uint64_t size for each entry
+		bytearray(DIGEST_LEN) digest for each entry
+		uint64_t inode for each entry (0 if unknown)
+		(optional) directory listings, see dirs()
+	"""
+	def __init__(self, fn):
+		with open(fn, 'rb') as f:
+			magic, version = struct.unpack("<4sI", f.read(8).ljust(8, b'\0'))
+			if magic != MAGIC or version != VERSION or \
+					os.fstat(f.fileno()).st_size < _HEADER.size:
+				raise ValueError(f"'{fn}' is not a valid state data file")
+			self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		_, _, self._count, self._recoff, self._restartoff, kindoff, mtimeoff, \
+			sizeoff, self._digestoff, inodeoff, self._dirsoff = \
+			_HEADER.unpack_from(self._mm)
+		# columns of fixed size entries, in file order
+		cols = [(kindoff, 1), (mtimeoff, 8), (sizeoff, 8),
+			(self._digestoff, DIGEST_LEN), (inodeoff, 8)]
+		if not _valid_layout(len(self._mm), self._count, self._recoff,
+				self._restartoff, cols, self._dirsoff):
+			self._mm.close()
+			raise ValueError(f"'{fn}' is truncated or corrupt")
+		mv = memoryview(self._mm)
+		self._inodes = mv[inodeoff:inodeoff + self._count * 8].cast('Q')
+		self._restarts = mv[self._restartoff:kindoff].cast('Q')
+		# sized by the count: columns are followed by alignment padding
+		self._kinds = mv[kindoff:kindoff + self._count]
+		self._mtimes = mv[mtimeoff:mtimeoff + self._count * 8].cast('q')
+		self._sizes = mv[sizeoff:sizeoff + self._count * 8].cast('Q')
+
+	def close(self):
+		if self._mm is not None:
+			for col in (self._restarts, self._kinds, self._mtimes, self._sizes,
+					self._inodes):
+				col.release()
+			self._mm.close()
+			self._mm = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def __len__(self):
+		return self._count
+
+	def _decode_record(self, off, prevpath):
+		"""
+		Decode path of the record at 'off', given the path of previous record.
+		returns:
+			(path as bytes, offset of the symlink target or next record)
+		"""
+		shared, restlen = _RECORD_HDR.unpack_from(self._mm, off)
+		off += _RECORD_HDR.size
+		path = prevpath[:shared] + self._mm[off:off + restlen]
+		return path, off + restlen
+
+	def _read_target(self, off):
+		tlen = _STRLEN.unpack_from(self._mm, off)[0]
+		off += _STRLEN.size
+		return self._mm[off:off + tlen], off + tlen
+
+	def _entry(self, idx, target):
+		kind = self._kinds[idx]
+		digest = None
+		if kind & HAS_DIGEST:
+			doff = self._digestoff + idx * DIGEST_LEN
+			digest = self._mm[doff:doff + DIGEST_LEN].hex()
+		kind &= KIND_MASK
+		if kind == KIND_SYMLINK:
+			return (target.decode('utf8'), self._mtimes[idx], None, digest, None)
+		return (kind == KIND_EXECUTABLE, self._mtimes[idx], self._sizes[idx], digest,
+			self._inodes[idx] or None)
+
+	def _iter_raw(self, start=0):
+		"""
+		Yields (index, path as bytes, symlink target as bytes or None), starting
+		from restart point 'start'
+		"""
+		idx = start * RESTART_INTERVAL
+		if idx >= self._count:
+			return
+		off = self._recoff + self._restarts[start]
+		path = b''
+		while idx < self._count:
+			path, off = self._decode_record(off, path)
+			target = None
+			if self._kinds[idx] & KIND_MASK == KIND_SYMLINK:
+				target, off = self._read_target(off)
+			yield idx, path, target
+			idx += 1
+
+	def items(self):
+		for idx, path, target in self._iter_raw():
+			yield path.decode('utf8'), self._entry(idx, target)
+
+	def __iter__(self):
+		for _, path, _ in self._iter_raw():
+			yield path.decode('utf8')
+
+	def _seek(self, keyb):
+		"""
+		returns:
+			iterator of _iter_raw from the restart point of the entries that 'keyb'
+			(sort_key of a path) would be among
+		"""
+		# find the last restart point whose path is not greater than key
+		lo, hi = 0, len(self._restarts)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			path, _ = self._decode_record(self._recoff + self._restarts[mid], b'')
+			if path <= keyb:
+				lo = mid + 1
+			else:
+				hi = mid
+		return self._iter_raw(max(lo - 1, 0))
+
+	def get(self, key, default=None):
+		keyb = sort_key(key)
+		for idx, path, target in self._seek(keyb):
+			if path == keyb:
+				return self._entry(idx, target)
+			if path > keyb:
+				break
+		return default
+
+	def has_prefix(self, prefix):
+		"""Whether the path of any entry starts with 'prefix'"""
+		prefixb = sort_key(prefix)
+		for _, path, _ in self._seek(prefixb):
+			if path >= prefixb:
+				return path.startswith(prefixb)
+		return False
+
+	def file_ids(self):
+		"""
+		returns:
+			(set of the inodes, set of the sizes, set of the digests as bytes) of
+			the files, to tell whether a file might be one of them without looking
+			it up by path
+		"""
+		inodes = set(self._inodes)
+		# symlinks and files of unknown inode
+		inodes.discard(0)
+		mm = self._mm
+		sizes = set()
+		digests = set()
+		for idx, kind in enumerate(self._kinds):
+			if kind & KIND_MASK == KIND_SYMLINK:
+				continue
+			sizes.add(self._sizes[idx])
+			if kind & HAS_DIGEST:
+				off = self._digestoff + idx * DIGEST_LEN
+				digests.add(mm[off:off + DIGEST_LEN])
+		return inodes, sizes, digests
+
+	def __getitem__(self, key):
+		ret = self.get(key)
+		if ret is None:
+			raise KeyError(key)
+		return ret
+
+	def __contains__(self, key):
+		return self.get(key) is not None
+
+	def dirs(self):
+		"""
+		Directory listings saved along with the entries, for scanner.DirCache.
+		Stored as:
+			uint32_t directory count
+			for each directory:
+				uint16_t path length, string path
+				uint64_t inode
+				int64_t mtime
+				uint32_t entry count
+				uint32_t names length
+				string names, separated by '/'
+				uint8_t kind for each entry
+		returns:
+			{relative dir path: (inode, mtime, (list of names, bytes of kinds))}
+		"""
+		ret = {}
+		if not self._dirsoff:
+			return ret
+		try:
+			self._read_dirs(ret)
+		except (struct.error, UnicodeDecodeError):
+			# truncated: the listings are only an optimization of the next scan
+			ret.clear()
+		return ret
+
+	def _read_dirs(self, ret):
+		mm = self._mm
+		off = self._dirsoff
+		count = struct.unpack_from("<I", mm, off)[0]
+		off += 4
+		for _ in range(count):
+			plen = _STRLEN.unpack_from(mm, off)[0]
+			off += _STRLEN.size
+			path = mm[off:off + plen].decode('utf8')
+			off += plen
+			ino, mtime, n, nameslen = _DIR_HDR.unpack_from(mm, off)
+			off += _DIR_HDR.size
+			names = mm[off:off + nameslen].decode('utf8').split('/') if n else []
+			off += nameslen
+			if off + n > len(mm):
+				raise struct.error("truncated directory listing")
+			ret[path] = (ino, mtime, (names, mm[off:off + n]))
+			off += n
+
+def write(fn, items, dirs=None, presorted=False):
+	"""
+	Write state data file atomically.
+	'items' is an iterable of
+		(relative path name, [target, mtime, size, digest, inode])
+	which must be in sort_key order if 'presorted' is True (e.g. the items of a
+	tree.Tree), so that they are not all held in memory.
+	'dirs' is an optional dict of directory listings, see StateData.dirs.
+	"""
+	if presorted:
+		items = ((sort_key(k), v) for k, v in items)
+	else:
+		items = sorted(((sort_key(k), v) for k, v in items), key=lambda x: x[0])
+	records = bytearray()
+	restarts = array('Q')
+	kinds = bytearray()
+	mtimes = array('q')
+	sizes = array('Q')
+	digests = bytearray()
+	inodes = array('Q')
+
+	prev = b''
+	for idx, (path, v) in enumerate(items):
+		if idx % RESTART_INTERVAL == 0:
+			restarts.append(len(records))
+			shared = 0
+		else:
+			shared = _common_prefix_len(prev, path)
+		records += _RECORD_HDR.pack(shared, len(path) - shared)
+		records += path[shared:]
+		prev = path
+
+		info = v[0]
+		digest = v[3] if len(v) > 3 else None
+		if isinstance(info, str):
+			target = info.encode('utf8')
+			records += _STRLEN.pack(len(target))
+			records += target
+			kind = KIND_SYMLINK
+			sizes.append(0)
+			inodes.append(0)
+		else:
+			kind = KIND_EXECUTABLE if info else KIND_FILE
+			sizes.append((v[2] if len(v) > 2 else None) or 0)
+			inodes.append((v[4] if len(v) > 4 else None) or 0)
+		if digest:
+			kind |= HAS_DIGEST
+			digests += bytes.fromhex(digest)
+		else:
+			digests += bytes(DIGEST_LEN)
+		kinds.append(kind)
+		mtimes.append(v[1])
+
+	count = len(kinds)
+	if sys.byteorder != 'little':
+		for col in (restarts, mtimes, sizes, inodes):
+			col.byteswap()
+	# lay out sections, keeping integer columns 8-byte aligned
+	sections = [memoryview(sec).cast('B') for sec in
+		(records, restarts, kinds, mtimes, sizes, digests, inodes)]
+	if dirs is not None:
+		sections.append(_pack_dirs(dirs))
+	offsets = []
+	pos = _HEADER.size
+	for sec in sections:
+		pos += -pos % 8
+		offsets.append(pos)
+		pos += len(sec)
+	if dirs is None:
+		offsets.append(0)
+
+	tmpfn = fn + '.tmp'
+	with open(tmpfn, 'wb') as f:
+		f.write(_HEADER.pack(MAGIC, VERSION, count, *offsets))
+		for off, sec in zip(offsets, sections):
+			f.write(bytes(off - f.tell()))
+			f.write(sec)
+	os.replace(tmpfn, fn)
+
+def _valid_layout(filesz, count, recoff, restartoff, cols, dirsoff):
+	"""
+	Whether the sections at the given offsets fit in a file of 'filesz' bytes,
+	in order. 'cols' is a list of (offset, entry size) of the columns of 'count'
+	entries that follow the restart points.
+	"""
+	if not recoff <= restartoff or \
+			cols[0][0] - restartoff != -(-count // RESTART_INTERVAL) * 8:
+		return False
+	end = cols[0][0]
+	for off, entrysz in cols:
+		if off < end:
+			return False
+		end = off + count * entrysz
+	if dirsoff and dirsoff < end:
+		return False
+	return max(end, dirsoff) <= filesz
+
+def _pack_dirs(dirs):
+	ret = bytearray(struct.pack("<I", len(dirs)))
+	for path, (ino, mtime, (names, kinds)) in dirs.items():
+		path = path.encode('utf8')
+		joined = '/'.join(names).encode('utf8')
+		ret += _STRLEN.pack(len(path))
+		ret += path
+		ret += _DIR_HDR.pack(ino, mtime, len(names), len(joined))
+		ret += joined
+		ret += kinds
+	return ret
+
+def _common_prefix_len(a, b):
+	# bisect using slice comparisons, which is faster than a Python loop
+	lo, hi = 0, min(len(a), len(b), 0xffff)
+	while lo < hi:
+		mid = (lo + hi + 1) // 2
+		if a[:mid] == b[:mid]:
+			lo = mid
+		else:
+			hi = mid - 1
+	return lo
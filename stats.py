@@ -0,0 +1,163 @@
+import sys
+import time
+import json
+import resource
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# minimum interval between progress line updates (seconds)
+PROGRESS_INTERVAL = 0.5
+# the current transfer rate is averaged over this many seconds
+RATE_WINDOW = 5.0
+
+class Stats:
+	"""
+	Counters and timers of a client run. Can be updated from multiple threads
+	(e.g. 'sync --streams').
+	"""
+	def __init__(self, progress=False):
+		self._lock = threading.Lock()
+		self._start = time.monotonic()
+		self._timers = {} # {name: [count, total seconds, max seconds]}
+		self._counters = {} # {name: value}
+		self._settings = {} # {name: value}, e.g. negotiated sizes
+		self._server_rss = None # peak memory use reported by the servers (KiB)
+		self._progress = _Progress() if progress else None
+
+	def add(self, name, value=1):
+		with self._lock:
+			self._counters[name] = self._counters.get(name, 0) + value
+
+	def set(self, name, value):
+		"""Record a setting chosen at runtime. The last value is reported."""
+		with self._lock:
+			self._settings[name] = value
+
+	def add_server_rss(self, kb):
+		"""Account the peak memory use reported by a server"""
+		with self._lock:
+			self._server_rss = max(self._server_rss or 0, kb)
+
+	def add_time(self, name, seconds):
+		with self._lock:
+			t = self._timers.get(name)
+			if t is None:
+				t = self._timers[name] = [0, 0.0, 0.0]
+			t[0] += 1
+			t[1] += seconds
+			t[2] = max(t[2], seconds)
+
+	@contextmanager
+	def timer(self, name):
+		start = time.monotonic()
+		try:
+			yield
+		finally:
+			self.add_time(name, time.monotonic() - start)
+
+	def set_total(self, nbytes):
+		"""Set the number of bytes to be uploaded, for the progress line"""
+		if self._progress is not None:
+			with self._lock:
+				self._progress.start(nbytes)
+
+	def add_total(self, nbytes):
+		"""Add to the number of bytes to be uploaded, as they become known"""
+		if self._progress is not None:
+			with self._lock:
+				self._progress.total += nbytes
+
+	def progress(self, nbytes):
+		"""Account 'nbytes' of file contents as uploaded"""
+		self.add('uploaded_bytes', nbytes)
+		if self._progress is not None:
+			with self._lock:
+				self._progress.update(nbytes)
+
+	def end_progress(self):
+		if self._progress is not None:
+			with self._lock:
+				self._progress.finish()
+
+	def report(self, **extra):
+		"""returns the statistics as a JSON serializable dict"""
+		with self._lock:
+			timers = {k: {'count': c, 'total_s': round(tot, 6), 'max_s': round(mx, 6)}
+				for k, (c, tot, mx) in self._timers.items()}
+			counters = dict(self._counters)
+			settings = dict(self._settings)
+			server_rss = self._server_rss
+		ret = {
+			**extra,
+			'elapsed_s': round(time.monotonic() - self._start, 6),
+			'timers': timers,
+			'counters': counters,
+			'settings': settings,
+			'client_max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+			# the largest of the servers, None if they cannot tell (older versions)
+			'server_max_rss_kb': server_rss,
+		}
+		upload = timers.get('sync', {}).get('total_s')
+		if upload:
+			ret['upload_bytes_per_s'] = round(counters.get('uploaded_bytes', 0) / upload)
+			ret['files_per_s'] = round(sum(counters.get(k, 0) for k in
+				('files_updated', 'files_deleted', 'files_renamed', 'files_copied')) /
+				upload)
+		return ret
+
+	def write_report(self, fn, **extra):
+		"""
+		Write the report to file 'fn', or to stderr if 'fn' is '-': stdout is
+		mixed with the messages of the run
+		"""
+		data = json.dumps(self.report(**extra), indent=1)
+		if fn == '-':
+			print(data, file=sys.stderr)
+		else:
+			with open(fn, 'w') as f:
+				f.write(data + '\n')
+
+class _Progress:
+	"""Progress line on stderr"""
+	def __init__(self):
+		self.total = 0
+		self._done = 0
+		self._start = time.monotonic()
+		self._last = 0.0
+		self._samples = deque() # (time, bytes done)
+		self._shown = False
+
+	def start(self, total):
+		self.total = total
+		self._start = time.monotonic()
+
+	def update(self, nbytes):
+		self._done += nbytes
+		now = time.monotonic()
+		if now - self._last >= PROGRESS_INTERVAL:
+			self._last = now
+			self._show(now)
+
+	def _show(self, now):
+		self._samples.append((now, self._done))
+		while len(self._samples) > 1 and now - self._samples[0][0] > RATE_WINDOW:
+			self._samples.popleft()
+		t0, b0 = self._samples[0]
+		if now > t0:
+			rate = (self._done - b0) / (now - t0)
+		else:
+			rate = self._done / max(now - self._start, 1e-9)
+		line = f"{self._done / 1e6:.1f}/{self.total / 1e6:.1f} MB, {rate / 1e6:.1f} MB/s"
+		if rate > 0 and self.total > self._done:
+			eta = int((self.total - self._done) / rate)
+			line += f", ETA {eta // 3600}:{eta // 60 % 60:02d}:{eta % 60:02d}"
+		sys.stderr.write(f"\r{line}\033[K")
+		sys.stderr.flush()
+		self._shown = True
+
+	def finish(self):
+		if self._shown:
+			self._show(time.monotonic())
+			sys.stderr.write("\n")
+			self._shown = False
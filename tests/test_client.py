@@ -0,0 +1,33 @@
+import json
+import os
+import pytest
+
+pytest.importorskip("PythonLib.MyBytesIO", reason="the client needs the "
+	"PythonLib submodule: run 'git submodule update --init'")
+
+import client
+
+def _baseline_entry(fn):
+	# as saved by versions before the state data file: [target, mtime]
+	st = os.lstat(fn)
+	info = os.readlink(fn) if os.path.islink(fn) else bool(st.st_mode & 0o111)
+	return [info, max(st.st_ctime_ns, st.st_mtime_ns)]
+
+def test_baseline_state_has_no_changes(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	os.makedirs("d/e")
+	for fn, size in (("a.txt", 10), ("d/b.bin", 100_000), ("d/e/c", 0)):
+		with open(fn, 'wb') as f:
+			f.write(bytes(size))
+	os.chmod("d/e/c", 0o755)
+	os.symlink("../a.txt", "d/link")
+	data = {fn: _baseline_entry(fn) for fn in ("a.txt", "d/b.bin", "d/e/c", "d/link")}
+	with open(client.DEFAULT_STATE_FILE, 'w') as f:
+		json.dump({"command": [], "remotecwd": None, "resolve_symlink": False,
+			"data": data}, f)
+
+	sw, oldstate = client._load_state(client.DEFAULT_STATE_FILE)
+	newstate = client.recursive_scan(client.DEFAULT_STATE_FILE, False)
+	to_delete, to_update, _, renames, copies, _ = \
+		client._compute_changes(oldstate, newstate)
+	assert (to_delete, to_update, renames, copies) == ([], {}, [], {})
@@ -0,0 +1,63 @@
+import io
+import random
+import delta
+
+def _delta(basis, data, roll_budget=delta.ROLL_BUDGET):
+	bs = delta.block_size(len(basis), 1 << 20)
+	sigs = list(delta.gen_signatures(io.BytesIO(basis), bs))
+	return bs, list(delta.gen_delta(data, bs, len(basis), sigs, roll_budget))
+
+def _apply(basis, bs, ops, data):
+	"""Rebuild the new file as the server does"""
+	out = bytearray()
+	for kind, a, b in ops:
+		if kind == delta.LITERAL:
+			out += data[a:b]
+		else:
+			out += basis[a * bs:(a + b) * bs]
+	return bytes(out)
+
+def _literal_len(ops):
+	return sum(b - a for kind, a, b in ops if kind == delta.LITERAL)
+
+def test_unchanged_is_one_block_run():
+	basis = random.Random(1).randbytes(300_000)
+	bs, ops = _delta(basis, basis)
+	assert ops == [(delta.BLOCKREF, 0, -(-len(basis) // bs))]
+
+def test_round_trip_with_edits():
+	rnd = random.Random(2)
+	basis = rnd.randbytes(1_048_576)
+	data = bytearray(basis)
+	data[500_000:500_100] = rnd.randbytes(100)
+	# shifts the blocks that follow
+	data[100_000:100_000] = b"inserted"
+	del data[800_000:800_333]
+	data += b"appended"
+	data = bytes(data)
+	bs, ops = _delta(basis, data)
+	assert _apply(basis, bs, ops, data) == data
+	# only the blocks around the edits are sent
+	assert _literal_len(ops) <= 8 * bs
+
+def test_round_trip_without_rolling():
+	rnd = random.Random(3)
+	basis = rnd.randbytes(200_000)
+	data = b"x" + basis
+	bs, ops = _delta(basis, data, roll_budget=0)
+	assert _apply(basis, bs, ops, data) == data
+	# shifted blocks cannot be found without rolling
+	assert _literal_len(ops) == len(data)
+
+def test_unrelated_contents():
+	rnd = random.Random(4)
+	basis = rnd.randbytes(100_000)
+	data = rnd.randbytes(150_000)
+	bs, ops = _delta(basis, data)
+	assert ops == [(delta.LITERAL, 0, len(data))]
+
+def test_block_size():
+	assert delta.block_size(0, 100) == delta.MIN_BLOCK_SZ
+	assert delta.block_size(1 << 30, 1 << 20) == 32_768
+	# limited by the number of blocks
+	assert delta.block_size(1 << 30, 1000) == -(-(1 << 30) // 1000)
@@ -0,0 +1,96 @@
+import filters
+from filters import Rules
+
+def _match(lines, path, is_dir=False):
+	return Rules(lines).match(path, is_dir)
+
+def test_names_match_at_any_depth():
+	assert _match(["*.o"], "a.o") is True
+	assert _match(["*.o"], "d/e/b.o") is True
+	assert _match(["*.o"], "a.oo") is None
+	assert _match(["cache"], "x/cache", True) is True
+	assert _match(["cache"], "x/cache.txt") is None
+
+def test_slash_anchors_to_rules_dir():
+	assert _match(["/top.txt"], "top.txt") is True
+	assert _match(["/top.txt"], "d/top.txt") is None
+	assert _match(["doc/*.txt"], "doc/a.txt") is True
+	assert _match(["doc/*.txt"], "x/doc/a.txt") is None
+
+def test_wildcards_do_not_match_slash():
+	assert _match(["doc/*.txt"], "doc/sub/a.txt") is None
+	assert _match(["a?c"], "a/c") is None
+	assert _match(["a?c"], "abc") is True
+	assert _match(["[ab].c"], "b.c") is True
+	assert _match(["[!ab].c"], "b.c") is None
+	assert _match(["[!ab].c"], "z.c") is True
+
+def test_double_star():
+	assert _match(["**/logs"], "logs", True) is True
+	assert _match(["**/logs"], "a/b/logs", True) is True
+	assert _match(["a/**"], "a/x/y") is True
+	assert _match(["a/**"], "b/a/x") is None
+	assert _match(["a/**/b"], "a/b") is True
+	assert _match(["a/**/b"], "a/x/y/b") is True
+
+def test_trailing_slash_matches_dirs_only():
+	assert _match(["build/"], "build", True) is True
+	assert _match(["build/"], "x/build", True) is True
+	assert _match(["build/"], "build", False) is None
+
+def test_last_matching_rule_decides():
+	rules = ["*.log", "!keep.log"]
+	assert _match(rules, "other.log") is True
+	assert _match(rules, "keep.log") is False
+	assert _match(rules, "a.txt") is None
+	assert _match(["!keep.log", "*.log"], "keep.log") is True
+
+def test_comments_blanks_and_escapes():
+	assert not Rules(["# comment", "", "   "])
+	assert _match(["# a"], "# a") is None
+	assert _match(["\\#a"], "#a") is True
+	assert _match(["\\!a"], "!a") is True
+	assert _match(["a.txt   "], "a.txt") is True
+	assert _match(["a\\*"], "a*") is True
+	assert _match(["a\\*"], "ab") is None
+
+def test_ignore_files(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	(tmp_path / "sub" / "deep").mkdir(parents=True)
+	(tmp_path / "skip").mkdir()
+	(tmp_path / ".s2rignore").write_text("*.tmp\nskip/\n")
+	(tmp_path / "sub" / ".s2rignore").write_text("!keep.tmp\n/only.txt\n")
+	excluded = filters.ExcludedPaths(filters.Filter.from_state({'filters': ["*.bak"]}))
+	assert excluded("a.tmp")
+	assert excluded("a.bak")
+	assert excluded("sub/a.bak")
+	assert not excluded("a.txt")
+	assert excluded("skip/a.txt")
+	assert excluded.dir_excluded("skip")
+	assert excluded.dir_filter("skip") is None
+	# rules of subdirectories take precedence
+	assert not excluded("sub/keep.tmp")
+	assert excluded("sub/deep/a.tmp")
+	assert excluded("sub/only.txt")
+	assert not excluded("sub/deep/only.txt")
+	assert not excluded("only.txt")
+
+def test_bracket_edge_cases():
+	# a leading ']' is part of the class
+	assert _match(["[]x]"], "]") is True
+	assert _match(["[]x]"], "x") is True
+	assert _match(["[]x]"], "y") is None
+	assert _match(["[!]x]"], "y") is True
+	assert _match(["[!]x]"], "]") is None
+	assert _match(["[a\\]]b"], "]b") is True
+	assert _match(["[a-]"], "-") is True
+	# negated classes do not match '/' either
+	assert _match(["x[!a]y"], "x/y") is None
+
+def test_invalid_brackets_are_literal():
+	assert _match(["a[]b"], "a[]b") is True
+	assert _match(["a[]b"], "ab") is None
+	assert _match(["a[b"], "a[b") is True
+	assert _match(["[z-a]"], "[z-a]") is True
+	assert _match(["[z-a]"], "m") is None
+	assert _match(["*.[ch"], "x.[ch") is True
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import pytest
+
+pytest.importorskip("PythonLib.MyBytesIO", reason="the client and server need "
+	"the PythonLib submodule: run 'git submodule update --init'")
+
+import clientcomm
+import shared
+import statefile
+
+PKG_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATE_FILE = ".s2rstate.json"
+
+def _write(fn, data):
+	os.makedirs(os.path.dirname(fn), exist_ok=True)
+	with open(fn, 'wb') as f:
+		f.write(data)
+
+def _client(*args, cwd):
+	subprocess.run([sys.executable, PKG_DIR, "client", *args], cwd=cwd, check=True,
+		stdout=subprocess.DEVNULL)
+
+def _sync(local, statsfn):
+	_client("sync", "--quiet", "--stats", statsfn, cwd=local)
+	with open(statsfn, 'r') as f:
+		report = json.load(f)
+	assert report['ok']
+	return report['counters']
+
+def _tree(top, skip=()):
+	"""returns {relative path: contents} of the files under 'top'"""
+	ret = {}
+	for root, _, names in os.walk(top):
+		for n in names:
+			fn = os.path.join(root, n)
+			rel = os.path.relpath(fn, top)
+			if rel not in skip:
+				with open(fn, 'rb') as f:
+					ret[rel] = f.read()
+	return ret
+
+@pytest.fixture
+def server(tmp_path):
+	sock = str(tmp_path / "s2r.sock")
+	p = subprocess.Popen([sys.executable, PKG_DIR, "server", "--listen",
+		f"unix:{sock}"])
+	try:
+		deadline = time.monotonic() + 10
+		while not os.path.exists(sock):
+			assert p.poll() is None and time.monotonic() < deadline
+			time.sleep(0.05)
+		yield f"unix:{sock}"
+	finally:
+		p.terminate()
+		p.wait()
+
+def test_sync(tmp_path, server):
+	rnd = random.Random(1)
+	local = str(tmp_path / "local")
+	remote = str(tmp_path / "remote")
+	os.makedirs(local)
+	os.makedirs(remote)
+	statsfn = str(tmp_path / "stats.json")
+
+	_client("genemptystate", cwd=local)
+	statefn = os.path.join(local, STATE_FILE)
+	with open(statefn, 'r') as f:
+		sw = json.load(f)
+	sw['transport'] = server
+	sw['remotecwd'] = remote
+	with open(statefn, 'w') as f:
+		json.dump(sw, f)
+
+	dup = rnd.randbytes(8192)
+	_write(f"{local}/a.txt", b"hello\n")
+	_write(f"{local}/sub/b.bin", rnd.randbytes(2 * 1_048_576))
+	_write(f"{local}/moved.bin", rnd.randbytes(1_572_864))
+	_write(f"{local}/dup1", dup)
+	_write(f"{local}/dup2", dup)
+	for i in range(20):
+		_write(f"{local}/small/f{i}", rnd.randbytes(100 + i))
+	counters = _sync(local, statsfn)
+	assert counters.get('files_copied', 0) >= 1
+	# uploads are hashed as they are sent
+	with statefile.StateData(statefile.data_file_name(statefn)) as data:
+		assert data["small/f0"][3] == shared.file_digest(f"{local}/small/f0")
+		assert data["moved.bin"][3] is not None
+
+	# rename, small change in a large file, and an interrupted large upload
+	os.rename(f"{local}/moved.bin", f"{local}/moved2.bin")
+	os.rename(f"{local}/small", f"{local}/small2")
+	with open(f"{local}/sub/b.bin", 'r+b') as f:
+		f.seek(1_000_000)
+		f.write(rnd.randbytes(100))
+	os.utime(f"{local}/sub/b.bin", (0, time.time() + 10))
+	big = rnd.randbytes(clientcomm.RESUME_MIN_SZ)
+	_write(f"{local}/big.bin", big)
+	done = len(big) // 2
+	_write(f"{remote}/.big.bin.s2rpart", big[:done])
+	with open(f"{remote}/.big.bin.s2rpart.json", 'w') as f:
+		json.dump({'size': len(big), 'digest': hashlib.blake2b(big,
+			digest_size=shared.DIGEST_LEN).hexdigest(), 'done': done}, f)
+	counters = _sync(local, statsfn)
+	assert counters.get('files_renamed', 0) >= 2
+	assert counters.get('files_updated', 0) <= 2
+	assert counters.get('delta_literal_bytes', 0) < 2 * 1_048_576
+	assert counters.get('resumed_bytes', 0) == done
+
+	statefiles = {STATE_FILE, STATE_FILE + ".data"}
+	assert _tree(remote) == _tree(local, statefiles)
@@ -0,0 +1,92 @@
+import json
+import os
+import pytest
+import statefile
+
+DIGEST = "00112233445566778899aabbccddeeff"
+
+ENTRIES = {
+	"b.txt": (False, 1_700_000_000, 12, DIGEST, 1001),
+	"a/run.sh": (True, 1_700_000_001, 0, None, 1002),
+	"a/link": ("../b.txt", 1_700_000_002, None, None, None),
+	"a-b": (False, -5, 1 << 40, None, None),
+	"ä/x": (False, 3, 7, None, 1003),
+}
+DIRS = {
+	"": (10, 20, (["a", "a-b", "b.txt", "ä"], bytes([2, 0, 0, 2]))),
+	"a": (11, 21, (["link", "run.sh"], bytes([1, 0]))),
+}
+
+def _write(tmp_path, items, dirs=None):
+	fn = str(tmp_path / "state.data")
+	statefile.write(fn, items, dirs)
+	return fn
+
+def test_round_trip(tmp_path):
+	fn = _write(tmp_path, ENTRIES.items(), DIRS)
+	with statefile.StateData(fn) as data:
+		assert len(data) == len(ENTRIES)
+		assert list(data) == sorted(ENTRIES, key=statefile.sort_key)
+		assert dict(data.items()) == ENTRIES
+		assert data["a/link"] == ENTRIES["a/link"]
+		assert data.get("missing") is None
+		assert "a/run.sh" in data and "a" not in data
+		assert data.has_prefix("a/") and data.has_prefix("ä/")
+		assert not data.has_prefix("c/")
+		inodes, sizes, digests = data.file_ids()
+		assert inodes == {1001, 1002, 1003}
+		assert sizes == {12, 0, 1 << 40, 7}
+		assert digests == {bytes.fromhex(DIGEST)}
+		assert data.dirs() == DIRS
+
+def test_many_entries(tmp_path):
+	# spans several restart points
+	items = {f"d{i % 7}/f{i}": (False, i, i, None, i + 1) for i in range(1000)}
+	fn = _write(tmp_path, items.items())
+	with statefile.StateData(fn) as data:
+		assert list(data) == sorted(items, key=statefile.sort_key)
+		for k in ("d0/f0", "d3/f500", "d6/f993"):
+			assert data[k] == items[k]
+		assert data.get("d3/f5000") is None
+		assert data.dirs() == {}
+
+def test_json_migration(tmp_path):
+	# older versions embed the data in the JSON, without size, digest and inode
+	old = json.loads(json.dumps({"data": {
+		"x": [True, 5],
+		"l": ["x", 6],
+		"y": [False, 7, 3],
+	}}))
+	fn = _write(tmp_path, old["data"].items())
+	with statefile.StateData(fn) as data:
+		assert dict(data.items()) == {
+			"x": (True, 5, 0, None, None),
+			"l": ("x", 6, None, None, None),
+			"y": (False, 7, 3, None, None),
+		}
+
+def test_empty(tmp_path):
+	fn = _write(tmp_path, [])
+	with statefile.StateData(fn) as data:
+		assert len(data) == 0
+		assert list(data.items()) == []
+		assert not data.has_prefix("")
+
+def test_corrupt(tmp_path):
+	fn = _write(tmp_path, ENTRIES.items(), DIRS)
+	with open(fn, 'rb') as f:
+		contents = f.read()
+	for size in (0, 4, 64, len(contents) // 2):
+		with open(fn, 'wb') as f:
+			f.write(contents[:size])
+		with pytest.raises(ValueError):
+			statefile.StateData(fn)
+	with open(fn, 'wb') as f:
+		f.write(b"XXXX" + contents[4:])
+	with pytest.raises(ValueError):
+		statefile.StateData(fn)
+
+def test_data_file_name():
+	assert statefile.data_file_name(".s2rstate.json") == ".s2rstate.json.data"
+	assert statefile.data_file_name("a/s") != statefile.data_file_name("a/s.data")
+	assert os.path.dirname(statefile.data_file_name("a/s")) == "a"
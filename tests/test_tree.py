@@ -0,0 +1,74 @@
+import statefile
+from tree import Tree, sorted_items
+
+# names that sort differently by path than by directory
+KEYS = ["a/b", "a-b", "a.b", "a0", "a", "b/c/d", "b/c-d", "b/c/e/f", "b/c0",
+	"ä", "z", "a/b-c/d", "a/b/c", ".hidden", "B"]
+
+def _entry(i):
+	return (False, i, i * 10, None, i + 1)
+
+def _tree():
+	return Tree({k: _entry(i) for i, k in enumerate(KEYS) if k not in ("a", "b/c")})
+
+def test_iteration_in_sort_key_order():
+	t = _tree()
+	expected = sorted((k for k in KEYS if k not in ("a", "b/c")), key=statefile.sort_key)
+	assert list(t) == expected
+	assert [k for k, _ in t.items()] == expected
+	assert len(t) == len(expected)
+
+def test_same_order_as_state_data(tmp_path):
+	t = _tree()
+	fn = str(tmp_path / "state.data")
+	statefile.write(fn, t.items(), presorted=True)
+	with statefile.StateData(fn) as data:
+		assert list(data.items()) == list(t.items())
+
+def test_entries():
+	t = Tree()
+	t["f"] = (True, 1, 2, "00" * statefile.DIGEST_LEN, 3)
+	t["l"] = ("f", 4, None, None, None)
+	t["old"] = [False, 5]
+	assert t["f"] == (True, 1, 2, "00" * statefile.DIGEST_LEN, 3)
+	assert t["l"] == ("f", 4, None, None, None)
+	assert t["old"] == (False, 5, 0, None, None)
+	t["l"] = (False, 6, 7, None, None)
+	assert t.get("l") == (False, 6, 7, None, None)
+	assert t.get("missing") is None
+	assert len(t) == 3
+
+def test_delete():
+	t = _tree()
+	n = len(t)
+	assert t.pop("b/c/d") == _entry(KEYS.index("b/c/d"))
+	del t["a.b"]
+	assert t.pop("a.b", None) is None
+	assert "b/c/d" not in t and "b/c/e/f" in t
+	assert len(t) == n - 2
+	assert list(t) == sorted(t, key=statefile.sort_key)
+
+def test_replace_while_iterating():
+	t = _tree()
+	for k, v in t.items():
+		t[k] = (v[0], v[1] + 100, v[2], v[3], v[4])
+	assert all(v[1] >= 100 for _, v in t.items())
+
+def test_add_dirs_yields_in_sort_order():
+	dirs = [
+		("", [("z", _entry(0)), ("a-b", _entry(1)), ("a0", _entry(2))]),
+		("a", [("x", _entry(3)), ("b-c", _entry(4))]),
+		("a/b", [("c", _entry(5))]),
+		("a/b/c", []),
+		("a/d", [("e", _entry(6))]),
+		("b", [("f", _entry(7))]),
+	]
+	t = Tree()
+	keys = [k for k, _ in t.add_dirs(iter(dirs))]
+	assert keys == list(t)
+	assert keys == sorted(keys, key=statefile.sort_key)
+	assert len(t) == 8
+
+def test_sorted_items_of_dict():
+	d = {k: _entry(i) for i, k in enumerate(KEYS)}
+	assert [k for k, _ in sorted_items(d)] == sorted(KEYS, key=statefile.sort_key)
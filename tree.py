@@ -0,0 +1,272 @@
+import itertools
+from array import array
+from bisect import bisect_left, insort
+import statefile
+from statefile import KIND_FILE, KIND_EXECUTABLE, KIND_SYMLINK, KIND_MASK, \
+	HAS_DIGEST, DIGEST_LEN
+
+class _Node:
+	"""
+	Entries of a directory, as columns sorted by name. Digests are stored
+	whether the entry has one or not (see HAS_DIGEST).
+	"""
+	__slots__ = ('names', 'kinds', 'mtimes', 'sizes', 'inodes', 'digests',
+		'targets', 'subdirs')
+
+	def __init__(self):
+		self.names = []
+		self.kinds = bytearray()
+		self.mtimes = array('q')
+		self.sizes = array('Q')
+		self.inodes = array('Q')
+		self.digests = bytearray()
+		self.targets = {} # {name: symlink target}
+		# names of the subdirectories followed by '/', which is how they sort
+		# among the names of the entries
+		self.subdirs = []
+
+	def entry(self, i):
+		kind = self.kinds[i]
+		digest = None
+		if kind & HAS_DIGEST:
+			digest = self.digests[i * DIGEST_LEN:(i + 1) * DIGEST_LEN].hex()
+		if kind & KIND_MASK == KIND_SYMLINK:
+			return (self.targets[self.names[i]], self.mtimes[i], None, digest, None)
+		return (kind & KIND_MASK == KIND_EXECUTABLE, self.mtimes[i], self.sizes[i],
+			digest, self.inodes[i] or None)
+
+	def insert(self, i, name, v):
+		self.names.insert(i, name)
+		self.kinds.insert(i, 0)
+		self.mtimes.insert(i, 0)
+		self.sizes.insert(i, 0)
+		self.inodes.insert(i, 0)
+		self.digests[i * DIGEST_LEN:i * DIGEST_LEN] = bytes(DIGEST_LEN)
+		self.set(i, v)
+
+	def set(self, i, v):
+		info = v[0]
+		digest = v[3] if len(v) > 3 else None
+		name = self.names[i]
+		if isinstance(info, str):
+			kind = KIND_SYMLINK
+			self.targets[name] = info
+			size = ino = 0
+		else:
+			kind = KIND_EXECUTABLE if info else KIND_FILE
+			self.targets.pop(name, None)
+			size = (v[2] if len(v) > 2 else None) or 0
+			ino = (v[4] if len(v) > 4 else None) or 0
+		if digest:
+			kind |= HAS_DIGEST
+			self.digests[i * DIGEST_LEN:(i + 1) * DIGEST_LEN] = bytes.fromhex(digest)
+		self.kinds[i] = kind
+		self.mtimes[i] = v[1]
+		self.sizes[i] = size
+		self.inodes[i] = ino
+
+	def delete(self, i):
+		self.targets.pop(self.names[i], None)
+		del self.names[i]
+		del self.kinds[i]
+		del self.mtimes[i]
+		del self.sizes[i]
+		del self.inodes[i]
+		del self.digests[i * DIGEST_LEN:(i + 1) * DIGEST_LEN]
+
+class Tree:
+	"""
+	Compact mapping of {relative path name: [target, mtime, size, digest, inode]}
+	(see client.recursive_scan) for large trees. Entries are stored by
+	directory, as columns sorted by name, so paths are not kept as strings.
+	Iteration is in statefile.sort_key order, as with statefile.StateData, so
+	that trees can be merged without sorting or hashing their paths.
+	Entries can be replaced while iterating, but not added or deleted.
+	"""
+	def __init__(self, items=()):
+		self._dirs = {"": _Node()} # {relative dir path: _Node}
+		self._len = 0
+		# (key, node, index) of the entry last yielded by items(), so that it can
+		# be replaced without looking it up. Reset when entries are added or
+		# deleted.
+		self._cursor = None
+		self.update(items)
+
+	def _node(self, d):
+		"""Node of directory 'd', created along with its parents if needed"""
+		node = self._dirs.get(d)
+		if node is None:
+			parent, _, name = d.rpartition('/')
+			insort(self._node(parent).subdirs, name + '/')
+			node = self._dirs[d] = _Node()
+		return node
+
+	def _find(self, key):
+		"""returns (node of the parent directory or None, index or -1)"""
+		d, _, name = key.rpartition('/')
+		node = self._dirs.get(d)
+		if node is None:
+			return None, -1
+		i = bisect_left(node.names, name)
+		if i < len(node.names) and node.names[i] == name:
+			return node, i
+		return node, -1
+
+	def add_dir(self, d, entries):
+		"""
+		Add list of (name, entry) of the files and symlinks of directory 'd'
+		('' for the top directory)
+		"""
+		node = self._node(d)
+		self._cursor = None
+		if node.names:
+			for name, v in entries:
+				self[f"{d}/{name}" if d else name] = v
+			return
+		entries.sort(key=lambda x: x[0])
+		node.names = [name for name, _ in entries]
+		node.kinds = bytearray(len(entries))
+		node.mtimes = array('q', bytes(8 * len(entries)))
+		node.sizes = array('Q', bytes(8 * len(entries)))
+		node.inodes = array('Q', bytes(8 * len(entries)))
+		node.digests = bytearray(DIGEST_LEN * len(entries))
+		for i, (_, v) in enumerate(entries):
+			node.set(i, v)
+		self._len += len(entries)
+
+	def add_dirs(self, dirs):
+		"""
+		Add the directories of iterable 'dirs' of (relative dir path, list of
+		(name, entry)) as they come, as add_dir does. They must come in the order
+		of scanner.iter_scan: parents first, in sort order of their paths followed
+		by '/', so that entries preceding the next directory can be told to be
+		complete.
+		yields:
+			(relative path name, entry) of the added entries in sort order, as
+			soon as no later directory can precede them. They can be replaced
+			meanwhile, as with items().
+		"""
+		# [prefix, node, next entry] of the directories with entries yet to be
+		# yielded. The innermost one is last, and they are ancestors of each other.
+		pending = []
+		for d, entries in itertools.chain(dirs, ((None, None),)):
+			bound = d + '/' if d else ""
+			while pending:
+				frame = pending[-1]
+				prefix, node, i = frame
+				names = node.names
+				while i < len(names) and (d is None or prefix + names[i] < bound):
+					key = prefix + names[i]
+					self._cursor = (key, node, i)
+					yield key, node.entry(i)
+					i += 1
+				if i < len(names):
+					# 'd' is under it
+					frame[2] = i
+					break
+				pending.pop()
+			if d is not None:
+				self.add_dir(d, entries)
+				pending.append([bound, self._dirs[d], 0])
+
+	def __len__(self):
+		return self._len
+
+	def __contains__(self, key):
+		return self._find(key)[1] >= 0
+
+	def get(self, key, default=None):
+		node, i = self._find(key)
+		return node.entry(i) if i >= 0 else default
+
+	def __getitem__(self, key):
+		node, i = self._find(key)
+		if i < 0:
+			raise KeyError(key)
+		return node.entry(i)
+
+	def __setitem__(self, key, v):
+		cursor = self._cursor
+		if cursor is not None and cursor[0] is key:
+			cursor[1].set(cursor[2], v)
+			return
+		node, i = self._find(key)
+		if i >= 0:
+			node.set(i, v)
+			return
+		self._cursor = None
+		d, _, name = key.rpartition('/')
+		node = self._node(d)
+		node.insert(bisect_left(node.names, name), name, v)
+		self._len += 1
+
+	def __delitem__(self, key):
+		node, i = self._find(key)
+		if i < 0:
+			raise KeyError(key)
+		node.delete(i)
+		self._len -= 1
+		self._cursor = None
+
+	def pop(self, key, *default):
+		node, i = self._find(key)
+		if i < 0:
+			if default:
+				return default[0]
+			raise KeyError(key)
+		ret = node.entry(i)
+		node.delete(i)
+		self._len -= 1
+		self._cursor = None
+		return ret
+
+	def update(self, items):
+		if hasattr(items, 'items'):
+			items = items.items()
+		for k, v in items:
+			self[k] = v
+
+	def _walk(self):
+		"""yields (path prefix of the directory, node, index) in sort order"""
+		# [node, prefix, next entry, next subdirectory]
+		stack = [[self._dirs[""], "", 0, 0]]
+		while stack:
+			frame = stack[-1]
+			node, prefix, i, j = frame
+			names = node.names
+			if j < len(node.subdirs):
+				sub = node.subdirs[j]
+				while i < len(names) and names[i] < sub:
+					yield prefix, node, i
+					i += 1
+				frame[2] = i
+				frame[3] = j + 1
+				stack.append([self._dirs[prefix + sub[:-1]], prefix + sub, 0, 0])
+				continue
+			while i < len(names):
+				yield prefix, node, i
+				i += 1
+			stack.pop()
+
+	def items(self):
+		for prefix, node, i in self._walk():
+			key = prefix + node.names[i]
+			self._cursor = (key, node, i)
+			yield key, node.entry(i)
+
+	def __iter__(self):
+		for prefix, node, i in self._walk():
+			yield prefix + node.names[i]
+
+	def keys(self):
+		return iter(self)
+
+def sorted_items(state):
+	"""
+	Items of 'state' (a Tree, a statefile.StateData or a dict) in
+	statefile.sort_key order
+	"""
+	if isinstance(state, (Tree, statefile.StateData)):
+		return state.items()
+	# str ordering is the same as the UTF8 encoded ordering of statefile
+	return iter(sorted(state.items()))
@@ -0,0 +1,221 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+	IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+# changes are reported once no new events arrived for this long (seconds) ...
+COALESCE_DELAY = 0.05
+# ... or this long after the first event, whichever comes first
+MAX_DELAY = 0.5
+
+READ_SZ = 65536
+
+# struct inotify_event: int wd, uint32_t mask, cookie, len, followed by name
+_EVENT = struct.Struct("=iIII")
+
+def _load_libc():
+	libc = ctypes.CDLL(None, use_errno=True)
+	if not hasattr(libc, 'inotify_init1'):
+		raise OSError(errno.ENOSYS, "inotify is not supported on this platform")
+	libc.inotify_init1.argtypes = [ctypes.c_int]
+	libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+	libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+	return libc
+
+def _join(parent, name):
+	return name if parent == "." else f"{parent}/{name}"
+
+class TreeWatcher:
+	"""
+	Watch the current directory and all of its subdirectories for changes using
+	inotify. Paths are relative path names, as in client.recursive_scan.
+	Subdirectories for which the callable 'excluded_dir' returns True are not
+	watched.
+	"""
+	def __init__(self, resolve_symlink, excluded_dir=None):
+		self._libc = _load_libc()
+		self._resolve_symlink = resolve_symlink
+		self.excluded_dir = excluded_dir
+		self._mask = WATCH_MASK | (0 if resolve_symlink else IN_DONT_FOLLOW)
+		self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+		if self._fd < 0:
+			raise _errno_oserror()
+		self._poll = select.poll()
+		self._poll.register(self._fd, select.POLLIN)
+		self._wds = {} # {watch descriptor: relative dir path}
+		self._dirs = {} # {relative dir path: watch descriptor}
+		self._dirty = set()
+		self._overflowed = False
+		try:
+			self.add_tree(".")
+		except:
+			self.close()
+			raise
+
+	def close(self):
+		if self._fd >= 0:
+			os.close(self._fd)
+			self._fd = -1
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def add_tree(self, path):
+		"""Watch directory 'path' and its subdirectories"""
+		todo = [path]
+		while todo:
+			d = todo.pop()
+			if d != "." and self.excluded_dir is not None and self.excluded_dir(d):
+				continue
+			if not self._add_watch(d):
+				continue
+			try:
+				with os.scandir(d) as it:
+					for de in it:
+						if de.is_dir(follow_symlinks=self._resolve_symlink):
+							todo.append(_join(d, de.name))
+			except OSError:
+				# removed in the meantime: its parent will report that
+				pass
+
+	def _add_watch(self, path):
+		wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self._mask)
+		if wd < 0:
+			err = ctypes.get_errno()
+			if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+				return False
+			if err == errno.ENOSPC:
+				raise OSError(err, "Too many directories to watch. Increase the "\
+					"'fs.inotify.max_user_watches' sysctl.")
+			raise _errno_oserror(path)
+		# the same directory can be added again under a new name when moved
+		oldpath = self._wds.get(wd)
+		if oldpath is not None and self._dirs.get(oldpath) == wd:
+			del self._dirs[oldpath]
+		self._wds[wd] = path
+		self._dirs[path] = wd
+		return True
+
+	def _remove_tree(self, path):
+		"""Stop watching directory 'path' and its subdirectories"""
+		prefix = path + "/"
+		for d in [d for d in self._dirs if d == path or d.startswith(prefix)]:
+			wd = self._dirs.pop(d)
+			del self._wds[wd]
+			self._libc.inotify_rm_watch(self._fd, wd)
+
+	def _handle_event(self, wd, mask, name):
+		if mask & IN_Q_OVERFLOW:
+			self._overflowed = True
+			# directories created meanwhile have to be watched too
+			self.add_tree(".")
+			return
+		if mask & IN_IGNORED:
+			# watch removed, e.g. directory deleted
+			path = self._wds.pop(wd, None)
+			if path is not None and self._dirs.get(path) == wd:
+				del self._dirs[path]
+			return
+		parent = self._wds.get(wd)
+		if parent is None or not name:
+			# stale watch, or event on the watched directory itself
+			return
+		path = _join(parent, name)
+		self._dirty.add(path)
+		if mask & (IN_CREATE | IN_MOVED_TO):
+			if mask & IN_ISDIR or (self._resolve_symlink and os.path.isdir(path)):
+				self.add_tree(path)
+		elif mask & IN_MOVED_FROM and mask & IN_ISDIR:
+			self._remove_tree(path)
+
+	def _read_events(self):
+		while True:
+			try:
+				buf = os.read(self._fd, READ_SZ)
+			except BlockingIOError:
+				return
+			off = 0
+			while off < len(buf):
+				wd, mask, _, namelen = _EVENT.unpack_from(buf, off)
+				off += _EVENT.size
+				name = buf[off:off + namelen].rstrip(b'\0')
+				off += namelen
+				self._handle_event(wd, mask, os.fsdecode(name))
+
+	def wait_changes(self, timeout=None):
+		"""
+		Wait for changes, then keep collecting them until they settle down (see
+		COALESCE_DELAY and MAX_DELAY).
+		returns:
+			(set of changed relative path names, whether events were lost)
+			Changed paths can be files or directories, which may no longer exist.
+			Paths under a changed directory are not listed separately.
+			The set is empty if nothing changed within 'timeout' seconds.
+			If events were lost, the whole tree has to be rescanned.
+		"""
+		first = None
+		end = None if timeout is None else time.monotonic() + timeout
+		while True:
+			now = time.monotonic()
+			if first is not None:
+				wait = min(COALESCE_DELAY, first + MAX_DELAY - now)
+			elif end is not None:
+				wait = end - now
+			else:
+				wait = None
+			if wait is not None and wait <= 0:
+				break
+			if not self._poll.poll(None if wait is None else wait * 1000):
+				if first is not None:
+					# settled down
+					break
+				continue
+			self._read_events()
+			if first is None and (self._dirty or self._overflowed):
+				first = time.monotonic()
+
+		dirty, overflowed = self._dirty, self._overflowed
+		self._dirty = set()
+		self._overflowed = False
+		return _remove_nested(dirty), overflowed
+
+def _remove_nested(paths):
+	ret = set()
+	# parents sort before their children
+	for path in sorted(paths):
+		if not any(p in ret for p in _ancestors(path)):
+			ret.add(path)
+	return ret
+
+def _ancestors(path):
+	while True:
+		path = os.path.dirname(path)
+		if not path:
+			return
+		yield path
+
+def _errno_oserror(fn=None):
+	err = ctypes.get_errno()
+	return OSError(err, os.strerror(err), fn)